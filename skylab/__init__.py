@@ -10,7 +10,9 @@
 
 import os
 import prettytable
-import shelve
+import sqlite3
+
+from skylab import state
 
 
 class LimitsUnavailable(Exception):
@@ -33,6 +35,14 @@ class NotEnoughNodes(Exception):
     pass
 
 
+class QuotaExceeded(Exception):
+    pass
+
+
+class TemplateError(Exception):
+    pass
+
+
 class RetryError(Exception):
     pass
 
@@ -65,49 +75,51 @@ def print_horiz_table(data):
     print(table)
 
 
-class Shelve(object):
-    """Context Manager for opening and closing access to the DBM."""
+class Database(object):
+    """Context Manager for opening and closing access to the state DB."""
 
     def __init__(self, file_path):
-        """Set the Path to the DBM to create/Open.
+        """Set the Path to the state DB to create/Open.
 
         :param file_path: Full path to file
         """
 
-        self.shelve = file_path
-        self.open_shelve = None
+        self.database = file_path
+        self.conn = None
 
     def __enter__(self):
-        """Open the DBM in r/w mode.
+        """Open the state DB in r/w mode.
 
-        :return: Open DBM
+        :return: ``state.Store``
         """
 
-        self.open_shelve = shelve.open(self.shelve, writeback=True)
-        return self.open_shelve
+        self.conn = sqlite3.connect(
+            self.database, timeout=30, isolation_level=None
+        )
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        return state.Store(conn=self.conn)
 
     def __exit__(self, type, value, traceback):
-        """Close DBM Connection."""
+        """Close state DB Connection."""
 
-        self.open_shelve.sync()
-        self.open_shelve.close()
+        self.conn.close()
 
 
-def dbm_create(db_path, db_name, db_key):
-    """Create a DBM.
+def dbm_create(db_path, db_name, db_key=None):
+    """Create the state DB and the entry for a lab.
 
     :param db_path: Path to a directory
-    :param db_name: Name of DBM
+    :param db_name: Name of the state DB
+    :param db_key: Name of the lab, no lab entry is created if not set
     """
 
     db_path = os.path.expanduser(db_path)
     if not os.path.exists(db_path):
         os.mkdir(db_path)
 
-    database_path = os.path.join(db_path, db_name)
-    with Shelve(file_path=database_path) as db:
-        host = db.get(db_key)
-        if host is None:
-            db[db_key] = {}
+    database_path = os.path.join(db_path, '%s.sqlite' % db_name)
+    with Database(file_path=database_path) as db:
+        if db_key is not None:
+            db.add_lab(lab=db_key)
 
-    return database_path
\ No newline at end of file
+    return database_path
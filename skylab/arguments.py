@@ -18,8 +18,32 @@ import os
 from skylab import info
 
 
-def args():
-    """Parse the Command Line Arguments."""
+def args(argv=None):
+    """Parse the Command Line Arguments.
+
+    :param argv: ``list`` of arguments, sys.argv is used if not set.
+    """
+
+    par, _ = parser()
+    return vars(par.parse_args(argv))
+
+
+def command_defaults(command):
+    """Return the default values of the options of a sub command.
+
+    :param command: Name of the sub command, IE "build-lab".
+    :return: ``dict``
+    """
+
+    _, subpar = parser()
+    return vars(subpar.choices[command].parse_args([]))
+
+
+def parser():
+    """Return the argument parser and its sub command parsers.
+
+    :return: ``tuple``
+    """
 
     par = argparse.ArgumentParser(
         usage='%(prog)s',
@@ -30,6 +54,40 @@ def args():
                      help='Enable Debug Mode',
                      action='store_true',
                      default=False)
+    par.add_argument('--log-path',
+                     metavar='',
+                     help=('Directory for the per node build logs,'
+                           ' DEFAULT: %(default)s'),
+                     default=os.path.join(os.environ.get('HOME', ''),
+                                          'skylab_logs'))
+    par.add_argument('--executor',
+                     metavar='',
+                     choices=['process', 'thread'],
+                     help=('Worker type used for API jobs, process|thread.'
+                           ' DEFAULT: %(default)s'),
+                     default='thread')
+    par.add_argument('--workers',
+                     metavar='',
+                     type=int,
+                     help=('Maximum number of concurrent workers,'
+                           ' DEFAULT: %(default)s'),
+                     default=10)
+
+    met = par.add_argument_group('Metrics Options')
+    met.add_argument('--metrics-file',
+                     metavar='',
+                     help=('JSON report of the run, DEFAULT: metrics.json in'
+                           ' the log path of the lab'),
+                     default=None)
+    met.add_argument('--statsd',
+                     metavar='',
+                     help='Send the metrics to StatsD at "host:port"',
+                     default=None)
+    met.add_argument('--prom-textfile',
+                     metavar='',
+                     help=('Write the metrics to a Prometheus textfile'
+                           ' collector file, IE "skylab.prom"'),
+                     default=None)
 
     dba = par.add_argument_group('Local Database Options')
     dba.add_argument('--db-path',
@@ -57,6 +115,17 @@ def args():
                            ' variables file path is found the key will be'
                            ' created for you, DEFAULT: "%(default)s"'),
                      default='~/.ssh/id_rsa.pub')
+    key.add_argument('--ssh-pool-size',
+                     metavar='',
+                     type=int,
+                     help=('Maximum number of SSH connections kept open'
+                           ' per process, DEFAULT: %(default)s'),
+                     default=10)
+    key.add_argument('--batch-steps',
+                     help=('Join the steps which are ready on a node into'
+                           ' one script run in a single remote shell'),
+                     action='store_true',
+                     default=False)
 
     aut = par.add_argument_group('Openstack Auth Options')
     key_types = aut.add_mutually_exclusive_group(required=True)
@@ -102,6 +171,34 @@ def args():
                      metavar='',
                      help='Naming convention for all nodes',
                      default='skylab')
+    lin.add_argument('--role',
+                     metavar='',
+                     choices=['controller', 'compute'],
+                     help='Only show the nodes of a role, controller|compute',
+                     default=None)
+    lin.add_argument('--node',
+                     metavar='',
+                     help='Only show one node, IE "<name>_compute1"',
+                     default=None)
+    lin.add_argument('--fields',
+                     metavar='',
+                     help=('Comma separated fields to show, from id, name,'
+                           ' server_name, role, status, lab_address,'
+                           ' public_net, private_net, flavor, image and'
+                           ' created. DEFAULT: %(default)s'),
+                     default='id,name,lab_address,public_net')
+    lin.add_argument('--format',
+                     metavar='',
+                     dest='output_format',
+                     choices=['table', 'json', 'csv'],
+                     help='Output format, table|json|csv DEFAULT: %(default)s',
+                     default='table')
+    lin.add_argument('--watch',
+                     metavar='',
+                     type=float,
+                     help=('Refresh the nodes from the server listing every'
+                           ' number of seconds, until interrupted'),
+                     default=None)
 
     dbi = subpar.add_parser('db-show',
                             help='Show the local database information')
@@ -109,17 +206,143 @@ def args():
     dbi.add_argument('-n',
                      '--name',
                      metavar='',
-                     help='Naming convention for all nodes',
-                     default='skylab')
+                     help='Only show one lab, every lab if not set',
+                     default=None)
+    dbi.add_argument('--format',
+                     metavar='',
+                     dest='output_format',
+                     choices=['table', 'json', 'csv'],
+                     help='Output format, table|json|csv DEFAULT: %(default)s',
+                     default='json')
+    dbi.add_argument('--show-secrets',
+                     help=('Show the keys and passwords of the labs, which'
+                           ' are hidden by default'),
+                     action='store_true',
+                     default=False)
 
     skl = subpar.add_parser('scuttle-lab',
-                            help='Show the local database information')
+                            help=('Delete the servers and the network of a'
+                                  ' lab'))
     skl.set_defaults(method='scuttle_lab')
     skl.add_argument('-n',
                      '--name',
                      metavar='',
                      help='Naming convention for all nodes',
                      default='skylab')
+    skl.add_argument('--unrecorded',
+                     help=('Also delete the servers named after the lab'
+                           ' which are not in the local DB'),
+                     action='store_true',
+                     default=False)
+
+    rsm = subpar.add_parser('resume-lab',
+                            help=('Resume a failed lab build, skipping the'
+                                  ' steps which already completed'))
+    rsm.set_defaults(method='resume_lab')
+    rsm.add_argument('-n',
+                     '--name',
+                     metavar='',
+                     help='Naming convention for all nodes',
+                     default='skylab')
+
+    scl = subpar.add_parser('scale-lab',
+                            help=('Add or remove compute nodes of a built lab'
+                                  ' without rebuilding it'))
+    scl.set_defaults(method='scale_lab')
+    scl.add_argument('-n',
+                     '--name',
+                     metavar='',
+                     help='Naming convention for all nodes',
+                     default='skylab')
+    scl.add_argument('--computes',
+                     metavar='',
+                     type=int,
+                     help='Number of compute nodes the lab is scaled to',
+                     required=True)
+    scl.add_argument('--refresh-catalog',
+                     help=('Ignore the cached flavor, image and network'
+                           ' listings and fetch them again'),
+                     action='store_true',
+                     default=False)
+    scl.add_argument('--no-bulk-create',
+                     help=('Create the compute nodes one at a time instead'
+                           ' of with a single multi-create request'),
+                     action='store_true',
+                     default=False)
+
+    bke = subpar.add_parser('bake-image',
+                            help=('Bake the steps which are the same on every'
+                                  ' node into an image that labs can be'
+                                  ' built from'))
+    bke.set_defaults(method='bake_image')
+    bke.add_argument('--image-name',
+                     metavar='',
+                     help='Name of the baked image, DEFAULT: %(default)s',
+                     default='skylab-baked')
+    bke.add_argument('--replace',
+                     help='Replace an image with the same name',
+                     action='store_true',
+                     default=False)
+    bke.add_argument('-n',
+                     '--name',
+                     metavar='',
+                     help=('Name of the server the image is baked on,'
+                           ' DEFAULT: %(default)s'),
+                     default='skylab_bake')
+    bke.add_argument('-i',
+                     '--image',
+                     metavar='',
+                     help=('The stock Image Name or ID the image is baked'
+                           ' from, DEFAULT: %(default)s'),
+                     default='Ubuntu 12.04 LTS (Precise Pangolin)')
+    bke.add_argument('--compute-ram',
+                     metavar='',
+                     type=int,
+                     help=('Ram of the server the image is baked on,'
+                           ' DEFAULT: %(default)s MB'),
+                     default=2048)
+    bke.add_argument('--cookbook-version',
+                     metavar='',
+                     help=('Cookbook Version baked into the image'
+                           ' DEFAULT: %(default)s'),
+                     default='master')
+    bke.add_argument('--artifact-path',
+                     metavar='',
+                     help=('Directory that the cookbook and package bundles'
+                           ' are kept in, DEFAULT: %(default)s'),
+                     default=os.path.join(os.environ.get('HOME', ''),
+                                          'skylab_artifacts'))
+    bke.add_argument('--refresh-artifacts',
+                     help=('Build the cookbook and package bundle again even'
+                           ' if it exists'),
+                     action='store_true',
+                     default=False)
+    bke.add_argument('--no-artifacts',
+                     help='Do not bake the cookbook and package bundle in',
+                     action='store_true',
+                     default=False)
+    bke.add_argument('--refresh-catalog',
+                     help=('Ignore the cached flavor, image and network'
+                           ' listings and fetch them again'),
+                     action='store_true',
+                     default=False)
+    bke.add_argument('-a',
+                     '--admin-pass',
+                     metavar='',
+                     help=('Admin password for the server.'
+                           ' DEFAULT: "%(default)s"'),
+                     default=None)
+    bke.add_argument('--ssh-port',
+                     metavar='',
+                     help=('SSH port to use for connection.'
+                           ' DEFAULT: "%(default)s"'),
+                     type=int,
+                     default=22)
+    bke.add_argument('--ssh-user',
+                     metavar='',
+                     help=('SSH username.'
+                           ' DEFAULT: "%(default)s"'),
+                     default='root')
 
     bld = subpar.add_parser('build-lab',
                             help='Build a Rackspace Private Cloud Lab')
@@ -135,6 +358,32 @@ def args():
                           help='CIDR for the Skylab Network',
                           default='172.16.51.0/24')
 
+    bld.add_argument('--refresh-catalog',
+                     help=('Ignore the cached flavor, image and network'
+                           ' listings and fetch them again'),
+                     action='store_true',
+                     default=False)
+    bld.add_argument('--artifact-path',
+                     metavar='',
+                     help=('Directory that the cookbook and package bundles'
+                           ' are kept in, DEFAULT: %(default)s'),
+                     default=os.path.join(os.environ.get('HOME', ''),
+                                          'skylab_artifacts'))
+    bld.add_argument('--refresh-artifacts',
+                     help=('Build the cookbook and package bundle again even'
+                           ' if it exists'),
+                     action='store_true',
+                     default=False)
+    bld.add_argument('--no-artifacts',
+                     help=('Fetch the cookbooks and packages from upstream on'
+                           ' the nodes instead of pushing a local bundle'),
+                     action='store_true',
+                     default=False)
+    bld.add_argument('--no-bulk-create',
+                     help=('Create the compute nodes one at a time instead'
+                           ' of with a single multi-create request'),
+                     action='store_true',
+                     default=False)
     bld.add_argument('--no-private',
                      help='Disable the default Private Network',
                      action='store_true',
@@ -187,4 +436,24 @@ def args():
                            ' DEFAULT: "%(default)s"'),
                      default='root')
 
-    return vars(par.parse_args())
\ No newline at end of file
+    flt = subpar.add_parser('fleet',
+                            help=('Build, resume, show or scuttle every lab'
+                                  ' of a fleet manifest'))
+    flt.set_defaults(method='fleet')
+    flt.add_argument('fleet_action',
+                     choices=['build', 'resume', 'info', 'scuttle'],
+                     help='Action run on every lab of the fleet')
+    flt.add_argument('-m',
+                     '--manifest',
+                     metavar='',
+                     help='JSON manifest of the labs in the fleet',
+                     required=True)
+    flt.add_argument('--max-labs',
+                     metavar='',
+                     type=int,
+                     help=('Maximum number of labs worked on at once, the'
+                           ' workers are shared between them.'
+                           ' DEFAULT: %(default)s'),
+                     default=4)
+
+    return par, subpar
\ No newline at end of file
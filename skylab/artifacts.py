@@ -0,0 +1,146 @@
+# =============================================================================
+# Copyright [2013] [cloudnull]
+# License Information :
+# This software has no warranty, it is provided 'as is'. It is your
+# responsibility to validate the behavior of the routines and its accuracy
+# using the code provided. Consult the GNU General Public license for further
+# details (see GNU General Public License).
+# http://www.gnu.org/licenses/gpl.html
+# =============================================================================
+
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+
+import requests
+
+import skylab as sk
+
+
+COOKBOOK_REPO = 'https://github.com/rcbops/chef-cookbooks.git'
+
+# Add-on cookbooks, name and version, unpacked into the cookbooks directory.
+ADDON_COOKBOOKS = (('cron', '1.2.6'), ('chef-client', '3.0.6'))
+ADDON_URL = ('https://supermarket.chef.io/api/v1/cookbooks/%s/versions/%s'
+             '/download')
+
+# Files saved in the "debs" directory of the bundle and their sources.
+PACKAGES = {
+    'rabbitmq.asc': ('http://www.rabbitmq.com/'
+                     'rabbitmq-signing-key-public.asc'),
+    'rabbitmq.deb': ('http://www.rabbitmq.com/releases/rabbitmq-server/'
+                     'v3.1.5/rabbitmq-server_3.1.5-1_all.deb'),
+    'chef_server.deb': ('https://www.opscode.com/chef/download-server'
+                        '?p=ubuntu&pv=12.04&m=x86_64')
+}
+
+# Top level directory within the bundle.
+BUNDLE_ROOT = 'skylab-artifacts'
+
+
+def bundle_path(artifact_path, cookbook_version):
+    """Return the full path to the bundle of a cookbook version.
+
+    :param artifact_path: Directory that bundles are kept in.
+    :param cookbook_version: Version of the RCBOPS cookbooks.
+    :return: ``str``
+    """
+
+    return os.path.join(
+        os.path.expanduser(artifact_path),
+        '%s-%s.tar.gz' % (BUNDLE_ROOT, cookbook_version.replace('/', '_'))
+    )
+
+
+def _download(url, local_path):
+    resp = requests.get(url, stream=True, timeout=60)
+    resp.raise_for_status()
+    with open(local_path, 'wb') as local_file:
+        for chunk in resp.iter_content(chunk_size=65536):
+            local_file.write(chunk)
+
+
+def _no_git(info):
+    if '.git' not in info.name.split('/'):
+        return info
+
+
+def _cookbooks(cookbook_version, work_dir):
+    """Check out the cookbooks and unpack the add-on cookbooks."""
+
+    cookbook_dir = os.path.join(work_dir, 'chef-cookbooks')
+    subprocess.check_call(['git', 'clone', COOKBOOK_REPO, cookbook_dir])
+    for command in (['git', 'checkout', cookbook_version],
+                    ['git', 'submodule', 'init'],
+                    ['git', 'submodule', 'sync'],
+                    ['git', 'submodule', 'update']):
+        subprocess.check_call(command, cwd=cookbook_dir)
+
+    for name, version in ADDON_COOKBOOKS:
+        addon = os.path.join(work_dir, '%s.tar.gz' % name)
+        _download(url=ADDON_URL % (name, version), local_path=addon)
+        with tarfile.open(addon) as tar:
+            tar.extractall(os.path.join(cookbook_dir, 'cookbooks'))
+        os.remove(addon)
+
+    return cookbook_dir
+
+
+def prepare_bundle(artifact_path, cookbook_version, refresh=False):
+    """Return the artifact bundle of a cookbook version, building it once.
+
+    The bundle is a compressed tarball holding the RCBOPS cookbooks, with
+    the add-on cookbooks already unpacked, and the rabbitmq and chef-server
+    packages. A bundle which is already in the artifact path is reused, so
+    a bundle copied in by hand allows builds without upstream access.
+
+    :param artifact_path: Directory that bundles are kept in.
+    :param cookbook_version: Version of the RCBOPS cookbooks.
+    :param refresh: Build the bundle again even if it exists.
+    :return: ``str`` full path to the bundle.
+    """
+
+    bundle = bundle_path(
+        artifact_path=artifact_path, cookbook_version=cookbook_version
+    )
+    if os.path.isfile(bundle) and refresh is False:
+        return bundle
+
+    bundle_dir = os.path.dirname(bundle)
+    if not os.path.isdir(bundle_dir):
+        os.makedirs(bundle_dir)
+
+    print('Preparing the artifact bundle for cookbook version "%s"'
+          % cookbook_version)
+    work_dir = tempfile.mkdtemp(dir=bundle_dir)
+    try:
+        cookbook_dir = _cookbooks(
+            cookbook_version=cookbook_version, work_dir=work_dir
+        )
+        deb_dir = os.path.join(work_dir, 'debs')
+        os.mkdir(deb_dir)
+        for name, url in PACKAGES.items():
+            _download(url=url, local_path=os.path.join(deb_dir, name))
+
+        temp_bundle = os.path.join(work_dir, 'bundle.tar.gz')
+        with tarfile.open(temp_bundle, 'w:gz') as tar:
+            tar.add(
+                cookbook_dir,
+                arcname=os.path.join(BUNDLE_ROOT, 'chef-cookbooks'),
+                filter=_no_git
+            )
+            tar.add(deb_dir, arcname=os.path.join(BUNDLE_ROOT, 'debs'))
+
+        # Rename last so that an interrupted build never leaves a bundle.
+        os.rename(temp_bundle, bundle)
+    except (subprocess.CalledProcessError, requests.RequestException,
+            OSError, tarfile.TarError) as exc:
+        raise sk.DeploymentFailure(
+            'The artifact bundle could not be prepared: %s' % exc
+        )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return bundle
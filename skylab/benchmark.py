@@ -0,0 +1,848 @@
+# =============================================================================
+# Copyright [2013] [cloudnull]
+# License Information :
+# This software has no warranty, it is provided 'as is'. It is your
+# responsibility to validate the behavior of the routines and its accuracy
+# using the code provided. Consult the GNU General Public license for further
+# details (see GNU General Public License).
+# http://www.gnu.org/licenses/gpl.html
+# =============================================================================
+"""Measure the orchestration overhead of skylab without a cloud.
+
+A full build is run against an in-process fake Nova API and a fake SSH
+transport, both with configurable latency and error rates. The wall time of
+every build phase, API and SSH call counts, state DB opens, worker starts
+and the time spent sleeping in retry and poll loops are reported.
+
+    python -m skylab.benchmark --nodes 5 --api-latency .05 --ssh-latency .1
+"""
+
+import argparse
+import cProfile
+import json
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+import skylab as sk
+from skylab import arguments
+from skylab import build_fabric as bf
+from skylab import executable
+from skylab import metrics
+from skylab import quota
+from skylab import service_module as sm
+from skylab import utils as ut
+
+
+API_CALLS = (
+    'authenticate', 'flavors.list', 'images.list', 'networks.list',
+    'networks.create', 'networks.delete', 'limits.get', 'keypairs.findall',
+    'keypairs.create', 'servers.create', 'servers.list', 'servers.get',
+    'servers.delete', 'servers.create_image', 'images.get', 'images.delete'
+)
+
+SSH_CALLS = ('run', 'put', 'get')
+
+# Functions timed as build phases, owner and attribute name.
+PHASES = (
+    (executable.Runner, '_load_client'),
+    (sm, 'flavor_find'),
+    (quota.Planner, 'admit'),
+    (sm, 'skylab_network'),
+    (sm, 'image_find'),
+    (executable.Runner, '_build_nodes'),
+    (sm, 'wait_for_active'),
+    (sm, 'construct_skylab'),
+    (executable.Runner, 'resume_lab'),
+    (executable.Runner, 'fleet'),
+    (executable.Runner, 'scale_lab'),
+    (sm, 'scale_skylab'),
+    (sm, 'drain_computes'),
+    (executable.Runner, 'scuttle_lab'),
+    (sm, 'scuttle_servers'),
+    (executable.Runner, 'bake_image'),
+    (sm, 'bake_node'),
+    (sm, 'wait_for_image')
+)
+
+# Modules whose calls to time.sleep are timed, and the name used.
+SLEEPERS = ((sm, 'sleep.poll'), (ut, 'sleep.retry'))
+
+
+class Stats(object):
+    """Counters and timers shared with forked worker processes."""
+
+    def __init__(self, counters, timers):
+        self.counters = dict(
+            [(name, multiprocessing.Value('i', 0)) for name in counters]
+        )
+        self.timers = dict(
+            [(name, (multiprocessing.Value('i', 0),
+                     multiprocessing.Value('d', 0)))
+             for name in timers]
+        )
+
+    def count(self, name):
+        value = self.counters[name]
+        with value.get_lock():
+            value.value += 1
+
+    def timing(self, name, seconds):
+        calls, total = self.timers[name]
+        with calls.get_lock():
+            calls.value += 1
+        with total.get_lock():
+            total.value += seconds
+
+    def report(self):
+        return {
+            'counters': dict([(name, value.value)
+                              for name, value in self.counters.items()]),
+            'phases': dict([(name, {'calls': calls.value,
+                                    'seconds': round(total.value, 3)})
+                            for name, (calls, total) in self.timers.items()])
+        }
+
+
+def guest_name(name):
+    """Return the host name Nova gives the guest of a server.
+
+    :param name: Name of the server.
+    :return: ``str``
+    """
+
+    host = re.sub(r'[ _]', '-', name)
+    host = re.sub(r'[^\w.-]+', '', host)
+    return host.lower().strip('.-')[:63]
+
+
+class FakeApiError(Exception):
+    """API failure injected by the fake Nova, retryable by default."""
+
+    code = 503
+
+
+class FakeResource(object):
+    def __init__(self, **info):
+        self._info = info
+        self.__dict__.update(info)
+
+
+class _Manager(object):
+    """Namespace for the fake methods of a Nova client manager."""
+
+    def __init__(self, **methods):
+        self.__dict__.update(methods)
+
+
+class FakeNova(object):
+    """In-process fake of the parts of the Nova client used by skylab.
+
+    Servers go ACTIVE, or ERROR at the boot error rate, once the boot time
+    has passed. Every call sleeps for the API latency and, apart from
+    authentication, fails with a retryable error at the API error rate.
+    """
+
+    def __init__(self, stats, region, latency=0, error_rate=0, boot_time=0,
+                 boot_error_rate=0, seed=None, images=None):
+        self.stats = stats
+        self.latency = latency
+        self.error_rate = error_rate
+        self.boot_time = boot_time
+        self.boot_error_rate = boot_error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self._servers = {}
+        self._networks = {}
+        self._count = 0
+        if images is None:
+            images = []
+        if not images:
+            images.extend(
+                [{'id': 'image-%d' % num, 'name': name, 'metadata': {}}
+                 for num, name in enumerate(
+                     ['Ubuntu 12.04 LTS (Precise Pangolin)',
+                      'Ubuntu 13.10 (Saucy Salamander)',
+                      'CentOS 6.5'])]
+            )
+        self._images = images
+
+        self.client = FakeResource(
+            tenant_id='benchmark',
+            region_name=region,
+            management_url='https://%s.benchmark.invalid/v2' % region
+        )
+        self.flavors = _Manager(list=self._flavor_list)
+        self.images = _Manager(
+            list=self._image_list,
+            get=self._image_get,
+            delete=self._image_delete
+        )
+        self.limits = _Manager(get=self._limits_get)
+        self.networks = _Manager(
+            _list=self._network_list,
+            _create=self._network_create,
+            _delete=self._network_delete
+        )
+        self.keypairs = _Manager(
+            findall=self._key_findall, create=self._key_create
+        )
+        self.servers = _Manager(
+            create=self._server_create,
+            list=self._server_list,
+            get=self._server_get,
+            delete=self._server_delete,
+            create_image=self._server_create_image
+        )
+
+    def _call(self, name, fail=True):
+        self.stats.count('nova.%s' % name)
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            failed = fail and self.random.random() < self.error_rate
+        if failed:
+            self.stats.count('nova.errors')
+            raise FakeApiError('Injected failure of "%s"' % name)
+
+    def authenticate(self):
+        # Authentication is not retried by skylab, never fail it.
+        self._call('authenticate', fail=False)
+
+    def _flavor_list(self):
+        self._call('flavors.list')
+        return [FakeResource(id=str(ram),
+                             name='%sMB Standard Instance' % ram,
+                             ram=ram,
+                             vcpus=max(1, ram // 1024),
+                             rxtx_factor=1.0)
+                for ram in (512, 1024, 2048, 4096, 8192)]
+
+    def _image_list(self):
+        self._call('images.list')
+        with self.lock:
+            return [FakeResource(status='ACTIVE', **image)
+                    for image in self._images]
+
+    def _image_get(self, image_id):
+        self._call('images.get')
+        with self.lock:
+            for image in self._images:
+                if image['id'] == image_id:
+                    return FakeResource(status='ACTIVE', **image)
+        exc = FakeApiError('Image "%s" not found' % image_id)
+        exc.code = 404
+        raise exc
+
+    def _image_delete(self, image_id):
+        self._call('images.delete')
+        with self.lock:
+            self._images[:] = [image for image in self._images
+                               if image['id'] != image_id]
+
+    def _limits_get(self, tenant_id):
+        self._call('limits.get')
+        return FakeResource(absolute={
+            'maxTotalPrivateNetworks': 10,
+            'totalPrivateNetworksUsed': len(self._networks),
+            'maxTotalRAMSize': 1048576,
+            'totalRAMUsed': 0,
+            'maxTotalInstances': -1,
+            'totalInstancesUsed': len(self._servers),
+            'maxTotalCores': -1,
+            'totalCoresUsed': 0
+        })
+
+    def _network_list(self, url, response_key):
+        self._call('networks.list')
+        with self.lock:
+            return list(self._networks.values())
+
+    def _network_create(self, url, body, response_key):
+        self._call('networks.create')
+        with self.lock:
+            net = FakeResource(
+                id='network-%d' % len(self._networks),
+                label=body['network']['label']
+            )
+            self._networks[net.id] = net
+        return net
+
+    def _network_delete(self, url):
+        self._call('networks.delete')
+        with self.lock:
+            if self._networks.pop(url.rsplit('/', 1)[-1], None) is None:
+                exc = FakeApiError('Network "%s" not found' % url)
+                exc.code = 404
+                raise exc
+
+    def _key_findall(self, name):
+        self._call('keypairs.findall')
+        return [FakeResource(name=name)]
+
+    def _key_create(self, name, public_key):
+        self._call('keypairs.create')
+
+    def _live(self, record):
+        """Return True until a deleted server has had its boot time to go."""
+
+        return record.get('gone') is None or time.time() < record['gone']
+
+    def _server(self, record):
+        """Return a server object with the status at this point in time."""
+
+        info = dict(record['info'])
+        if time.time() < record['ready']:
+            info['status'] = 'BUILD'
+            info['addresses'] = {}
+        elif record['error'] is True:
+            info['status'] = 'ERROR'
+        else:
+            info['status'] = 'ACTIVE'
+        return FakeResource(**info)
+
+    def _server_create(self, name, nics=None, min_count=None, max_count=None,
+                       **kwargs):
+        self._call('servers.create')
+        count = max_count or 1
+        records = []
+        with self.lock:
+            for index in range(count):
+                self._count += 1
+                num = self._count
+                addresses = {
+                    'public': [{'version': 4,
+                                'addr': '10.0.%d.%d' % divmod(num, 250)}]
+                }
+                for nic in nics or []:
+                    net = self._networks.get(nic['net-id'])
+                    if net is not None:
+                        addresses[net.label] = [
+                            {'version': 4,
+                             'addr': '172.16.%d.%d' % divmod(num, 250)}
+                        ]
+
+                # Nova names the servers of a multi-create "<name>-<N>".
+                if count > 1:
+                    server_name = '%s-%d' % (name, index + 1)
+                else:
+                    server_name = name
+
+                records.append({
+                    'info': {'id': 'server-%d' % num,
+                             'name': server_name,
+                             'addresses': addresses},
+                    'ready': time.time() + self.boot_time,
+                    'error': self.random.random() < self.boot_error_rate
+                })
+                self._servers['server-%d' % num] = records[-1]
+            return self._server(record=records[0])
+
+    def _server_list(self, search_opts=None):
+        self._call('servers.list')
+        prefix = (search_opts or {}).get('name', '')
+        with self.lock:
+            return [self._server(record=record)
+                    for record in self._servers.values()
+                    if record['info']['name'].startswith(prefix) and
+                    self._live(record=record)]
+
+    def guests(self):
+        """Return the public address and host name of every live server.
+
+        Guests are named as Nova names them, after a sanitised form of the
+        name of their server, in the "novalocal" domain.
+        """
+
+        with self.lock:
+            return dict([
+                (record['info']['addresses']['public'][0]['addr'],
+                 guest_name(name=record['info']['name']))
+                for record in self._servers.values()
+                if self._live(record=record)
+            ])
+
+    def _server_get(self, server_id):
+        self._call('servers.get')
+        with self.lock:
+            return self._server(record=self._servers[server_id])
+
+    def _server_create_image(self, server_id, image_name, metadata=None):
+        self._call('servers.create_image')
+        with self.lock:
+            image_id = 'image-%d' % (len(self._images) + 100)
+            self._images.append(
+                {'id': image_id, 'name': image_name, 'metadata': metadata}
+            )
+        return image_id
+
+    def _server_delete(self, server_id):
+        self._call('servers.delete')
+        with self.lock:
+            record = self._servers.get(server_id)
+            if record is None or not self._live(record=record):
+                exc = FakeApiError('Server "%s" not found' % server_id)
+                exc.code = 404
+                raise exc
+            elif record.get('gone') is None:
+                record['gone'] = time.time() + self.boot_time
+
+
+class _FakeResult(str):
+    failed = False
+    return_code = 0
+
+
+class _Sleeper(object):
+    """Stand-in for the time module of another module, timing sleeps."""
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(time, attr)
+
+    def sleep(self, seconds):
+        start = time.time()
+        time.sleep(seconds)
+        self.stats.timing(self.name, time.time() - start)
+
+
+class Benchmark(object):
+    """Patch skylab onto the fakes, run a build and collect its stats."""
+
+    def __init__(self, opts):
+        """Setup the benchmark.
+
+        :param opts: ``dict`` parsed benchmark arguments.
+        """
+
+        self.opts = opts
+        self.stats = Stats(
+            counters=(['nova.%s' % name for name in API_CALLS] +
+                      ['ssh.%s' % name for name in SSH_CALLS] +
+                      ['nova.errors', 'ssh.errors', 'db.open',
+                       'process.start', 'thread.start']),
+            timers=([name for _, name in PHASES] +
+                    [name for _, name in SLEEPERS])
+        )
+        self.patches = []
+        self.images = []
+        self.clouds = {}
+        self.scripts = {}
+
+    def _patch(self, owner, attr, value):
+        self.patches.append((owner, attr, owner.__dict__[attr]))
+        setattr(owner, attr, value)
+
+    def _unpatch(self):
+        while self.patches:
+            owner, attr, value = self.patches.pop()
+            setattr(owner, attr, value)
+
+    def _timed(self, name, func):
+        stats = self.stats
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.timing(name, time.time() - start)
+        return timed
+
+    def _counted(self, name, func):
+        stats = self.stats
+
+        def counted(*args, **kwargs):
+            stats.count(name)
+            return func(*args, **kwargs)
+        return counted
+
+    def _load_client(self, runner):
+        """Replace Runner._load_client, using the fake Nova.
+
+        Runners in the same region share one fake Nova, so that a later
+        command of the benchmark sees the servers of the build.
+        """
+
+        if runner.client is not None:
+            return
+
+        region = runner.args['region']
+        if region in self.clouds:
+            runner.client = self.clouds[region]
+            runner.client.authenticate()
+            return
+
+        runner.client = self.clouds[region] = FakeNova(
+            stats=self.stats,
+            region=region,
+            latency=self.opts['api_latency'],
+            error_rate=self.opts['api_error_rate'],
+            boot_time=self.opts['boot_time'],
+            boot_error_rate=self.opts['boot_error_rate'],
+            seed=self.opts['seed'],
+            images=self.images
+        )
+        runner.client.authenticate()
+
+    def _run_action(self, engine, action_dict, target, name=None):
+        """Replace Engine.run_action, using a fake SSH transport."""
+
+        method = action_dict['method']
+        self.stats.count('ssh.%s' % method)
+        if self.opts['ssh_latency']:
+            time.sleep(self.opts['ssh_latency'])
+
+        # Seed by task so forked lanes do not share one random sequence.
+        rand = random.Random('%s%s%s' % (self.opts['seed'], target, name))
+        if rand.random() < self.opts['ssh_error_rate']:
+            self.stats.count('ssh.errors')
+            raise bf.InstallationFailed(
+                'Injected failure of "%s" on "%s"' % (name, target),
+                return_code=1
+            )
+
+        if method == 'run' and 'hostname -f' in action_dict['command']:
+            host = self.clouds[engine.args['region']].guests()[target]
+            return _FakeResult('%s\n%s.novalocal' % (host, host))
+        elif method == 'run':
+            error = self._drain_error(
+                region=engine.args['region'], script=action_dict['command']
+            )
+            if error is not None:
+                raise bf.InstallationFailed(error, return_code=1)
+
+        if method == 'get':
+            with open(action_dict['local_path'], 'wb') as local_file:
+                local_file.write('%s from %s' % (name, target))
+        elif method == 'put' and hasattr(action_dict['local_path'], 'read'):
+            self.scripts[(target, action_dict['remote_path'])] = (
+                action_dict['local_path'].getvalue()
+            )
+        elif method == 'run' and action_dict['command'].startswith('bash '):
+            self._run_batch(
+                script=self.scripts.pop(
+                    (target, action_dict['command'].split()[1])
+                ),
+                target=target,
+                region=engine.args['region'],
+                stream=action_dict['stdout']
+            )
+        return _FakeResult('')
+
+    def _drain_error(self, region, script):
+        """Return why a drain script fails on the fake cloud, if it does.
+
+        The nova-compute host of a node is the host name of its guest, a
+        drain of any other host fails as it would on the controller.
+        """
+
+        match = re.search(r'^COMPUTE_HOST="(.*)"$', script, re.M)
+        if match is None:
+            return None
+        elif match.group(1) not in self.clouds[region].guests().values():
+            self.stats.count('ssh.errors')
+            return ('nova-compute was not found on host %s'
+                    % match.group(1))
+
+    def _run_batch(self, script, target, region, stream):
+        """Write the markers of an uploaded batch script to its stream.
+
+        Every step fails at the SSH error rate, or when it drains a host
+        which does not exist, and the steps which require a failed step are
+        skipped, as the real script would.
+        """
+
+        token = re.search(r'SKYLAB-BATCH (\w+)', script).group(1)
+        codes = {}
+        body = []
+        for line in script.replace(token, '').splitlines():
+            match = re.match(r'skylab_step (\d+)((?: \d+)*)$', line)
+            if match is None:
+                body.append(line)
+                continue
+
+            index = match.group(1)
+            step_body, body = '\n'.join(body), []
+            if [req for req in match.group(2).split() if codes.get(req)]:
+                stream.write('SKYLAB-BATCH %s %s skip\n' % (token, index))
+                codes[index] = 'skip'
+                continue
+
+            # Seed by step so forked lanes do not share one random sequence.
+            rand = random.Random(
+                '%s%s%s' % (self.opts['seed'], target, step_body)
+            )
+            codes[index] = 0
+            if rand.random() < self.opts['ssh_error_rate']:
+                self.stats.count('ssh.errors')
+                codes[index] = 1
+            elif self._drain_error(region=region, script=step_body):
+                codes[index] = 1
+            stream.write('SKYLAB-BATCH %s %s start\n' % (token, index))
+            stream.write('SKYLAB-BATCH %s %s exit %s\n'
+                         % (token, index, codes[index]))
+
+    def _install(self):
+        bench = self
+
+        self._patch(
+            executable.Runner,
+            '_load_client',
+            lambda runner: bench._load_client(runner=runner)
+        )
+        self._patch(
+            bf.Engine,
+            'run_action',
+            lambda engine, action_dict, target, name=None: bench._run_action(
+                engine, action_dict=action_dict, target=target, name=name
+            )
+        )
+        for owner, attr in PHASES:
+            self._patch(
+                owner, attr, self._timed(attr, owner.__dict__[attr])
+            )
+        for module, name in SLEEPERS:
+            self._patch(module, 'time', _Sleeper(stats=self.stats, name=name))
+
+        for owner, attr, name in ((sk.Database, '__enter__', 'db.open'),
+                                  (multiprocessing.Process, 'start',
+                                   'process.start'),
+                                  (threading.Thread, 'start', 'thread.start')):
+            self._patch(
+                owner, attr, self._counted(name, owner.__dict__[attr])
+            )
+
+    def _args(self, work_dir, command):
+        argv = ['--debug',
+                '--workers', str(self.opts['workers']),
+                '--db-path', work_dir,
+                '--log-path', '',
+                '-U', 'benchmark',
+                '-A', 'benchmark',
+                '-R', self.opts['regions']]
+        if self.opts.get('batch_steps') is True:
+            argv.append('--batch-steps')
+        args = arguments.args(argv=argv + command)
+
+        # Nodes are only visible to the fake Nova of their own process.
+        args['executor'] = 'thread'
+        args['db_path'] = sk.dbm_create(
+            db_path=args['db_path'],
+            db_name=args['db_name']
+        )
+        return args
+
+    def run(self):
+        """Run the build, with the bake, scale, resume and scuttle if asked.
+
+        :return: ``dict`` report of the run.
+        """
+
+        work_dir = tempfile.mkdtemp(prefix='skylab-benchmark-')
+        profile = None
+        if self.opts.get('profile'):
+            profile = cProfile.Profile()
+
+        error = None
+        metrics.configure()
+        self._install()
+        start = time.time()
+        try:
+            if self.opts.get('labs', 1) > 1:
+                manifest = os.path.join(work_dir, 'fleet.json')
+                defaults = {'node_count': self.opts['nodes'],
+                            'no_artifacts': True}
+                if self.opts.get('baked') is True:
+                    defaults['image'] = 'skylab-baked'
+                with open(manifest, 'wb') as mfile:
+                    json.dump(
+                        {'defaults': defaults,
+                         'labs': dict([('bench%d' % (num + 1), {})
+                                       for num in range(self.opts['labs'])])},
+                        mfile
+                    )
+                commands = dict([
+                    (action, ['fleet', action, '--manifest', manifest])
+                    for action in ('build', 'resume', 'scuttle')
+                ])
+            else:
+                build = ['build-lab',
+                         '--name', 'bench',
+                         '--no-artifacts',
+                         '--node-count', str(self.opts['nodes'])]
+                if self.opts.get('baked') is True:
+                    build.extend(['--image', 'skylab-baked'])
+                commands = {'build': build,
+                            'scale': ['scale-lab',
+                                      '--name', 'bench',
+                                      '--computes', str(self.opts['scale'])],
+                            'resume': ['resume-lab', '--name', 'bench'],
+                            'scuttle': ['scuttle-lab', '--name', 'bench']}
+            if profile is not None:
+                profile.enable()
+            try:
+                if self.opts.get('baked') is True:
+                    bake_args = self._args(
+                        work_dir=work_dir,
+                        command=['bake-image', '--no-artifacts']
+                    )
+                    executable.Runner(args=bake_args).bake_image()
+
+                for action in ('build', 'scale', 'resume', 'scuttle'):
+                    if action == 'build' or self.opts.get(action):
+                        args = self._args(
+                            work_dir=work_dir, command=commands[action]
+                        )
+                        executable.Runner(args=args).run_method()
+            finally:
+                if profile is not None:
+                    profile.disable()
+        except (Exception, SystemExit) as exc:
+            error = '%s: %s' % (type(exc).__name__, exc)
+        finally:
+            wall_time = time.time() - start
+            self._unpatch()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        if profile is not None:
+            profile.dump_stats(self.opts['profile'])
+
+        report = self.stats.report()
+        report['metrics'] = metrics.export(args={'method': 'benchmark'})
+        report['wall_time'] = round(wall_time, 3)
+        report['error'] = error
+        report['options'] = self.opts
+        return report
+
+
+def print_report(report):
+    """Print a benchmark report as tables."""
+
+    sk.print_horiz_table(
+        [{'phase': name, 'calls': phase['calls'], 'seconds': phase['seconds']}
+         for name, phase in sorted(report['phases'].items())
+         if phase['calls']]
+    )
+    sk.print_horiz_table(
+        [{'counter': name, 'count': count}
+         for name, count in sorted(report['counters'].items())
+         if count]
+    )
+    print('Wall time: %ss' % report['wall_time'])
+    if report['error'] is not None:
+        print('The build FAILED: %s' % report['error'])
+
+
+def args(argv=None):
+    """Parse the benchmark arguments.
+
+    :param argv: ``list`` of arguments, sys.argv is used if not set.
+    """
+
+    par = argparse.ArgumentParser(
+        description='Benchmark skylab against a fake cloud.'
+    )
+    par.add_argument('--nodes',
+                     type=int,
+                     help='Number of nodes in the lab, DEFAULT: %(default)s',
+                     default=3)
+    par.add_argument('--labs',
+                     type=int,
+                     help=('Number of labs, built as a fleet when more than'
+                           ' one, DEFAULT: %(default)s'),
+                     default=1)
+    par.add_argument('--regions',
+                     help=('Regions to build in, use commas to separate'
+                           ' regions, DEFAULT: %(default)s'),
+                     default='BENCH')
+    par.add_argument('--workers',
+                     type=int,
+                     help='Number of concurrent workers, DEFAULT: %(default)s',
+                     default=10)
+    par.add_argument('--api-latency',
+                     type=float,
+                     help='Seconds added to every API call, DEFAULT: 0',
+                     default=0)
+    par.add_argument('--api-error-rate',
+                     type=float,
+                     help='Fraction of API calls that fail, DEFAULT: 0',
+                     default=0)
+    par.add_argument('--boot-time',
+                     type=float,
+                     help='Seconds a server takes to boot, DEFAULT: 0',
+                     default=0)
+    par.add_argument('--boot-error-rate',
+                     type=float,
+                     help='Fraction of servers that go into ERROR, DEFAULT: 0',
+                     default=0)
+    par.add_argument('--ssh-latency',
+                     type=float,
+                     help='Seconds added to every SSH action, DEFAULT: 0',
+                     default=0)
+    par.add_argument('--ssh-error-rate',
+                     type=float,
+                     help='Fraction of SSH actions that fail, DEFAULT: 0',
+                     default=0)
+    par.add_argument('--baked',
+                     help='Bake an image first and build the lab from it',
+                     action='store_true',
+                     default=False)
+    par.add_argument('--scale',
+                     type=int,
+                     metavar='COMPUTES',
+                     help=('Scale the lab to a number of compute nodes once'
+                           ' it has been built'),
+                     default=None)
+    par.add_argument('--resume',
+                     help='Resume the lab once it has been built',
+                     action='store_true',
+                     default=False)
+    par.add_argument('--scuttle',
+                     help='Scuttle the lab once it has been built',
+                     action='store_true',
+                     default=False)
+    par.add_argument('--batch-steps',
+                     help='Run the steps of each node as batch scripts',
+                     action='store_true',
+                     default=False)
+    par.add_argument('--seed',
+                     type=int,
+                     help='Seed for the injected failures, DEFAULT: 0',
+                     default=0)
+    par.add_argument('--profile',
+                     metavar='FILE',
+                     help='Save cProfile stats of the run to a file',
+                     default=None)
+    par.add_argument('--json',
+                     metavar='FILE',
+                     help='Save the report as JSON to a file',
+                     default=None)
+    opts = vars(par.parse_args(argv))
+    if opts['scale'] is not None and opts['labs'] > 1:
+        par.error('--scale only works with a single lab')
+    return opts
+
+
+def main():
+    opts = args()
+    report = Benchmark(opts=opts).run()
+    print_report(report=report)
+    if opts['json'] is not None:
+        with open(opts['json'], 'wb') as json_file:
+            json.dump(report, json_file, indent=4)
+
+    if report['error'] is not None:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
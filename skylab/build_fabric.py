@@ -9,13 +9,23 @@
 # =============================================================================
 
 import StringIO
+import base64
+import collections
 import os
+import pipes
+import re
+import sys
 import tempfile
+import time
+import uuid
 
 import skylab as sk
+from skylab import metrics
 from skylab import utils as ut
 
 import fabric.api as api
+from fabric import network
+from fabric import state
 
 
 # Colorize Errors if they happen
@@ -23,7 +33,304 @@ api.env.colorize_errors = True
 
 
 class InstallationFailed(Exception):
-    pass
+    def __init__(self, message, return_code=None, output=None):
+        super(InstallationFailed, self).__init__(message)
+        self.return_code = return_code
+        self.output = output
+
+
+# Outcome of a fanned out step on a single host.
+HostResult = collections.namedtuple(
+    'HostResult', 'host return_code duration output error'
+)
+
+# Engine methods of the steps which can be joined into a batch script.
+BATCH_METHODS = ('run', 'put')
+
+# Error reported for a batched step whose required step failed in the batch.
+BATCH_SKIPPED = 'A step it requires failed earlier in the batch'
+
+# Runs one step of a batch script between markers carrying its exit code.
+BATCH_HEADER = """#!/bin/bash
+skylab_step() {
+    # skylab_step INDEX [REQUIRED INDEX ...]
+    local index=$1 req code
+    shift
+    for req in "$@"; do
+        if [ "$(eval echo \\$SKYLAB_RC_${req})" != "0" ];then
+            echo "SKYLAB-BATCH %(token)s ${index} skip"
+            return
+        fi
+    done
+    echo "SKYLAB-BATCH %(token)s ${index} start"
+    skylab_step_${index} < /dev/null
+    code=$?
+    eval SKYLAB_RC_${index}=${code}
+    echo "SKYLAB-BATCH %(token)s ${index} exit ${code}"
+}
+"""
+
+BATCH_STEP = """
+skylab_step_%(index)d() (
+set -e
+%(command)s
+)
+skylab_step %(index)d%(requires)s
+"""
+
+
+def render_commands(template, contexts):
+    """Render a template once per host for use with Engine.fan_out.
+
+    :param template: ``str`` with "%(key)s" style substitutions.
+    :param contexts: ``dict`` of hosts and the values rendered for each.
+    :return: ``dict`` of hosts and their rendered payload.
+    """
+
+    return dict([(host, template % ctx) for host, ctx in contexts.items()])
+
+
+def batch_script(token, steps):
+    """Return the script which runs a batch of steps, see Engine.run_batch.
+
+    :param token: Unique token of the batch used in its markers.
+    :param steps: ``list`` of ``dict`` steps of the batch.
+    :return: ``str``
+    """
+
+    script = [BATCH_HEADER % {'token': token}]
+    for index, step in enumerate(steps):
+        if step['method'] == 'put':
+            # Contents are sent encoded so that they land byte for byte.
+            command = "printf '%%s' '%s' | base64 -d > %s" % (
+                base64.b64encode(step['string_obj']),
+                pipes.quote(step['remote_path'])
+            )
+        else:
+            command = step['string_obj']
+
+        script.append(
+            BATCH_STEP % {'index': index,
+                          'command': command,
+                          'requires': ''.join(
+                              [' %d' % req for req in step['requires']])}
+        )
+    script.append('rm -f "$0"\n')
+    return ''.join(script)
+
+
+def _fan_out_job(engine, name, method, commands, remote_path, target):
+    """Run the payload of a single host and return its HostResult."""
+
+    kwargs = {'name': name, 'string_obj': commands[target], 'target': target}
+    if method in ('put', 'put_file'):
+        kwargs['remote_path'] = remote_path
+
+    start = time.time()
+    try:
+        result = getattr(engine, method)(**kwargs)
+    except InstallationFailed as exc:
+        return HostResult(
+            target, exc.return_code, time.time() - start, exc.output, str(exc)
+        )
+    except (Exception, SystemExit) as exc:
+        # Fabric aborts with SystemExit, IE when a host can not be reached.
+        return HostResult(target, None, time.time() - start, None, str(exc))
+    else:
+        return HostResult(
+            target,
+            getattr(result, 'return_code', 0),
+            time.time() - start,
+            str(result) if result is not None else None,
+            None
+        )
+    finally:
+        engine.disconnect()
+
+
+class NodeStream(object):
+    """File like object which tags each line of output with host and step.
+
+    Lines are appended to the log file of the host, echoed to the console in
+    debug mode and the last few are kept for error reports.
+    """
+
+    def __init__(self, host, step, log_file=None, echo=False, tail=20):
+        """Open the stream.
+
+        :param host: Host the output comes from.
+        :param step: Name of the step producing the output.
+        :param log_file: Full path to the log file for the host.
+        :param echo: Write tagged lines to stdout.
+        :param tail: Number of lines kept for error reports.
+        """
+
+        self.prefix = '[%s][%s] ' % (host, step)
+        self.echo = echo
+        self.buffer = ''
+        self.tail = collections.deque(maxlen=tail)
+        self.log = None
+        if log_file is not None:
+            self.log = open(log_file, 'ab')
+
+    def _line(self, line):
+        line = line.rstrip('\r')
+        self.tail.append(line)
+        tagged = '%s%s\n' % (self.prefix, line)
+        if self.log is not None:
+            self.log.write(tagged)
+        if self.echo is True:
+            sys.stdout.write(tagged)
+
+    def write(self, data):
+        self.buffer += data
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            self._line(line=line)
+
+    def flush(self):
+        if self.log is not None:
+            self.log.flush()
+
+    def close(self):
+        if self.buffer:
+            self._line(line=self.buffer)
+            self.buffer = ''
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+class BatchStream(NodeStream):
+    """NodeStream for the output of a batch script, see Engine.run_batch.
+
+    The markers written by the script are not logged. They switch the step
+    that output lines are tagged with and report the outcome of every step
+    as soon as it is known.
+    """
+
+    def __init__(self, host, token, steps, report, log_file=None,
+                 echo=False, tail=20):
+        """Open the stream.
+
+        :param host: Host the output comes from.
+        :param token: Unique token of the batch used in its markers.
+        :param steps: ``list`` of ``dict`` steps of the batch.
+        :param report: Called with the index of a step and its error, which
+                       is None when the step completed.
+        :param log_file: Full path to the log file for the host.
+        :param echo: Write tagged lines to stdout.
+        :param tail: Number of lines kept for error reports.
+        """
+
+        super(BatchStream, self).__init__(
+            host=host, step='batch', log_file=log_file, echo=echo, tail=tail
+        )
+        self.host = host
+        self.steps = steps
+        self.report = report
+        self.started = {}
+        self.marker = re.compile(
+            r'SKYLAB-BATCH %s (\d+) (start|exit|skip)(?: (\d+))?' % token
+        )
+
+    def _line(self, line):
+        match = self.marker.search(line)
+        if match is None:
+            return super(BatchStream, self)._line(line=line)
+        elif match.start():
+            # Output of the step which did not end with a new line.
+            super(BatchStream, self)._line(line=line[:match.start()])
+
+        index = int(match.group(1))
+        title = self.steps[index]['title']
+        event = match.group(2)
+        if event == 'start':
+            self.prefix = '[%s][%s] ' % (self.host, title)
+            self.tail.clear()
+            self.started[index] = time.time()
+            print('[%s] %s - Started' % (self.host, title))
+        elif event == 'skip':
+            print('[%s] %s - Skipped, %s'
+                  % (self.host, title, BATCH_SKIPPED.lower()))
+            self.report(index, BATCH_SKIPPED)
+        else:
+            code = int(match.group(3))
+            duration = time.time() - self.started.get(index, time.time())
+            if code == 0:
+                print('[%s] %s - Done in %.1fs' % (self.host, title, duration))
+                self.report(index, None)
+            else:
+                print('[%s] %s - FAILED, return code "%s" after %.1fs'
+                      % (self.host, title, code, duration))
+                self.report(
+                    index,
+                    '"%s" failed on "%s" with return code "%s". %s'
+                    % (title, self.host, code, '\n'.join(self.tail))
+                )
+
+
+class ConnectionPool(object):
+    """Bounded pool of persistent SSH connections.
+
+    Connections are stored in the Fabric connection cache so that every
+    Fabric operation made against a pooled host reuses the same session. When
+    the pool is full the least recently used connection is closed.
+    """
+
+    def __init__(self, max_size=10, keepalive=10):
+        """Setup the pool.
+
+        :param max_size: Maximum number of open connections.
+        :param keepalive: Seconds between SSH keepalive packets.
+        """
+
+        self.max_size = max_size
+        self.keepalive = keepalive
+        self.hosts = collections.OrderedDict()
+
+    def _active(self, key):
+        transport = self.hosts[key].get_transport()
+        return transport is not None and transport.is_active()
+
+    def _close(self, key):
+        conn = self.hosts.pop(key)
+        conn.close()
+        if key in state.connections:
+            del state.connections[key]
+
+    def acquire(self, host_string):
+        """Return an open connection for a host, connecting if needed.
+
+        This has to be called within the Fabric settings for the host so
+        that new connections are made with the right user, port and key.
+
+        :param host_string: Fabric host string.
+        :return: Open connection.
+        """
+
+        key = network.normalize_to_string(host_string)
+        if key in self.hosts:
+            if self._active(key):
+                # Move the connection to the end, marking it recently used.
+                self.hosts[key] = self.hosts.pop(key)
+                return self.hosts[key]
+            else:
+                self._close(key)
+
+        while len(self.hosts) >= self.max_size:
+            self._close(key=next(iter(self.hosts)))
+
+        # The Fabric connection cache will connect if the key is missing.
+        conn = self.hosts[key] = state.connections[key]
+        conn.get_transport().set_keepalive(self.keepalive)
+        return conn
+
+    def close_all(self):
+        """Close every connection in the pool."""
+
+        for key in list(self.hosts.keys()):
+            self._close(key=key)
 
 
 class Engine(object):
@@ -31,6 +338,11 @@ class Engine(object):
 
     def __init__(self, args):
         self.args = args
+        self.settings = self._fab_settings()
+        self.pool = ConnectionPool(
+            max_size=self.args.get('ssh_pool_size') or 10,
+            keepalive=self.settings['keepalive']
+        )
 
     def _fab_settings(self):
         """Return a general purpose settings dict."""
@@ -42,13 +354,58 @@ class Engine(object):
             'combine_stderr': True,
             'connection_attempts': 10,
             'disable_known_hosts': True,
+            'output_prefix': False,
             'key_filename': self.args.get('key_path'),
             'user': self.args.get('ssh_user'),
             'port': self.args.get('ssh_port'),
         }
 
-    def run_action(self, action_dict, target):
-        env_settings = self._fab_settings()
+    def disconnect(self):
+        """Close all pooled connections."""
+
+        self.pool.close_all()
+
+    def _log_file(self, target):
+        """Return the full path to the log file of a host, if logging."""
+
+        log_file = None
+        if self.args.get('log_path'):
+            log_dir = os.path.join(
+                os.path.expanduser(self.args['log_path']), self.args['name']
+            )
+            if not os.path.isdir(log_dir):
+                try:
+                    os.makedirs(log_dir)
+                except OSError:
+                    # Another lane may have made the directory first.
+                    pass
+            log_file = os.path.join(log_dir, '%s.log' % target)
+        return log_file
+
+    def _stream(self, name, target):
+        """Return a NodeStream for the output of a step on a host."""
+
+        return NodeStream(
+            host=target,
+            step=name,
+            log_file=self._log_file(target=target),
+            echo=self.args.get('debug') is True
+        )
+
+    def run_action(self, action_dict, target, name=None):
+        """Run a Fabric action against a target.
+
+        Output of "run" actions is streamed line by line, tagged with the
+        host and step, into the per node log file. An action which fails
+        raises InstallationFailed as soon as it returns.
+
+        :param action_dict: ``dict`` Fabric method and its arguments.
+        :param target: Host, or list of hosts, to run the action on.
+        :param name: Name of the step used for output and logs.
+        :return: Result of the Fabric method.
+        """
+
+        env_settings = self.settings.copy()
         if isinstance(target, list):
             api.env.hosts = target
         else:
@@ -59,36 +416,65 @@ class Engine(object):
         if self.args.get('debug') is True:
             hide = api.hide()
         else:
-            hide = api.hide('running', 'stdout', 'output', 'warnings')
+            hide = api.hide('running', 'warnings')
 
         ad = action_dict.copy()
         method = ad.pop('method')
+        span = metrics.span('step', step=name, host=target, method=method)
+
+        stream = None
+        if method == 'run':
+            stream = ad.get('stdout')
+            if stream is None:
+                stream = ad['stdout'] = self._stream(name=name, target=target)
 
         # grab the api method from fabric
         method = getattr(api, method)
 
         # Run all the things
-        with hide, settings:
-            result = method(**ad)
-
-        if hasattr(result, 'return_code'):
-            # Check for Failures.
-            code = result.return_code
-            # TODO(kevin) Make this do something smart
-            if code != 0:
-                pass
-        else:
-            return result
+        start = time.time()
+        print('[%s] %s - Started' % (target, name))
+        with span:
+            try:
+                with hide, settings:
+                    if 'host_string' in env_settings:
+                        self.pool.acquire(
+                            host_string=env_settings['host_string']
+                        )
+                    result = method(**ad)
+            finally:
+                if stream is not None:
+                    stream.close()
+
+            duration = time.time() - start
+            if getattr(result, 'failed', False):
+                # Check for Failures.
+                code = getattr(result, 'return_code', None)
+                print('[%s] %s - FAILED, return code "%s" after %.1fs'
+                      % (target, name, code, duration))
+                last_lines = ''
+                if stream is not None:
+                    last_lines = '\n'.join(stream.tail)
+                raise InstallationFailed(
+                    '"%s" failed on "%s" with return code "%s". %s'
+                    % (name, target, code, last_lines),
+                    return_code=code,
+                    output=last_lines
+                )
+            else:
+                print('[%s] %s - Done in %.1fs' % (target, name, duration))
+                return result
 
     def get(self, name, string_obj, target):
         ad = {'method': 'get'}
-        print('Grabbing [%s]' % name)
         ad['remote_path'] = string_obj
         temp_file = ad['local_path'] = tempfile.mktemp()
-        self.run_action(action_dict=ad, target=target)
+        self.run_action(action_dict=ad, target=target, name=name)
         with open(temp_file, 'rb') as tf:
-            with sk.Shelve(file_path=self.args['db_path']) as db:
-                get_obj = db[self.args['db_name']][name] = tf.read()
+            get_obj = tf.read()
+        metrics.incr('ssh.bytes_received', len(get_obj))
+        with sk.Database(file_path=self.args['db_path']) as db:
+            db.set_values(lab=self.args['name'], values={name: get_obj})
         try:
             os.remove(temp_file)
         except OSError:
@@ -96,35 +482,118 @@ class Engine(object):
         finally:
             return get_obj
 
-    def parallel_put(self, name, string_obj, remote_path, target):
-        proc_args = {'name': name,
-                     'string_obj': string_obj,
-                     'target': target,
+    def fan_out(self, name, commands, method='run', remote_path=None):
+        """Run one step across many hosts, each with its own payload.
+
+        Hosts are worked on in parallel, bounded by the "workers" argument.
+        A host which fails does not stop the others, every host gets a
+        HostResult so that callers can act on partial failures.
+
+        :param name: Name of the step used for output and logs.
+        :param commands: ``dict`` of hosts and their rendered payload, a
+                         command for "run" or file contents for "put".
+        :param method: Engine method used for the step, run|put|put_file.
+        :param remote_path: Remote path used by "put" steps.
+        :return: ``dict`` of hosts and their HostResult.
+        """
+
+        proc_args = {'engine': self,
+                     'name': name,
+                     'method': method,
+                     'commands': commands,
                      'remote_path': remote_path,
-                     'queue': ut.basic_queue(iters=target),
-                     'job_action': self.run}
-        ut.worker_proc(
-            kwargs=proc_args
+                     'queue': ut.basic_queue(iters=sorted(commands)),
+                     'job_action': _fan_out_job}
+        # Fabric settings are process global, always use process workers.
+        jobs = ut.worker_proc(
+            kwargs=proc_args,
+            threads=self.args.get('workers') or 10,
+            backend='process'
+        )
+
+        results = {}
+        for job in jobs:
+            if job.error is not None:
+                results[job.target] = HostResult(
+                    job.target, None, None, None, str(job.error)
+                )
+            else:
+                results[job.target] = job.result
+        return results
+
+    def parallel_put(self, name, string_obj, remote_path, target):
+        return self.fan_out(
+            name=name,
+            commands=dict([(host, string_obj) for host in target]),
+            method='put',
+            remote_path=remote_path
         )
 
     def put(self, name, string_obj, remote_path, target):
         ad = {'method': 'put'}
-        print('Putting [%s]' % name)
         ad['local_path'] = StringIO.StringIO(string_obj)
         ad['remote_path'] = remote_path
-        self.run_action(action_dict=ad, target=target)
+        self.run_action(action_dict=ad, target=target, name=name)
+        metrics.incr('ssh.bytes_sent', len(string_obj))
+
+    def put_file(self, name, string_obj, remote_path, target):
+        """Upload a local file, string_obj is the full path to the file."""
+
+        ad = {'method': 'put'}
+        ad['local_path'] = string_obj
+        ad['remote_path'] = remote_path
+        self.run_action(action_dict=ad, target=target, name=name)
+        metrics.incr('ssh.bytes_sent', os.path.getsize(string_obj))
 
     def parallel_run(self, name, string_obj, target):
-        proc_args = {'name': name,
-                     'string_obj': string_obj,
-                     'queue': ut.basic_queue(iters=target),
-                     'job_action': self.run}
-        ut.worker_proc(
-            kwargs=proc_args
+        return self.fan_out(
+            name=name, commands=dict([(host, string_obj) for host in target])
         )
 
+    def run_batch(self, steps, target, report):
+        """Run many steps on a host as one script in a single remote shell.
+
+        The commands of "run" steps and the contents of "put" steps are
+        joined into one script, which is uploaded and run, so a batch costs
+        two round trips however many steps it holds. Every step runs in its
+        own subshell, which exits on the first command that fails, between
+        markers carrying its exit code, and a step is skipped when a step of
+        the batch that it requires has failed.
+
+        :param steps: ``list`` of ``dict`` with the "title", "method",
+                      "string_obj" and "remote_path" of every step and its
+                      "requires", the indexes of earlier steps of the batch.
+        :param target: Host the batch is run on.
+        :param report: Called with the index of a step and its error, which
+                       is None when the step completed, as soon as the step
+                       has finished.
+        """
+
+        token = uuid.uuid4().hex[:12]
+        remote_path = '/tmp/skylab-batch-%s.sh' % token
+        name = 'Batch of %d steps' % len(steps)
+        self.put(
+            name=name,
+            string_obj=batch_script(token=token, steps=steps),
+            remote_path=remote_path,
+            target=target
+        )
+
+        ad = {'method': 'run'}
+        ad['command'] = 'bash %s' % remote_path
+        ad['stdout'] = BatchStream(
+            host=target,
+            token=token,
+            steps=steps,
+            report=report,
+            log_file=self._log_file(target=target),
+            echo=self.args.get('debug') is True
+        )
+        self.run_action(action_dict=ad, target=target, name=name)
+
     def run(self, name, string_obj, target):
+        """Run a script, which fails on the first command that fails."""
+
         ad = {'method': 'run'}
-        print('Executing [%s]' % name)
-        ad['command'] = string_obj
-        self.run_action(action_dict=ad, target=target)
+        ad['command'] = 'set -e\n%s' % string_obj
+        return self.run_action(action_dict=ad, target=target, name=name)
@@ -0,0 +1,172 @@
+# =============================================================================
+# Copyright [2013] [cloudnull]
+# License Information :
+# This software has no warranty, it is provided 'as is'. It is your
+# responsibility to validate the behavior of the routines and its accuracy
+# using the code provided. Consult the GNU General Public license for further
+# details (see GNU General Public License).
+# http://www.gnu.org/licenses/gpl.html
+# =============================================================================
+
+import bisect
+
+import skylab as sk
+from skylab import metrics
+
+
+# Seconds that a cached flavor, image or network listing is valid for.
+CATALOG_TTL = 86400
+
+
+def _flavors(client):
+    return [{'id': flv.id,
+             'name': flv.name,
+             'ram': flv.ram,
+             'vcpus': flv.vcpus,
+             'rxtx': flv.rxtx_factor}
+            for flv in client.flavors.list()]
+
+
+def _images(client):
+    return [{'id': img.id,
+             'name': img.name,
+             'metadata': getattr(img, 'metadata', None) or {}}
+            for img in client.images.list()]
+
+
+def _networks(client):
+    return [{'id': net.id, 'label': net.label}
+            for net in client.networks._list('/os-networksv2', 'networks')]
+
+
+class Catalog(object):
+    """Flavor, image and network listings cached in the state DB.
+
+    Listings are keyed by region and compute endpoint and are only fetched
+    from the API when the cached copy is missing, expired or invalidated.
+    """
+
+    listers = {
+        'flavors': _flavors,
+        'images': _images,
+        'networks': _networks
+    }
+
+    def __init__(self, client, db_path, ttl=CATALOG_TTL, refresh=False):
+        """Load the catalog for an authenticated client.
+
+        :param client: Authenticated Nova Client
+        :param db_path: Full path to the state DB.
+        :param ttl: Seconds that a cached listing is valid for.
+        :param refresh: Invalidate all cached listings first.
+        """
+
+        self.client = client
+        self.db_path = db_path
+        self.ttl = ttl
+        self.region = client.client.region_name
+        self.endpoint = client.client.management_url
+        self.listings = {}
+        self._ram_index = None
+        self._image_index = None
+
+        if refresh is True:
+            self.invalidate()
+
+    def invalidate(self, kind=None):
+        """Drop cached listings, all of them if kind is not set.
+
+        :param kind: flavors|images|networks
+        """
+
+        with sk.Database(file_path=self.db_path) as db:
+            db.clear_catalog(
+                region=self.region, endpoint=self.endpoint, kind=kind
+            )
+
+        if kind is None:
+            self.listings.clear()
+        else:
+            self.listings.pop(kind, None)
+
+        if kind in (None, 'flavors'):
+            self._ram_index = None
+        if kind in (None, 'images'):
+            self._image_index = None
+
+    def _listing(self, kind):
+        if kind not in self.listings:
+            with sk.Database(file_path=self.db_path) as db:
+                listing = db.get_catalog(
+                    region=self.region,
+                    endpoint=self.endpoint,
+                    kind=kind,
+                    ttl=self.ttl
+                )
+                if listing is None:
+                    metrics.incr('catalog.miss', kind=kind)
+                    metrics.incr('api.calls', call='%s.list' % kind)
+                    with metrics.span('catalog', kind=kind,
+                                      region=self.region):
+                        listing = self.listers[kind](self.client)
+                    db.put_catalog(
+                        region=self.region,
+                        endpoint=self.endpoint,
+                        kind=kind,
+                        data=listing
+                    )
+                else:
+                    metrics.incr('catalog.hit', kind=kind)
+            self.listings[kind] = listing
+        return self.listings[kind]
+
+    def flavors(self):
+        return self._listing(kind='flavors')
+
+    def images(self):
+        return self._listing(kind='images')
+
+    def networks(self):
+        return self._listing(kind='networks')
+
+    def flavors_by_ram(self, ram):
+        """Return all flavors with an amount of RAM.
+
+        :param ram: RAM in Mega Bytes
+        :return: ``list``
+        """
+
+        if self._ram_index is None:
+            self._ram_index = {}
+            for flv in self.flavors():
+                self._ram_index.setdefault(flv['ram'], []).append(flv)
+        return self._ram_index.get(ram, [])
+
+    def find_images(self, image):
+        """Return the images matching an ID, a name or a name prefix.
+
+        An exact ID or name match wins over name prefix matches.
+
+        :param image: Name, name prefix or ID of an image.
+        :return: ``list``
+        """
+
+        if self._image_index is None:
+            by_id = dict([(img['id'], img) for img in self.images()])
+            by_name = sorted([(img['name'], img['id'])
+                              for img in self.images()])
+            self._image_index = (by_id, by_name)
+
+        by_id, by_name = self._image_index
+        if image in by_id:
+            return [by_id[image]]
+
+        matches = []
+        index = bisect.bisect_left(by_name, (image,))
+        for name, img_id in by_name[index:]:
+            if not name.startswith(image):
+                break
+            elif name == image:
+                return [by_id[img_id]]
+            matches.append(by_id[img_id])
+        return matches
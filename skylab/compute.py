@@ -0,0 +1,258 @@
+# =============================================================================
+# Copyright [2013] [cloudnull]
+# License Information :
+# This software has no warranty, it is provided 'as is'. It is your
+# responsibility to validate the behavior of the routines and its accuracy
+# using the code provided. Consult the GNU General Public license for further
+# details (see GNU General Public License).
+# http://www.gnu.org/licenses/gpl.html
+# =============================================================================
+
+import json
+import os
+import threading
+import urllib
+
+import requests
+from requests import adapters
+
+from novaclient import exceptions
+from novaclient.v1_1 import keypairs as nova_keypairs
+from novaclient.v1_1 import servers as nova_servers
+
+
+USER_AGENT = 'skylab'
+
+
+class ComputeClient(object):
+    """Nova REST client for the server and keypair calls of a build.
+
+    The client wraps an authenticated novaclient and uses its token and
+    compute endpoint. The hot calls, creating, listing, getting and deleting
+    servers and finding and creating keys, are sent through one
+    ``requests.Session`` whose pool keeps a connection alive for every
+    worker, so the workers of a process share warm connections. Every other
+    call is passed on to the novaclient.
+
+    Errors are the novaclient exceptions, with the same "code" and
+    "retry_after", so the retry handling of the callers does not change.
+    """
+
+    def __init__(self, nova, pool_size=10):
+        """Wrap a novaclient.
+
+        :param nova: Authenticated novaclient.
+        :param pool_size: Connections kept alive, one for each worker.
+        """
+
+        self.nova = nova
+        self.pool_size = max(1, pool_size)
+        self.servers = ServerManager(api=self)
+        self.keypairs = KeypairManager(api=self)
+        self._auth_lock = threading.Lock()
+        self._connect()
+
+    def __getattr__(self, attr):
+        return getattr(self.nova, attr)
+
+    def _connect(self):
+        """Open the session and its connection pool.
+
+        A forked worker opens its own, as the sockets of the parent can not
+        be shared.
+        """
+
+        adapter = adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_size
+        )
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pid = os.getpid()
+
+    def _reauthenticate(self, token):
+        """Authenticate again, unless another worker already has.
+
+        :param token: The token which was refused.
+        """
+
+        http = self.nova.client
+        with self._auth_lock:
+            if http.auth_token == token:
+                http.unauthenticate()
+                http.authenticate()
+
+    def request(self, method, url, body=None):
+        """Send a request to the compute endpoint.
+
+        An expired token is renewed and the request sent once more.
+
+        :param method: HTTP method.
+        :param url: Path on the compute endpoint, IE "/servers".
+        :param body: ``dict`` sent as JSON.
+        :return: ``dict`` of the response body, None if it had none.
+        """
+
+        if self.pid != os.getpid():
+            self._connect()
+
+        http = self.nova.client
+        if not http.management_url:
+            self._reauthenticate(token=http.auth_token)
+
+        headers = {'User-Agent': USER_AGENT, 'Accept': 'application/json'}
+        if http.projectid:
+            headers['X-Auth-Project-Id'] = http.projectid
+
+        kwargs = {'verify': http.verify_cert, 'timeout': http.timeout}
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+            kwargs['data'] = json.dumps(body)
+
+        for attempt in (1, 2):
+            token = headers['X-Auth-Token'] = http.auth_token
+            resp = self.session.request(
+                method, http.management_url + url, headers=headers, **kwargs
+            )
+            if resp.status_code == 401 and attempt == 1:
+                self._reauthenticate(token=token)
+            else:
+                break
+
+        try:
+            resp_body = json.loads(resp.text) if resp.text else None
+        except ValueError:
+            resp_body = None
+
+        if resp.status_code >= 400:
+            raise exceptions.from_response(resp, resp_body, url, method)
+        return resp_body
+
+
+class ServerManager(object):
+    """Server calls of the compute API.
+
+    Calls which are not made here are passed on to the novaclient.
+    """
+
+    def __init__(self, api):
+        self.api = api
+
+    def __getattr__(self, attr):
+        return getattr(self.api.nova.servers, attr)
+
+    def write_to_completion_cache(self, cache_type, val):
+        """The shell completion cache of novaclient is not kept."""
+
+    def _server(self, info):
+        return nova_servers.Server(self, info, loaded=True)
+
+    def list(self, search_opts=None):
+        """Return the servers matching the search options.
+
+        :param search_opts: ``dict`` of query filters, IE {"name": "lab_"}.
+        :return: ``list`` of servers.
+        """
+
+        url = '/servers/detail'
+        opts = sorted([(key, value) for key, value
+                       in (search_opts or {}).items() if value])
+        if opts:
+            url = '%s?%s' % (url, urllib.urlencode(opts))
+        body = self.api.request('GET', url)
+        return [self._server(info=info) for info in body['servers']]
+
+    def get(self, server):
+        """Return a server.
+
+        :param server: ID of the server.
+        """
+
+        body = self.api.request('GET', '/servers/%s' % server)
+        return self._server(info=body['server'])
+
+    def delete(self, server):
+        """Delete a server.
+
+        :param server: ID of the server.
+        """
+
+        self.api.request('DELETE', '/servers/%s' % server)
+
+    def create(self, name, image, flavor, nics=None, key_name=None,
+               admin_pass=None, min_count=None, max_count=None):
+        """Create one server, or several with the same spec.
+
+        :param name: Name of the server.
+        :param image: ID of the image.
+        :param flavor: ID of the flavor.
+        :param nics: ``list`` of {"net-id": ID} networks.
+        :param key_name: Name of the key injected into the server.
+        :param admin_pass: Root password of the server.
+        :param min_count: Fewest servers created, IE for a bulk create.
+        :param max_count: Most servers created.
+        :return: The server, the first one if there were several.
+        """
+
+        min_count = min_count or 1
+        server = {
+            'name': name,
+            'imageRef': image,
+            'flavorRef': flavor,
+            'min_count': min_count,
+            'max_count': max(min_count, max_count or min_count)
+        }
+        if nics:
+            server['networks'] = [{'uuid': nic['net-id']} for nic in nics]
+        if key_name:
+            server['key_name'] = key_name
+        if admin_pass is not None:
+            server['adminPass'] = admin_pass
+
+        body = self.api.request('POST', '/servers', body={'server': server})
+        return self._server(info=body['server'])
+
+
+class KeypairManager(object):
+    """Keypair calls of the compute API.
+
+    Calls which are not made here are passed on to the novaclient.
+    """
+
+    def __init__(self, api):
+        self.api = api
+
+    def __getattr__(self, attr):
+        return getattr(self.api.nova.keypairs, attr)
+
+    def write_to_completion_cache(self, cache_type, val):
+        """The shell completion cache of novaclient is not kept."""
+
+    def _keypair(self, info):
+        return nova_keypairs.Keypair(self, info, loaded=True)
+
+    def findall(self, name=None):
+        """Return the keys of the tenant, only the named one if given.
+
+        :param name: Name of the key.
+        :return: ``list`` of keys.
+        """
+
+        body = self.api.request('GET', '/os-keypairs')
+        keys = [item['keypair'] for item in body['keypairs']]
+        return [self._keypair(info=key) for key in keys
+                if name is None or key.get('name') == name]
+
+    def create(self, name, public_key):
+        """Upload a public key.
+
+        :param name: Name of the key.
+        :param public_key: ``str`` of the public key.
+        """
+
+        body = self.api.request(
+            'POST',
+            '/os-keypairs',
+            body={'keypair': {'name': name, 'public_key': public_key}}
+        )
+        return self._keypair(info=body['keypair'])
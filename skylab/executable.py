@@ -8,14 +8,24 @@
 # http://www.gnu.org/licenses/gpl.html
 # =============================================================================
 
+import copy
 import os
 import json
+import time
 
 import skylab as sk
 
 from skylab import arguments
+from skylab import artifacts
+from skylab import catalog
+from skylab import compute
+from skylab import fleet
+from skylab import metrics
 from skylab import osclients
+from skylab import quota
+from skylab import report
 from skylab import service_module as sm
+from skylab import state
 from skylab import utils
 
 
@@ -23,14 +33,80 @@ def execute():
     """Execute the Tribble Application."""
     user_args = arguments.args()
 
-    # Load the local DB for rebuilding
+    # Load the local DB, a build adds the entry for each lab it builds.
     user_args['db_path'] = sk.dbm_create(
         db_path=user_args.get('db_path'),
-        db_name=user_args.get('db_name'),
-        db_key=user_args.get('name')
+        db_name=user_args.get('db_name')
     )
 
-    Runner(args=user_args).run_method()
+    metrics.configure()
+    try:
+        Runner(args=user_args).run_method()
+    finally:
+        metrics.export(args=user_args)
+
+
+# Build arguments saved with a lab so that its build can be resumed and its
+# compute nodes scaled.
+RESUME_ARGS = ('artifact_bundle', 'baked_artifacts', 'baked_steps',
+               'compute', 'compute_ram', 'cookbook_version', 'ssh_port',
+               'ssh_user')
+
+
+def region_name(name, region):
+    """Return the name of the lab built for a region of a multi-region build.
+
+    :param name: Naming convention for all nodes.
+    :param region: Name of the region.
+    """
+
+    return '%s_%s' % (name, region.lower())
+
+
+def build_region(args, target):
+    """Build a lab in one region of a multi-region build.
+
+    :param args: ``dict`` parsed cli arguments.
+    :param target: Name of the region.
+    :return: Name of the lab that was built.
+    """
+
+    region_args = copy.deepcopy(args)
+    region_args['region'] = target
+    region_args['name'] = region_name(name=args['name'], region=target)
+
+    try:
+        Runner(args=region_args)._build_region()
+    except SystemExit as exc:
+        # Keep the failure of a region within the region.
+        raise sk.DeploymentFailure(str(exc))
+    else:
+        return region_args['name']
+
+
+def fleet_lab(clients, action, target):
+    """Build, resume or scuttle one lab of a fleet.
+
+    :param clients: ``dict`` of regions and their authenticated client.
+    :param action: build|resume|scuttle
+    :param target: ``dict`` arguments of the lab.
+    :return: Name of the lab.
+    """
+
+    runner = Runner(args=target)
+    runner.client = clients[target['region']]
+    try:
+        if action == 'build':
+            runner._build_region()
+        elif action == 'resume':
+            runner.resume_lab()
+        else:
+            runner.scuttle_lab()
+    except SystemExit as exc:
+        # Keep the failure of a lab within the lab.
+        raise sk.DeploymentFailure(str(exc))
+    else:
+        return target['name']
 
 
 class Runner(object):
@@ -54,12 +130,17 @@ class Runner(object):
         else:
             action()
 
-    def build_lab(self):
-        """Build the Openstack Lab."""
+    def _load_client(self):
+        """Load the Novaclient and Authenticate.
 
-        queue = None
+        The server and keypair calls go through a ``ComputeClient`` with a
+        keep-alive connection for each worker. A client which was handed to
+        the runner is used as it is.
+        """
+
+        if self.client is not None:
+            return
 
-        # Load the Novaclient and Authenticate.
         creds = osclients.Creds(
             user=self.args.get('username'),
             region=self.args.get('region'),
@@ -67,49 +148,305 @@ class Runner(object):
             password=self.args.get('password'),
             tenant=self.args.get('tenant_name'),
             project_id=self.args.get('project_id'),
+            cache_path=self.args.get('db_path')
+        )
+
+        with metrics.span('auth', region=self.args.get('region')):
+            clients = osclients.Clients(creds=creds, args=self.args)
+            nova = clients.nova()
+            nova.authenticate()
+
+        self.client = compute.ComputeClient(
+            nova=nova, pool_size=self.args.get('workers') or 10
+        )
+
+    def build_lab(self):
+        """Build the Openstack Lab in every region requested.
+
+        When more than one region is given every region is built in
+        parallel as its own lab, named "<name>_<region>". A failure in one
+        region does not stop the others.
+        """
+
+        if self.args.get('no_artifacts') is False:
+            # Prepare the bundle once, before any region starts building.
+            self.args['artifact_bundle'] = artifacts.prepare_bundle(
+                artifact_path=self.args['artifact_path'],
+                cookbook_version=self.args['cookbook_version'],
+                refresh=self.args.get('refresh_artifacts')
+            )
+
+        regions = osclients.regions(region=self.args['region'])
+        if len(regions) == 1:
+            self.args['region'] = regions[0]
+            return self._build_region()
+
+        results = utils.worker_proc(
+            kwargs={'args': self.args,
+                    'queue': utils.basic_queue(iters=regions),
+                    'job_action': build_region},
+            threads=len(regions),
+            backend='process'
+        )
+
+        sk.print_horiz_table(
+            [{'region': job.target,
+              'lab': region_name(name=self.args['name'], region=job.target),
+              'status': 'FAILED' if job.error else 'BUILT',
+              'error': str(job.error) if job.error else None}
+             for job in sorted(results)]
+        )
+
+        failures = [job.target for job in results if job.error is not None]
+        if failures:
+            raise sk.DeploymentFailure(
+                'The build failed in regions: %s' % ', '.join(failures)
+            )
+
+    def fleet(self):
+        """Build, resume, show or scuttle every lab of a fleet manifest.
+
+        One client is authenticated per region before any lab is started
+        and every lab works with it, along with the cached catalog in the
+        state DB. Labs are worked on in worker processes, up to max labs at
+        a time, as the build forks lanes which must not inherit the DB
+        connections of other threads. The workers are split evenly between
+        the labs so that a large lab does not starve the others, and a build
+        is checked against the account RAM of the whole fleet first. A
+        failure in one lab does not stop the others.
+        """
+
+        labs = fleet.load_manifest(
+            manifest=self.args['manifest'], args=self.args
+        )
+        action = self.args['fleet_action']
+        if action == 'info':
+            return self._fleet_info(labs=labs)
+
+        max_labs = max(1, min(self.args['max_labs'], len(labs)))
+        workers = fleet.worker_share(
+            workers=self.args['workers'], labs=max_labs
+        )
+
+        clients = {}
+        bundles = {}
+        for lab_args in labs:
+            lab_args['workers'] = workers
+            if lab_args['region'] not in clients:
+                runner = Runner(args=lab_args)
+                runner._load_client()
+                clients[lab_args['region']] = runner.client
+
+                if action == 'build':
+                    # Fill the catalog cache once for all labs of the region.
+                    lab_catalog = catalog.Catalog(
+                        client=runner.client,
+                        db_path=self.args['db_path'],
+                        refresh=any([lab['refresh_catalog'] for lab in labs
+                                     if lab['region'] == lab_args['region']])
+                    )
+                    lab_catalog.flavors()
+                    lab_catalog.images()
+            lab_args['refresh_catalog'] = False
+
+            if action == 'build' and lab_args['no_artifacts'] is False:
+                # Prepare every bundle once, before any lab starts building.
+                key = (lab_args['artifact_path'], lab_args['cookbook_version'])
+                if key not in bundles:
+                    bundles[key] = artifacts.prepare_bundle(
+                        artifact_path=lab_args['artifact_path'],
+                        cookbook_version=lab_args['cookbook_version'],
+                        refresh=lab_args['refresh_artifacts']
+                    )
+                lab_args['artifact_bundle'] = bundles[key]
+
+        if action == 'build':
+            for region, client in clients.items():
+                self._fleet_quota(
+                    client=client,
+                    labs=[lab_args for lab_args in labs
+                          if lab_args['region'] == region]
+                )
+
+        print('Running "%s" on "%s" labs, "%s" at a time'
+              % (action, len(labs), max_labs))
+        with metrics.span('fleet', action=action):
+            results = utils.worker_proc(
+                kwargs={'clients': clients,
+                        'action': action,
+                        'queue': utils.basic_queue(iters=labs),
+                        'job_action': fleet_lab},
+                threads=max_labs,
+                backend='process'
+            )
+
+        sk.print_horiz_table(
+            [{'lab': job.target['name'],
+              'region': job.target['region'],
+              'status': 'FAILED' if job.error else action.upper(),
+              'error': str(job.error) if job.error else None}
+             for job in sorted(results, key=lambda job: job.target['name'])]
         )
 
-        clients = osclients.Clients(creds=creds, args=self.args)
-        self.client = clients.nova()
-        self.client.authenticate()
+        failures = sorted(
+            [job.target['name'] for job in results if job.error is not None]
+        )
+        if failures:
+            raise sk.DeploymentFailure(
+                'The fleet %s failed for labs: %s'
+                % (action, ', '.join(failures))
+            )
+
+    def _fleet_quota(self, client, labs):
+        """Check the footprint of every lab in a region at once.
+
+        Nothing is reserved, every lab reserves its own footprint when it
+        starts building.
+        """
 
-        # Set the tenant ID
+        lab_catalog = catalog.Catalog(
+            client=client, db_path=self.args['db_path']
+        )
+        needs = []
+        for lab_args in labs:
+            spec = quota.lab_spec(
+                catalog=lab_catalog,
+                args=lab_args,
+                controller_flavor=sm.flavor_find(
+                    catalog=lab_catalog, flavor_ram=lab_args['controller_ram']
+                ),
+                compute_flavor=sm.flavor_find(
+                    catalog=lab_catalog, flavor_ram=lab_args['compute_ram']
+                )
+            )
+            needs.append(
+                quota.footprint(spec=spec, node_count=lab_args['node_count'])
+            )
+
+        planner = quota.Planner(client=client, db_path=self.args['db_path'])
+        plan = planner.plan(need=quota.add(*needs))
+        if plan['short']:
+            raise sk.QuotaExceeded(
+                'This fleet is not possible in "%s", your account is short'
+                ' of %s.' % (planner.region, quota.describe(plan['short']))
+            )
+
+    def _fleet_info(self, labs):
+        """Show the state of every lab of a fleet from the local DB."""
+
+        print_data = []
+        with sk.Database(file_path=self.args['db_path']) as db:
+            known = db.labs()
+            for lab_args in labs:
+                name = lab_args['name']
+                print_data.append({
+                    'lab': name,
+                    'region': lab_args['region'],
+                    'known': name in known,
+                    'nodes': len(db.nodes(lab=name)),
+                    'expected_nodes': lab_args['node_count'],
+                    'completed_steps': len(db.steps(lab=name))
+                })
+
+        sk.print_horiz_table(print_data)
+
+    def _build_region(self):
+        """Build the Openstack Lab in a single region.
+
+        The capacity reserved for the lab is released once its nodes exist,
+        as the account limits count them from then on, or once building the
+        nodes has failed.
+        """
+
+        if self.args['node_count'] < 3:
+            raise sk.NotEnoughNodes(
+                'The node count is too low. You have set "%s" but it needs'
+                ' to be a minimum of "3".' % self.args['node_count']
+            )
+
+        # Fail on a bad script before any server is created.
+        sm.check_scripts(args=self.args)
+
+        with sk.Database(file_path=self.args['db_path']) as db:
+            db.add_lab(lab=self.args['name'])
+
+        self._load_client()
+
+        planner = quota.Planner(
+            client=self.client, db_path=self.args['db_path']
+        )
+        try:
+            queue = self._build_servers(planner=planner)
+        finally:
+            planner.release(lab=self.args['name'])
+
+        # Save what is needed to resume the build.
+        with sk.Database(file_path=self.args['db_path']) as db:
+            db.set_values(
+                lab=self.args['name'],
+                values={'build_args': dict([(arg, self.args.get(arg))
+                                            for arg in RESUME_ARGS])}
+            )
+
+        # Construct all the things.
+        with utils.IndicatorThread(work_q=queue, debug=self.args.get('debug')):
+            with metrics.span('construct', lab=self.args['name']):
+                sm.construct_skylab(args=self.args)
+
+    def _build_servers(self, planner):
+        """Admit the lab against the account limits and build its nodes.
+
+        :param planner: ``quota.Planner`` the lab is reserved with.
+        :return: Queue the nodes were built from.
+        """
+
+        queue = None
         with utils.IndicatorThread(debug=self.args.get('debug')):
-            tenant = self.client.client.tenant_id
+            lab_catalog = catalog.Catalog(
+                client=self.client,
+                db_path=self.args['db_path'],
+                refresh=self.args.get('refresh_catalog')
+            )
 
             # Set the controller Flavor ID
             print('Finding Flavor Information')
             controller_flavor = sm.flavor_find(
-                client=self.client, flavor_ram=self.args.get('controller_ram')
+                catalog=lab_catalog,
+                flavor_ram=self.args.get('controller_ram')
             )
             self.args['controller'] = {'flavor': controller_flavor}
 
             # Set the compute Flavor ID
             compute_flavor = sm.flavor_find(
-                client=self.client, flavor_ram=self.args.get('compute_ram')
+                catalog=lab_catalog, flavor_ram=self.args.get('compute_ram')
             )
             self.args['compute'] = {'flavor': compute_flavor}
 
-            # Add up total purposed ram for the build
-            con_ram = self.args.get('controller_ram')
-            com_ram = self.args.get('compute_ram')
-            t_ram = con_ram + com_ram
-
             print('Checking Build against Limits')
-            in_limits = sm.check_limits(
-                client=self.client,
-                tenant_id=tenant,
-                purposed_ram=t_ram
+            spec = quota.lab_spec(
+                catalog=lab_catalog,
+                args=self.args,
+                controller_flavor=controller_flavor,
+                compute_flavor=compute_flavor
             )
-            if in_limits is False:
-                raise sk.NotEnoughRam(
-                    'This build is not possible, your account does not'
-                    ' have enough RAM available.'
+            plan = planner.admit(
+                lab=self.args['name'],
+                need=quota.footprint(
+                    spec=spec, node_count=self.args['node_count']
+                )
+            )
+            if plan['short']:
+                raise sk.QuotaExceeded(
+                    'This build is not possible, your account is short of %s.'
+                    ' A lab of up to "%s" nodes fits.'
+                    % (quota.describe(short=plan['short']),
+                       quota.nodes_fit(left=plan['left'], spec=spec))
                 )
 
             print('Defining the Network')
             network = sm.skylab_network(
                 client=self.client,
+                catalog=lab_catalog,
                 name=self.args.get('name'),
                 net_cidr=self.args.get('net_cidr'),
                 net_id=self.args.get('net_id')
@@ -117,9 +454,10 @@ class Runner(object):
 
             print('Checking for Image')
             image_id = sm.image_find(
-                client=self.client,
+                catalog=lab_catalog,
                 image=self.args.get('image')
             )
+            self._baked(lab_catalog=lab_catalog, image_id=image_id)
             nics = [
                 {'net-id': "00000000-0000-0000-0000-000000000000"},
                 {'net-id': network}
@@ -135,118 +473,623 @@ class Runner(object):
             }
 
             print('Defining the key')
-            if self.args.get('admin_pass') is not None:
-                build_kwargs['admin_pass'] = self.args['admin_pass']
-
-            if self.args.get('key_name'):
-                if not sm.client_key_find(self.client,
-                                          key_name=self.args['key_name']):
-                    key_path = os.path.expanduser(self.args['key_location'])
-                    if os.path.exists(key_path):
-                        with open(key_path, 'rb') as key:
-                            sm.client_key_create(
-                                self.client,
-                                key_name=self.args['key_name'],
-                                public_key=key.read()
-                            )
-                        build_kwargs['key_name'] = self.args['key_name']
-                else:
-                    build_kwargs['key_name'] = self.args['key_name']
+            build_kwargs.update(self._key_kwargs())
 
             print('Loading Work Queue')
-            if self.args['node_count'] < 3:
-                raise sk.NotEnoughNodes(
-                    'The node count is too low. You have set "%s" but it needs'
-                    ' to be a minimum of "3".' % self.args['node_count']
-                )
-            else:
-                # Load our queue
-                queue = utils.basic_queue()
-                self.args['compute'].update(build_kwargs)
-                for c_node in range(self.args['node_count'] - 2):
-                    c_node += 1
-                    compute = {
-                        'name': '%s_compute%s' % (self.args['name'], c_node)
-                    }
-                    compute.update(self.args['compute'])
+            queue = utils.basic_queue()
+            bulk = []
+            self.args['compute'].update(build_kwargs)
+            for c_node in range(self.args['node_count'] - 2):
+                c_node += 1
+                compute = {
+                    'name': '%s_compute%s' % (self.args['name'], c_node)
+                }
+                compute.update(self.args['compute'])
+                if self.args.get('no_bulk_create') is True:
                     queue.put(compute)
+                else:
+                    bulk.append(compute)
+
+            self.args['controller'].update(build_kwargs)
+            for c_node in range(2):
+                c_node += 1
+                controller = {
+                    'name': '%s_controller%s' % (self.args['name'], c_node)
+                }
+                controller.update(self.args['controller'])
+                queue.put(controller)
 
-                self.args['controller'].update(build_kwargs)
-                for c_node in range(2):
-                    c_node += 1
-                    controller = {
-                        'name': '%s_controller%s' % (self.args['name'], c_node)
-                    }
-                    controller.update(self.args['controller'])
-                    queue.put(controller)
-
-        # Prep the threader
-        proc_args = {'client': self.client,
-                     'args': self.args,
-                     'queue': queue,
-                     'job_action': sm.bob_the_builder}
         with utils.IndicatorThread(work_q=queue, debug=self.args.get('debug')):
             print('Building "%s" nodes' % self.args['node_count'])
-            utils.worker_proc(
-                kwargs=proc_args
+            with metrics.span('build_nodes', lab=self.args['name']):
+                self._build_nodes(queue=queue, bulk=bulk)
+
+        return queue
+
+    def _key_kwargs(self):
+        """Return the admin password and key arguments for new servers.
+
+        The key is created in Nova from the key location if it is missing.
+        """
+
+        build_kwargs = {}
+        if self.args.get('admin_pass') is not None:
+            build_kwargs['admin_pass'] = self.args['admin_pass']
+
+        if self.args.get('key_name'):
+            if not sm.client_key_find(self.client,
+                                      key_name=self.args['key_name']):
+                key_path = os.path.expanduser(self.args['key_location'])
+                if os.path.exists(key_path):
+                    with open(key_path, 'rb') as key:
+                        sm.client_key_create(
+                            self.client,
+                            key_name=self.args['key_name'],
+                            public_key=key.read()
+                        )
+                    build_kwargs['key_name'] = self.args['key_name']
+            else:
+                build_kwargs['key_name'] = self.args['key_name']
+
+        return build_kwargs
+
+    def _baked(self, lab_catalog, image_id):
+        """Load what a baked image has already done from its metadata."""
+
+        image = lab_catalog.find_images(image=image_id)[0]
+        metadata = image.get('metadata') or {}
+        baked = metadata.get('skylab_baked')
+        self.args['baked_steps'] = baked.split(',') if baked else []
+        self.args['baked_artifacts'] = metadata.get('skylab_artifacts')
+        if self.args['baked_artifacts'] == self.args['cookbook_version']:
+            # The bundle of the image is used instead.
+            self.args['artifact_bundle'] = None
+
+    def bake_image(self):
+        """Bake the steps which are the same on every node into an image.
+
+        One server is booted from the stock image, the node agnostic steps
+        are run on it and it is snapshotted. Labs built from the snapshot
+        skip those steps. The server is kept in the local DB under its name
+        while the image is baked, so the name of a lab is refused.
+        """
+
+        with sk.Database(file_path=self.args['db_path']) as db:
+            if self.args['name'] in db.labs():
+                raise SystemExit(
+                    '"%s" is the name of a lab in the local DB, use another'
+                    ' "--name" for the server the image is baked on.'
+                    % self.args['name']
+                )
+
+        self._load_client()
+        lab_catalog = catalog.Catalog(
+            client=self.client,
+            db_path=self.args['db_path'],
+            refresh=self.args.get('refresh_catalog')
+        )
+
+        image_name = self.args['image_name']
+        existing = [img['id'] for img in lab_catalog.images()
+                    if img['name'] == image_name]
+        if existing and self.args.get('replace') is False:
+            raise SystemExit(
+                'An image named "%s" already exists, use "--replace" to'
+                ' replace it.' % image_name
             )
 
-        # Construct all the things.
-        with utils.IndicatorThread(work_q=queue, debug=self.args.get('debug')):
-            sm.construct_skylab(args=self.args)
+        if self.args.get('no_artifacts') is False:
+            self.args['artifact_bundle'] = artifacts.prepare_bundle(
+                artifact_path=self.args['artifact_path'],
+                cookbook_version=self.args['cookbook_version'],
+                refresh=self.args.get('refresh_artifacts')
+            )
 
-    def db_show(self):
-        with sk.Shelve(file_path=self.args['db_path']) as db:
-            print(json.dumps(dict(db), indent=4))
+        build_hash = {
+            'name': '%s_image' % self.args['name'],
+            'flavor': sm.flavor_find(
+                catalog=lab_catalog, flavor_ram=self.args['compute_ram']
+            ),
+            'image': sm.image_find(
+                catalog=lab_catalog, image=self.args['image']
+            ),
+            'nics': [{'net-id': "00000000-0000-0000-0000-000000000000"},
+                     {'net-id': "11111111-1111-1111-1111-111111111111"}]
+        }
+        build_hash.update(self._key_kwargs())
 
-    def lab_info(self):
+        with utils.IndicatorThread(debug=self.args.get('debug')):
+            server_id = sm.bob_the_builder(
+                client=self.client,
+                args=self.args,
+                target=build_hash
+            )
+            try:
+                if sm.wait_for_active(client=self.client,
+                                      args=self.args,
+                                      servers={server_id: build_hash}):
+                    raise sk.DeploymentFailure(
+                        'The server for the image never went ACTIVE'
+                    )
+
+                metadata = sm.bake_node(
+                    args=self.args, node_name=build_hash['name']
+                )
+                print('Creating image "%s"' % image_name)
+                image_id = sm.client_image_create(
+                    client=self.client,
+                    server_id=server_id,
+                    image_name=image_name,
+                    metadata=metadata
+                )
+                sm.wait_for_image(client=self.client, image_id=image_id)
+            finally:
+                sm.client_delete(client=self.client, server_id=server_id)
+                with sk.Database(file_path=self.args['db_path']) as db:
+                    db.delete_lab(lab=self.args['name'])
+
+            for old_id in existing:
+                sm.client_image_delete(client=self.client, image_id=old_id)
+            lab_catalog.invalidate(kind='images')
+
+        print('Image "%s" (%s) is ready, build labs from it with'
+              ' "build-lab --image %s"' % (image_name, image_id, image_id))
+
+    def resume_lab(self):
+        """Resume a failed build, skipping the steps already completed."""
+
+        with sk.Database(file_path=self.args['db_path']) as db:
+            build_args = db.get_value(lab=self.args['name'], key='build_args')
+
+        if build_args is None:
+            raise SystemExit(
+                'No build was found for lab "%s".' % self.args['name']
+            )
+        self.args.update(build_args)
+
+        with utils.IndicatorThread(debug=self.args.get('debug')):
+            with metrics.span('construct', lab=self.args['name']):
+                sm.construct_skylab(args=self.args, resume=True)
+
+    def scale_lab(self):
+        """Add or remove compute nodes of a built lab.
+
+        The topology of the lab is read from the state DB. Scaling up builds
+        only the new compute nodes, at the lowest free indexes, and runs the
+        compute steps of the build on them. Scaling down drains the highest
+        indexed compute nodes from the controllers and deletes them.
+        Compute nodes left part way through an earlier scale are finished.
+        """
+
+        name = self.args['name']
+        with sk.Database(file_path=self.args['db_path']) as db:
+            build_args = db.get_value(lab=name, key='build_args')
+            computes = db.nodes(lab=name, role='compute')
+
+        if build_args is None:
+            raise SystemExit('No build was found for lab "%s".' % name)
+        elif build_args.get('compute') is None:
+            raise SystemExit(
+                'Lab "%s" was built without its compute spec being saved and'
+                ' can not be scaled.' % name
+            )
+        elif self.args['computes'] < 1:
+            raise sk.NotEnoughNodes(
+                'The compute count is too low. You have set "%s" but it'
+                ' needs to be a minimum of "1".' % self.args['computes']
+            )
+        self.args.update(build_args)
+
+        self._load_client()
+        with metrics.span('scale', lab=name):
+            if self.args['computes'] > len(computes):
+                self._scale_up(
+                    computes=sm.free_computes(
+                        lab=name,
+                        existing=computes,
+                        count=self.args['computes'] - len(computes)
+                    )
+                )
+            elif self.args['computes'] < len(computes):
+                by_index = sorted(
+                    computes,
+                    key=lambda node: sm.compute_index(lab=name, name=node)
+                )
+                self._scale_down(computes=by_index[self.args['computes']:])
+
+            # Deploy every compute node the build has not finished on.
+            with sk.Database(file_path=self.args['db_path']) as db:
+                computes = db.nodes(lab=name, role='compute')
+                completed = db.steps(lab=name)
+            unfinished = sorted([
+                node for node in computes
+                if ('bootstrap_computes',
+                    sm.node_addr(nodes=computes, device=node)) not in completed
+            ])
+            if unfinished:
+                with utils.IndicatorThread(debug=self.args.get('debug')):
+                    sm.scale_skylab(args=self.args, computes=unfinished)
 
-        def get_addr(server, net_name):
-            if 'addresses' in srv:
-                addresses = server['addresses'].get(net_name)
-                if addresses is not None:
-                    for addr in addresses:
-                        if addr.get('version') == 4:
-                            return addr.get('addr')
+        print('Lab "%s" has "%s" compute nodes' % (name, len(computes)))
+
+    def _scale_up(self, computes):
+        """Admit new compute nodes against the account limits and build them.
+
+        :param computes: ``list`` of names of the new compute nodes.
+        """
+
+        lab_catalog = catalog.Catalog(
+            client=self.client,
+            db_path=self.args['db_path'],
+            refresh=self.args.get('refresh_catalog')
+        )
+        spec = {
+            'compute_ram': self.args['compute_ram'],
+            'compute_vcpus': quota.flavor_vcpus(
+                catalog=lab_catalog, flavor_id=self.args['compute']['flavor']
+            )
+        }
+
+        planner = quota.Planner(
+            client=self.client, db_path=self.args['db_path']
+        )
+        try:
+            plan = planner.admit(
+                lab=self.args['name'],
+                need=quota.compute_footprint(
+                    spec=spec, computes=len(computes)
+                )
+            )
+            if plan['short']:
+                raise sk.QuotaExceeded(
+                    'Adding "%s" compute nodes is not possible, your account'
+                    ' is short of %s.'
+                    % (len(computes), quota.describe(short=plan['short']))
+                )
+
+            queue = utils.basic_queue()
+            bulk = []
+            for node in computes:
+                compute = {'name': node}
+                compute.update(self.args['compute'])
+                if self.args.get('no_bulk_create') is True:
+                    queue.put(compute)
                 else:
-                    return None
+                    bulk.append(compute)
+
+            with utils.IndicatorThread(work_q=queue,
+                                       debug=self.args.get('debug')):
+                print('Building "%s" compute nodes' % len(computes))
+                with metrics.span('build_nodes', lab=self.args['name']):
+                    self._build_nodes(queue=queue, bulk=bulk)
+        finally:
+            planner.release(lab=self.args['name'])
+
+    def _scale_down(self, computes):
+        """Drain compute nodes from the lab and delete them.
+
+        Nodes which could not be deleted are kept in the local DB so that the
+        scale can be run again.
+
+        :param computes: ``list`` of names of the compute nodes to remove.
+        """
 
         name = self.args['name']
-        with sk.Shelve(file_path=self.args['db_path']) as db:
-            db_data = dict(db)
-            info = [db_data[name][srv] for srv in db_data[name].keys()
-                    if srv.startswith(name)]
+        with sk.Database(file_path=self.args['db_path']) as db:
+            lab_nodes = db.nodes(lab=name)
+
+        with utils.IndicatorThread(debug=self.args.get('debug')):
+            print('Draining "%s" compute nodes' % len(computes))
+            sm.drain_computes(args=self.args, computes=computes)
+
+            servers = dict([(lab_nodes[node]['id'], node)
+                            for node in computes])
+            print('Deleting "%s" servers' % len(servers))
+            remaining = sm.scuttle_servers(
+                client=self.client, args=self.args, server_ids=sorted(servers)
+            )
+
+        with sk.Database(file_path=self.args['db_path']) as db:
+            with db.transaction():
+                for sid, node in servers.items():
+                    if sid not in remaining:
+                        db.clear_steps(
+                            lab=name,
+                            host=sm.node_addr(nodes=lab_nodes, device=node)
+                        )
+                        db.delete_node(lab=name, name=node)
+
+            computes = sorted(db.nodes(lab=name, role='compute'))
+            hostnames = db.get_value(
+                lab=name, key='compute_hostnames', default={}
+            )
+            db.set_values(
+                lab=name,
+                values={
+                    'compute_nodes': [
+                        sm.node_addr(nodes=lab_nodes, device=node)
+                        for node in computes
+                    ],
+                    'compute_hostnames': dict([
+                        (node, names) for node, names in hostnames.items()
+                        if node in computes
+                    ])
+                }
+            )
+
+        if remaining:
+            raise sk.DeploymentFailure(
+                'Servers were not deleted: %s' % ', '.join(
+                    sorted([servers[sid] for sid in remaining])
+                )
+            )
 
-            if self.args.get('server'):
-                pass
+    def _build_nodes(self, queue, bulk=None):
+        """Create all nodes in the queue and wait for them to be active.
+
+        Nodes which fail to go active are built again, up to MAX_FAULTS
+        times.
+
+        :param queue: Queue of server dicts.
+        :param bulk: ``list`` of server dicts which are created with one
+                     request for every group of identical specs.
+        """
+
+        servers = {}
+        for group in sm.bulk_groups(targets=bulk or []):
+            if len(group) == 1:
+                queue.put(group[0])
+                continue
+
+            created, missing = sm.bulk_create(
+                client=self.client, args=self.args, targets=group
+            )
+            servers.update(created)
+            for target in missing:
+                queue.put(target)
+
+        for _ in range(sm.MAX_FAULTS):
+            proc_args = {'client': self.client,
+                         'args': self.args,
+                         'queue': queue,
+                         'job_action': sm.bob_the_builder}
+            results = utils.worker_proc(
+                kwargs=proc_args,
+                threads=self.args.get('workers'),
+                backend=self.args.get('executor')
+            )
+
+            failures = [job for job in results if job.error is not None]
+            if failures:
+                raise sk.DeploymentFailure(
+                    'Failed to build nodes: %s' % ', '.join(
+                        ['"%s" (%s)' % (job.target['name'], job.error)
+                         for job in failures]
+                    )
+                )
+
+            servers.update([(job.result, job.target) for job in results])
+            rebuild = sm.wait_for_active(
+                client=self.client, args=self.args, servers=servers
+            )
+            servers = {}
+            if rebuild:
+                queue = utils.basic_queue(iters=rebuild)
             else:
-                print_data = []
-                skynet = '%s_address' % name
-                for srv in info:
-                    print_data.append({
-                        'id': srv.get('id'),
-                        'name': srv.get('name'),
-                        skynet: get_addr(server=srv, net_name=name),
-                        'public_net': get_addr(server=srv, net_name='public')
-                    })
-
-                sk.print_horiz_table(print_data)
+                break
+        else:
+            raise sk.DeploymentFailure(
+                'Nodes never went ACTIVE after "%s" attempts' % sm.MAX_FAULTS
+            )
+
+    def db_show(self):
+        """Show the labs of the local DB, one lab if a name is given.
+
+        Keys and passwords are not read from the DB unless they are asked
+        for, they are shown as hidden instead.
+        """
+
+        lab = self.args.get('name')
+        exclude = None
+        if self.args.get('show_secrets') is not True:
+            exclude = report.SECRET_VALUES
+
+        with sk.Database(file_path=self.args['db_path']) as db:
+            if lab is not None and lab not in db.labs():
+                raise SystemExit('Lab "%s" was not found.' % lab)
+
+            data = db.dump(lab=lab, exclude=exclude)
+            if exclude is not None:
+                for name in data:
+                    data[name] = report.hide_secrets(
+                        values=data[name], keys=db.value_keys(lab=name)
+                    )
+
+        output_format = self.args.get('output_format') or 'json'
+        if output_format == 'json':
+            print(json.dumps(data, indent=4))
+        else:
+            fields = ['lab', 'key', 'value']
+            rows = [{'lab': name,
+                     'key': key,
+                     'value': (value if isinstance(value, basestring)
+                               else json.dumps(value, sort_keys=True))}
+                    for name in sorted(data)
+                    for key, value in sorted(data[name].items())]
+            print(report.render(
+                rows=rows, fields=fields, output_format=output_format
+            ))
+
+    def lab_info(self):
+        """Show the nodes of a lab from the local DB.
+
+        Only the nodes and the fields asked for are read and worked out.
+        With watch, the nodes are refreshed from one server listing per
+        interval and saved to the local DB, until interrupted.
+        """
+
+        name = self.args['name']
+        fields = report.parse_fields(fields=self.args.get('fields'))
+        with sk.Database(file_path=self.args['db_path']) as db:
+            nodes = self._info_nodes(db=db)
+
+        if not self.args.get('watch'):
+            print(report.render(
+                rows=report.node_rows(lab=name, nodes=nodes, fields=fields),
+                fields=fields,
+                output_format=self.args.get('output_format') or 'table'
+            ))
+            return
+
+        self._load_client()
+        prefix = '%s_' % name
+        try:
+            while True:
+                listing = dict([
+                    (server.id, server)
+                    for server in sm.client_list(
+                        self.client, search_opts={'name': prefix}
+                    )
+                    if server.name.startswith(prefix)
+                ])
+                with sk.Database(file_path=self.args['db_path']) as db:
+                    with db.transaction():
+                        for node, data in nodes.items():
+                            server = listing.get(data.get('id'))
+                            if server is None:
+                                data['status'] = 'MISSING'
+                            else:
+                                nodes[node] = server._info
+                                db.put_node(
+                                    lab=name, name=node, data=server._info
+                                )
+
+                print('%s - "%s" nodes of lab "%s"'
+                      % (time.strftime('%Y-%m-%d %H:%M:%S'), len(nodes), name))
+                print(report.render(
+                    rows=report.node_rows(
+                        lab=name, nodes=nodes, fields=fields
+                    ),
+                    fields=fields,
+                    output_format=self.args.get('output_format') or 'table'
+                ))
+                time.sleep(self.args['watch'])
+        except KeyboardInterrupt:
+            print('Stopped watching lab "%s"' % name)
+
+    def _info_nodes(self, db):
+        """Return the nodes of the lab asked for by lab-info.
+
+        :param db: ``state.Store``
+        :return: ``dict`` of node names and their data.
+        """
+
+        name = self.args['name']
+        if name not in db.labs():
+            raise SystemExit('Lab "%s" was not found.' % name)
+        elif self.args.get('node'):
+            data = db.get_node(lab=name, name=self.args['node'])
+            if data is None:
+                raise SystemExit(
+                    'Node "%s" was not found in lab "%s".'
+                    % (self.args['node'], name)
+                )
+            return {self.args['node']: data}
+        else:
+            return db.nodes(lab=name, role=self.args.get('role'))
 
     def scuttle_lab(self):
+        """Delete the servers and the network of a lab and forget the lab.
+
+        Servers named after the lab which are not in the local DB, such as
+        those created just before a crash, are deleted as well when they are
+        named as a node or a multi-create of the lab. Any other such server
+        is only deleted with "unrecorded", otherwise the lab is kept.
+
+        The lab is only removed from the local DB once all of its servers
+        are gone, servers which could not be deleted are kept so that the
+        scuttle can be run again.
+        """
+
+        self._load_client()
+
+        name = self.args['name']
+        prefix = '%s_' % name
         with utils.IndicatorThread(debug=self.args.get('debug')):
-            servers = [
+            with sk.Database(file_path=self.args['db_path']) as db:
+                nodes = db.nodes(lab=name)
+                stems = db.get_value(lab=name, key='bulk_stems', default=[])
+                # Labs whose names start with this one own their servers.
+                others = tuple(['%s_' % lab for lab in db.labs()
+                                if lab != name and lab.startswith(prefix)])
+
+            # Bulk created servers are named by Nova, match them by ID.
+            listing = dict([
                 (server.id, server.name)
-                for server in sm.client_list(self.client)
-                if server.name.startswith(self.args['name'])
-            ]
+                for server in sm.client_list(
+                    self.client, search_opts={'name': prefix}
+                )
+                if server.name.startswith(prefix) and
+                not server.name.startswith(others)
+            ])
+            servers = dict([(node['id'], node_name)
+                            for node_name, node in nodes.items()
+                            if node.get('id') in listing])
+
+            # Servers of the lab which never made it into the DB.
+            unrecorded = []
+            for sid, server_name in listing.items():
+                if sid in servers:
+                    continue
+                elif (self.args.get('unrecorded') is True or
+                        state.node_role(lab=name, name=server_name) or
+                        server_name.startswith(tuple(stems))):
+                    servers[sid] = server_name
+                else:
+                    unrecorded.append(server_name)
+
+            print('Deleting "%s" servers' % len(servers))
+            with metrics.span('scuttle', lab=name):
+                remaining = sm.scuttle_servers(
+                    client=self.client,
+                    args=self.args,
+                    server_ids=sorted(servers)
+                )
+
+            if remaining:
+                with sk.Database(file_path=self.args['db_path']) as db:
+                    with db.transaction():
+                        for sid, node_name in servers.items():
+                            if sid not in remaining:
+                                db.delete_node(lab=name, name=node_name)
+
+                raise sk.DeploymentFailure(
+                    'Servers were not deleted: %s' % ', '.join(
+                        sorted([servers[sid] for sid in remaining])
+                    )
+                )
+
+            if unrecorded:
+                raise sk.DeploymentFailure(
+                    'Lab "%s" has servers which are not in the local DB: %s.'
+                    ' Run the scuttle again with "--unrecorded" to delete'
+                    ' them.' % (name, ', '.join(sorted(unrecorded)))
+                )
+
+            lab_catalog = catalog.Catalog(
+                client=self.client, db_path=self.args['db_path']
+            )
+            networks = [net for net in lab_catalog.networks()
+                        if net['label'] == name]
+            for net in networks:
+                print('Deleting the network "%s"' % net['id'])
+                sm.client_network_delete(self.client, net_id=net['id'])
+            if networks:
+                lab_catalog.invalidate(kind='networks')
 
-            with sk.Shelve(file_path=self.args['db_path']) as db:
-                for server in servers:
-                    if self.args['name'] in db:
-                        lab_db = db[self.args['name']]
-                        if lab_db.get(server[1]) is not None:
-                            del lab_db[server[1]]
-                            sm.client_delete(self.client, server_id=server[0])
+            with sk.Database(file_path=self.args['db_path']) as db:
+                db.delete_lab(lab=name)
+            print('Lab "%s" has been scuttled' % name)
 
 
 if __name__ == '__main__':
@@ -67,7 +67,6 @@ RABBITMQPATH="releases/rabbitmq-server/v3.1.5/rabbitmq-server_3.1.5-1_all.deb"
 RABBITMQ="${RABBIT_URL}/${RABBITMQPATH}"
 wget -O /tmp/rabbitmq.deb ${RABBITMQ}
 dpkg -i /tmp/rabbitmq.deb
-rabbit_setup
 
 CHEF="https://www.opscode.com/chef/download-server?p=ubuntu&pv=12.04&m=x86_64"
 CHEF_SERVER_PACKAGE_URL=${CHEF}
@@ -75,6 +74,46 @@ wget -O /tmp/chef_server.deb ${CHEF_SERVER_PACKAGE_URL}
 dpkg -i /tmp/chef_server.deb
 """
 
+ARTIFACT_UNPACK = """
+if [ -d "/opt/skylab-artifacts" ];then
+    rm -rf /opt/skylab-artifacts
+fi
+tar xzf %(artifact_remote)s -C /opt
+"""
+
+ARTIFACT_APT_PACKAGES = """
+apt-get update
+DEPS="python-dev python-pip git erlang erlang-nox erlang-dev curl lvm2"
+apt-get install -y ${DEPS}
+DEBS="/opt/skylab-artifacts/debs"
+
+apt-key add ${DEBS}/rabbitmq.asc
+dpkg -i ${DEBS}/rabbitmq.deb
+
+dpkg -i ${DEBS}/chef_server.deb
+"""
+
+BAKE_APT_DEPS = """
+apt-get update
+DEPS="python-dev python-pip git erlang erlang-nox erlang-dev curl lvm2"
+apt-get install -y ${DEPS}
+"""
+
+BAKE_CLEANUP = """
+swapoff -a
+apt-get clean
+rm -f /tmp/skylab-artifacts.tar.gz
+"""
+
+BAKED_APT_PACKAGES = """
+DEBS="/opt/skylab-artifacts/debs"
+
+apt-key add ${DEBS}/rabbitmq.asc
+dpkg -i ${DEBS}/rabbitmq.deb
+
+dpkg -i ${DEBS}/chef_server.deb
+"""
+
 SWAP_SCRIPT = """
 #!/usr/bin/env bash
 SWAPPINESS=$(sysctl -a | grep vm.swappiness | awk -F' = ' '{print $2}')
@@ -85,8 +124,12 @@ fi
 
 if [ ! "$(swapon -s | grep -v Filename)" ];then
   SWAPFILE="/SwapFile"
+  # Reuse a swap file which is already there, IE from a baked image.
   if [ -f "${SWAPFILE}" ];then
-    swapoff -a
+    chmod 600 ${SWAPFILE}
+    if swapon ${SWAPFILE};then
+      exit 0
+    fi
     rm ${SWAPFILE}
   fi
   dd if=/dev/zero of=${SWAPFILE} bs=1M count=1024
@@ -182,6 +225,20 @@ knife role from file /opt/chef-cookbooks/roles/*.rb
 popd
 """
 
+ARTIFACT_COOKBOOK_UPLOAD = """
+if [ -d "/opt/chef-cookbooks" ];then
+    rm -rf /opt/chef-cookbooks
+fi
+
+cp -a /opt/skylab-artifacts/chef-cookbooks /opt/chef-cookbooks
+pushd /opt/chef-cookbooks
+
+# Upload all of the RCBOPS Cookbooks
+knife cookbook upload -o /opt/chef-cookbooks/cookbooks -a
+knife role from file /opt/chef-cookbooks/roles/*.rb
+popd
+"""
+
 
 ENVIRONMENT = """
 {
@@ -358,3 +415,31 @@ chef-client -j %(first_bt_json)s \
             -E %(chef_env)s \
             -L /var/log/chef-client.log
 """
+
+HOST_NAMES = """
+hostname
+hostname -f 2> /dev/null || hostname
+"""
+
+DRAIN_COMPUTE = """
+COMPUTE_HOST="%(compute_name)s"
+COMPUTE_FQDN="%(compute_fqdn)s"
+NOVA_HOST=$(nova-manage service list 2> /dev/null | \\
+    awk -v host="${COMPUTE_HOST}" -v fqdn="${COMPUTE_FQDN}" \\
+    '$1 == "nova-compute" && ($2 == host || $2 == fqdn) {print $2; exit}')
+if [ -z "${NOVA_HOST}" ];then
+    echo "nova-compute was not found on host ${COMPUTE_HOST}"
+    exit 1
+fi
+nova-manage service disable --host=${NOVA_HOST} --service=nova-compute
+
+# Chef names a node by its FQDN unless it was told otherwise.
+for CHEF_NAME in ${COMPUTE_FQDN} ${COMPUTE_HOST};do
+    if knife node show ${CHEF_NAME} > /dev/null 2>&1;then
+        knife node delete ${CHEF_NAME} -y
+    fi
+    if knife client show ${CHEF_NAME} > /dev/null 2>&1;then
+        knife client delete ${CHEF_NAME} -y
+    fi
+done
+"""
@@ -0,0 +1,94 @@
+# =============================================================================
+# Copyright [2013] [cloudnull]
+# License Information :
+# This software has no warranty, it is provided 'as is'. It is your
+# responsibility to validate the behavior of the routines and its accuracy
+# using the code provided. Consult the GNU General Public license for further
+# details (see GNU General Public License).
+# http://www.gnu.org/licenses/gpl.html
+# =============================================================================
+
+import copy
+import json
+import os
+
+from skylab import arguments
+from skylab import osclients
+
+
+# Options of a lab in a manifest which are not build-lab options.
+LAB_OPTIONS = ('region',)
+
+# build-lab options which are set by the fleet itself.
+FLEET_OPTIONS = ('name', 'method')
+
+
+def load_manifest(manifest, args):
+    """Return the arguments of every lab in a fleet manifest.
+
+    The manifest is a JSON object with a "labs" object of lab names and
+    their options. Options are the build-lab options written with
+    underscores, IE "node_count", and "region". Options in a "defaults"
+    object apply to every lab and options which are not set use the
+    build-lab defaults.
+
+    Example:
+        {"defaults": {"node_count": 4},
+         "labs": {"ci1": {}, "ci2": {"region": "ord", "compute_ram": 4096}}}
+
+    :param manifest: Full path to the manifest.
+    :param args: ``dict`` parsed cli arguments of the fleet.
+    :return: ``list`` of ``dict`` lab arguments, in lab name order.
+    """
+
+    try:
+        with open(os.path.expanduser(manifest), 'rb') as mfile:
+            data = json.load(mfile)
+    except (IOError, ValueError) as exc:
+        raise SystemExit(
+            'The fleet manifest "%s" could not be loaded: %s' % (manifest, exc)
+        )
+
+    labs = data.get('labs')
+    if not isinstance(labs, dict) or not labs:
+        raise SystemExit('The fleet manifest "%s" has no labs.' % manifest)
+
+    build_defaults = arguments.command_defaults(command='build-lab')
+    fleet = []
+    for name in sorted(labs):
+        options = dict(data.get('defaults') or {})
+        options.update(labs[name] or {})
+        unknown = [key for key in options
+                   if key in FLEET_OPTIONS or
+                   (key not in build_defaults and key not in LAB_OPTIONS)]
+        if unknown:
+            raise SystemExit(
+                'Lab "%s" has unknown options: %s'
+                % (name, ', '.join(sorted(unknown)))
+            )
+
+        lab_args = copy.deepcopy(args)
+        lab_args.update(build_defaults)
+        lab_args.update([(str(key), value) for key, value in options.items()])
+        lab_args['name'] = str(name)
+
+        regions = osclients.regions(region=lab_args['region'])
+        if len(regions) != 1:
+            raise SystemExit(
+                'Lab "%s" has to be built in a single region.' % name
+            )
+        lab_args['region'] = str(regions[0])
+        fleet.append(lab_args)
+
+    return fleet
+
+
+def worker_share(workers, labs):
+    """Return the workers each lab gets from the workers of the fleet.
+
+    :param workers: Number of workers for the whole fleet.
+    :param labs: Number of labs worked on at once.
+    :return: ``int``
+    """
+
+    return max(1, workers // max(1, labs))
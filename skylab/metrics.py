@@ -0,0 +1,264 @@
+# =============================================================================
+# Copyright [2013] [cloudnull]
+# License Information :
+# This software has no warranty, it is provided 'as is'. It is your
+# responsibility to validate the behavior of the routines and its accuracy
+# using the code provided. Consult the GNU General Public license for further
+# details (see GNU General Public License).
+# http://www.gnu.org/licenses/gpl.html
+# =============================================================================
+
+import contextlib
+import json
+import os
+import re
+import socket
+import tempfile
+import time
+
+
+# The recorder of this run, inherited by forked worker processes.
+_RECORDER = None
+
+
+class Recorder(object):
+    """Collect timing spans and counters from every process of a run.
+
+    Events are appended one line at a time to a shared file, which is safe
+    for the forked lanes and worker processes to write to at the same time,
+    and are aggregated into a report once the run is over.
+    """
+
+    def __init__(self, events_path):
+        """Open the event file.
+
+        :param events_path: Full path to the file events are written to.
+        """
+
+        self.events_path = events_path
+        self.fd = os.open(
+            events_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600
+        )
+
+    def write(self, event):
+        os.write(self.fd, json.dumps(event) + '\n')
+
+    def close(self):
+        os.close(self.fd)
+
+    def events(self):
+        with open(self.events_path, 'rb') as events:
+            return [json.loads(line) for line in events if line.strip()]
+
+
+def configure(events_path=None):
+    """Start recording metrics for this process and its children.
+
+    :param events_path: Full path to the event file, a temp file if not set.
+    """
+
+    global _RECORDER
+    if events_path is None:
+        fd, events_path = tempfile.mkstemp(prefix='skylab-metrics-')
+        os.close(fd)
+    _RECORDER = Recorder(events_path=events_path)
+    return _RECORDER
+
+
+@contextlib.contextmanager
+def span(name, **tags):
+    """Time the block within, recording whether it raised.
+
+    :param name: Name of the span, IE "auth".
+    :param tags: Extra values saved with the span, IE host="10.0.0.1".
+    """
+
+    start = time.time()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        if _RECORDER is not None:
+            _RECORDER.write({'type': 'span',
+                             'name': name,
+                             'tags': tags,
+                             'start': start,
+                             'duration': time.time() - start,
+                             'ok': ok})
+
+
+def incr(name, value=1, **tags):
+    """Add to a counter.
+
+    :param name: Name of the counter, IE "api.calls".
+    :param value: Amount added to the counter.
+    :param tags: Extra values saved with the count.
+    """
+
+    if _RECORDER is not None:
+        _RECORDER.write(
+            {'type': 'count', 'name': name, 'tags': tags, 'value': value}
+        )
+
+
+def report():
+    """Return the aggregated report of everything recorded so far.
+
+    :return: ``dict`` of spans and counters.
+    """
+
+    spans = {}
+    counters = {}
+    steps = []
+    if _RECORDER is None:
+        return {'spans': spans, 'counters': counters, 'steps': steps}
+
+    for event in _RECORDER.events():
+        if event['type'] == 'count':
+            counters[event['name']] = (
+                counters.get(event['name'], 0) + event['value']
+            )
+            continue
+
+        agg = spans.setdefault(
+            event['name'],
+            {'count': 0, 'failed': 0, 'seconds': 0.0, 'max': 0.0}
+        )
+        agg['count'] += 1
+        agg['seconds'] += event['duration']
+        agg['max'] = max(agg['max'], event['duration'])
+        if not event['ok']:
+            agg['failed'] += 1
+        if event['name'] == 'step':
+            steps.append(dict(event['tags'],
+                              duration=round(event['duration'], 3),
+                              ok=event['ok']))
+
+    for agg in spans.values():
+        agg['seconds'] = round(agg['seconds'], 3)
+        agg['max'] = round(agg['max'], 3)
+
+    return {'spans': spans, 'counters': counters, 'steps': steps}
+
+
+def _metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+def send_statsd(data, address, prefix='skylab'):
+    """Send the spans and counters of a report to StatsD over UDP.
+
+    :param data: ``dict`` report from ``report``.
+    :param address: StatsD "host:port".
+    :param prefix: Prefix of every metric name.
+    """
+
+    host, _, port = address.partition(':')
+    lines = []
+    for name, agg in sorted(data['spans'].items()):
+        lines.append('%s.%s.seconds:%d|ms'
+                     % (prefix, name, agg['seconds'] * 1000))
+        lines.append('%s.%s.count:%d|c' % (prefix, name, agg['count']))
+        lines.append('%s.%s.failed:%d|c' % (prefix, name, agg['failed']))
+    for name, value in sorted(data['counters'].items()):
+        lines.append('%s.%s:%d|c' % (prefix, name, value))
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for line in lines:
+            sock.sendto(line, (host, int(port or 8125)))
+    finally:
+        sock.close()
+
+
+def write_textfile(data, path, labels=None):
+    """Write the spans and counters of a report as a Prometheus textfile.
+
+    The file is written next to its final path and renamed into place, so
+    the node exporter never reads a partial file.
+
+    :param data: ``dict`` report from ``report``.
+    :param path: Full path to the ".prom" file.
+    :param labels: ``dict`` of labels added to every metric.
+    """
+
+    def _labels(**extra):
+        merged = dict(labels or {}, **extra)
+        return ','.join(['%s="%s"' % (key, merged[key])
+                         for key in sorted(merged)])
+
+    lines = [
+        '# TYPE skylab_span_seconds_total counter',
+        '# TYPE skylab_span_count_total counter',
+        '# TYPE skylab_span_failed_total counter',
+        '# TYPE skylab_span_max_seconds gauge'
+    ]
+    for name, agg in sorted(data['spans'].items()):
+        tags = _labels(span=name)
+        lines.append('skylab_span_seconds_total{%s} %s'
+                     % (tags, agg['seconds']))
+        lines.append('skylab_span_count_total{%s} %s' % (tags, agg['count']))
+        lines.append('skylab_span_failed_total{%s} %s'
+                     % (tags, agg['failed']))
+        lines.append('skylab_span_max_seconds{%s} %s' % (tags, agg['max']))
+
+    for name, value in sorted(data['counters'].items()):
+        metric = 'skylab_%s_total' % _metric_name(name)
+        lines.append('# TYPE %s counter' % metric)
+        lines.append('%s{%s} %s' % (metric, _labels(), value))
+
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'wb') as prom:
+        prom.write('\n'.join(lines) + '\n')
+    os.rename(temp_path, path)
+
+
+def export(args):
+    """Write the report of the run and send it to the configured sinks.
+
+    :param args: ``dict`` parsed cli arguments.
+    :return: ``dict`` the report.
+    """
+
+    global _RECORDER
+    if _RECORDER is None:
+        return
+
+    data = report()
+    data['lab'] = args.get('name')
+    data['method'] = args.get('method')
+
+    metrics_file = args.get('metrics_file')
+    if metrics_file is None and args.get('log_path'):
+        metrics_file = os.path.join(
+            os.path.expanduser(args['log_path']),
+            args.get('name') or args['method'],
+            'metrics.json'
+        )
+
+    if metrics_file and (data['spans'] or data['counters']):
+        metrics_file = os.path.expanduser(metrics_file)
+        metrics_dir = os.path.dirname(metrics_file)
+        if metrics_dir and not os.path.isdir(metrics_dir):
+            os.makedirs(metrics_dir)
+        with open(metrics_file, 'wb') as mfile:
+            json.dump(data, mfile, indent=4)
+
+    if args.get('statsd'):
+        try:
+            send_statsd(data=data, address=args['statsd'])
+        except (socket.error, ValueError) as exc:
+            print('Metrics were not sent to StatsD: %s' % exc)
+
+    if args.get('prom_textfile'):
+        write_textfile(
+            data=data,
+            path=os.path.expanduser(args['prom_textfile']),
+            labels={'lab': args.get('name'), 'method': args.get('method')}
+        )
+
+    _RECORDER.close()
+    os.remove(_RECORDER.events_path)
+    _RECORDER = None
+    return data
@@ -9,11 +9,17 @@
 # =============================================================================
 
 
+import calendar
+import hashlib
 import logging
+import re
+import time
 
 from novaclient.v1_1 import client as nova_client
 from novaclient import shell
 
+import skylab as sk
+
 
 LOG = logging.getLogger(__name__)
 
@@ -22,14 +28,57 @@ class MissingCredentials(Exception):
     pass
 
 
+# Seconds before expiry at which a cached token is refreshed.
+TOKEN_REFRESH_MARGIN = 300
+
+
+class _CachedResponse(object):
+    """Stands in for the auth response when a cached token is used."""
+
+    status_code = 200
+
+
+def token_expires(expires):
+    """Return an ISO 8601 token expiry as a unix timestamp, or None.
+
+    :param expires: Expiry, IE "2013-12-22T10:30:00.000-06:00"
+    """
+
+    match = re.match(
+        r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.\d+)?'
+        r'(Z|([+-])(\d{2}):?(\d{2}))?$',
+        expires or ''
+    )
+    if match is None:
+        return None
+
+    stamp = calendar.timegm(
+        time.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S')
+    )
+    if match.group(3) is not None:
+        offset = int(match.group(4)) * 3600 + int(match.group(5)) * 60
+        if match.group(3) == '+':
+            stamp -= offset
+        else:
+            stamp += offset
+    return stamp
+
+
 class AuthPlugin(object):
-    def __init__(self, password=False, key=False):
-        """Craetes an authentication plugin for use with Rackspace."""
+    def __init__(self, password=False, key=False, cache_path=None):
+        """Craetes an authentication plugin for use with Rackspace.
+
+        :param password: Authenticate with a password.
+        :param key: Authenticate with an API key.
+        :param cache_path: Full path to the state DB used to cache tokens.
+        """
 
         self.user_password = password
         self.user_key = key
         print self.user_password, self.user_key
         self.auth_url = self.global_auth()
+        self.cache_path = cache_path
+        self.cache_used = False
 
     def global_auth(self):
         """Return the Rackspace Cloud US Auth URL."""
@@ -66,7 +115,51 @@ class AuthPlugin(object):
         else:
             raise MissingCredentials('No Key or Password was provided.')
 
-        return cls._authenticate(auth_url, body)
+        if self.cache_path is None:
+            return cls._authenticate(auth_url, body)
+        else:
+            return self._cached_authenticate(cls, auth_url, body)
+
+    def _cache_key(self, cls, auth_url):
+        """Return the token cache key for a set of credentials."""
+
+        return hashlib.sha1(
+            '\0'.join([auth_url, cls.user, cls.projectid or '', cls.password])
+        ).hexdigest()
+
+    def _cached_authenticate(self, cls, auth_url, body):
+        """Authenticate using a cached token when one is still valid.
+
+        The token and service catalog are kept in the state DB, shared with
+        every process, until shortly before they expire. A cached token is
+        only used once per plugin, if the client authenticates again the
+        token was rejected and a new one is requested.
+        """
+
+        key = self._cache_key(cls, auth_url)
+        if self.cache_used is False:
+            self.cache_used = True
+            with sk.Database(file_path=self.cache_path) as db:
+                cached = db.get_token(key=key, margin=TOKEN_REFRESH_MARGIN)
+
+            if cached is not None:
+                LOG.debug('Using the cached token for "%s"' % cls.user)
+                return cls._extract_service_catalog(
+                    auth_url, _CachedResponse(), cached
+                )
+
+        resp, resp_body = cls._time_request(
+            auth_url + '/tokens', 'POST', body=body, allow_redirects=True
+        )
+        if resp.status_code in (200, 201):
+            expires = token_expires(
+                resp_body.get('access', {}).get('token', {}).get('expires')
+            )
+            if expires is not None:
+                with sk.Database(file_path=self.cache_path) as db:
+                    db.put_token(key=key, data=resp_body, expires=expires)
+
+        return cls._extract_service_catalog(auth_url, resp, resp_body)
 
     def authenticate(self, cls, auth_url):
         """Authenticate against the Rackspace US auth service."""
@@ -74,11 +167,29 @@ class AuthPlugin(object):
         return self._authenticate(cls, auth_url)
 
 
+def regions(region):
+    """Return the list of regions from a comma separated string.
+
+    :param region: Region names, IE "dfw, ord"
+    :return: ``list`` of upper cased, unique, region names.
+    """
+
+    names = []
+    for name in region.split(','):
+        name = name.strip().upper()
+        if name and name not in names:
+            names.append(name)
+
+    if not names:
+        raise MissingCredentials('No Region was provided.')
+    return names
+
+
 class Creds(object):
     """Load Rackspace Credentials."""
 
     def __init__(self, user, region, key=None, password=None, tenant=None,
-                 project_id=None, system='rackspace'):
+                 project_id=None, system='rackspace', cache_path=None):
 
         if any([key is not None, password is not None]):
             self.username = user
@@ -93,9 +204,11 @@ class Creds(object):
             self.region_name = region.upper()
             self.auth_system = system
             if self.password is not None:
-                self.auth_plugin = AuthPlugin(password=True)
+                self.auth_plugin = AuthPlugin(
+                    password=True, cache_path=cache_path
+                )
             elif self.api_key is not None:
-                self.auth_plugin = AuthPlugin(key=True)
+                self.auth_plugin = AuthPlugin(key=True, cache_path=cache_path)
         else:
             raise MissingCredentials('No Key or Password was provided.')
 
@@ -0,0 +1,283 @@
+# =============================================================================
+# Copyright [2013] [cloudnull]
+# License Information :
+# This software has no warranty, it is provided 'as is'. It is your
+# responsibility to validate the behavior of the routines and its accuracy
+# using the code provided. Consult the GNU General Public license for further
+# details (see GNU General Public License).
+# http://www.gnu.org/licenses/gpl.html
+# =============================================================================
+
+import time
+
+import skylab as sk
+from skylab import metrics
+
+
+# Absolute limit names of every resource, the maximum and the amount used.
+LIMITS = {
+    'ram': ('maxTotalRAMSize', 'totalRAMUsed'),
+    'instances': ('maxTotalInstances', 'totalInstancesUsed'),
+    'cores': ('maxTotalCores', 'totalCoresUsed'),
+    'networks': ('maxTotalPrivateNetworks', 'totalPrivateNetworksUsed')
+}
+
+# Seconds a reservation is held for if the build never releases it.
+RESERVATION_TTL = 3600
+
+
+def flavor_vcpus(catalog, flavor_id):
+    """Return the number of cores of a flavor.
+
+    :param catalog: ``catalog.Catalog`` for the nova client
+    :param flavor_id: ID of the flavor.
+    :return: ``int``
+    """
+
+    for flv in catalog.flavors():
+        if flv['id'] == flavor_id:
+            return flv['vcpus']
+    return 0
+
+
+def lab_spec(catalog, args, controller_flavor, compute_flavor):
+    """Return the size of the nodes of a lab and the networks it creates.
+
+    :param catalog: ``catalog.Catalog`` for the nova client
+    :param args: ``dict`` arguments of the lab.
+    :param controller_flavor: ID of the controller flavor.
+    :param compute_flavor: ID of the compute flavor.
+    :return: ``dict``
+    """
+
+    # Only a lab network which does not exist yet is created.
+    networks = 0
+    if args.get('net_id') is None:
+        if not [net for net in catalog.networks()
+                if net['label'] == args['name']]:
+            networks = 1
+
+    return {
+        'controller_ram': args['controller_ram'],
+        'compute_ram': args['compute_ram'],
+        'controller_vcpus': flavor_vcpus(
+            catalog=catalog, flavor_id=controller_flavor
+        ),
+        'compute_vcpus': flavor_vcpus(
+            catalog=catalog, flavor_id=compute_flavor
+        ),
+        'networks': networks
+    }
+
+
+def footprint(spec, node_count):
+    """Return the resources used by a whole lab.
+
+    :param spec: ``dict`` from ``lab_spec``.
+    :param node_count: Number of servers in the lab.
+    :return: ``dict`` of resources and amounts.
+    """
+
+    computes = max(0, node_count - 2)
+    return {
+        'ram': spec['controller_ram'] * 2 + spec['compute_ram'] * computes,
+        'instances': node_count,
+        'cores': (spec['controller_vcpus'] * 2 +
+                  spec['compute_vcpus'] * computes),
+        'networks': spec['networks']
+    }
+
+
+def compute_footprint(spec, computes):
+    """Return the resources used by compute nodes added to a lab.
+
+    :param spec: ``dict`` with the "compute_ram" and "compute_vcpus".
+    :param computes: Number of compute nodes.
+    :return: ``dict`` of resources and amounts.
+    """
+
+    return {
+        'ram': spec['compute_ram'] * computes,
+        'instances': computes,
+        'cores': spec['compute_vcpus'] * computes,
+        'networks': 0
+    }
+
+
+def add(*footprints):
+    """Return the sum of several footprints."""
+
+    total = dict([(resource, 0) for resource in LIMITS])
+    for need in footprints:
+        for resource in LIMITS:
+            total[resource] += need.get(resource, 0)
+    return total
+
+
+def absolute_limits(client, tenant_id):
+    """Return the absolute limits of the account.
+
+    :param client: Authenticated Nova Client
+    :param tenant_id: tenant id for the user
+    :return: ``dict``
+    """
+
+    metrics.incr('api.calls', call='limits.get')
+    limits = client.limits.get(tenant_id=tenant_id)._info
+    absolute = limits.get('absolute')
+    if absolute is None:
+        raise sk.LimitsUnavailable('No Limits Found.')
+    return absolute
+
+
+def remaining(absolute, reserved=None):
+    """Return what is left of every resource.
+
+    A maximum of -1, or a missing maximum, is unlimited and is returned as
+    None.
+
+    :param absolute: ``dict`` absolute limits of the account.
+    :param reserved: ``dict`` footprint held by other builds.
+    :return: ``dict`` of resources and amounts.
+    """
+
+    left = {}
+    for resource, (max_key, used_key) in LIMITS.items():
+        maximum = absolute.get(max_key)
+        if maximum is None or maximum < 0:
+            left[resource] = None
+        else:
+            left[resource] = (maximum - absolute.get(used_key, 0) -
+                              (reserved or {}).get(resource, 0))
+    return left
+
+
+def shortfalls(left, need):
+    """Return every resource that a footprint needs more of than is left.
+
+    :return: ``dict`` of resources and the amount missing.
+    """
+
+    short = {}
+    for resource, amount in need.items():
+        if left.get(resource) is not None and amount > left[resource]:
+            short[resource] = amount - left[resource]
+    return short
+
+
+def nodes_fit(left, spec):
+    """Return the largest node count of a lab that fits, None if unlimited.
+
+    :param left: ``dict`` remaining resources.
+    :param spec: ``dict`` from ``lab_spec``.
+    :return: ``int``
+    """
+
+    base = footprint(spec=spec, node_count=2)
+    if shortfalls(left=left, need=base):
+        return 0
+
+    per_node = {
+        'ram': spec['compute_ram'],
+        'instances': 1,
+        'cores': spec['compute_vcpus']
+    }
+    computes = None
+    for resource, amount in per_node.items():
+        if left[resource] is not None and amount > 0:
+            fit = (left[resource] - base[resource]) // amount
+            computes = fit if computes is None else min(computes, fit)
+
+    if computes is not None:
+        return 2 + computes
+
+
+class Planner(object):
+    """Admit builds against the absolute limits of the account.
+
+    A build reserves its whole footprint in the state DB, so that builds
+    which run at the same time, such as the labs of a fleet, are checked
+    against each other as well as against what the account already uses.
+    The reservation is released once the nodes exist, as the limits then
+    count them as used.
+    """
+
+    def __init__(self, client, db_path):
+        """Load the planner.
+
+        :param client: Authenticated Nova Client
+        :param db_path: Full path to the state DB.
+        """
+
+        self.client = client
+        self.db_path = db_path
+        self.region = client.client.region_name
+        self.endpoint = client.client.management_url
+
+    def plan(self, need, lab=None):
+        """Return what is left for a footprint and what it is short of.
+
+        :param need: ``dict`` footprint of the build.
+        :param lab: Name of the lab, its own reservation is not counted.
+        :return: ``dict``
+        """
+
+        absolute = absolute_limits(
+            client=self.client, tenant_id=self.client.client.tenant_id
+        )
+        with sk.Database(file_path=self.db_path) as db:
+            reserved = db.reservations(
+                region=self.region, endpoint=self.endpoint, exclude=lab
+            )
+        return self._plan(absolute=absolute, reserved=reserved, need=need)
+
+    def _plan(self, absolute, reserved, need):
+        left = remaining(absolute=absolute, reserved=add(*reserved))
+        return {'need': need,
+                'left': left,
+                'short': shortfalls(left=left, need=need)}
+
+    def admit(self, lab, need):
+        """Reserve the footprint of a build, or fail if it does not fit.
+
+        The check and the reservation are one transaction, so two builds
+        can never both be admitted into the same capacity.
+
+        :param lab: Name of the lab.
+        :param need: ``dict`` footprint of the build.
+        :return: ``dict`` the plan of the build.
+        """
+
+        absolute = absolute_limits(
+            client=self.client, tenant_id=self.client.client.tenant_id
+        )
+        with sk.Database(file_path=self.db_path) as db:
+            with db.transaction():
+                reserved = db.reservations(
+                    region=self.region, endpoint=self.endpoint, exclude=lab
+                )
+                plan = self._plan(
+                    absolute=absolute, reserved=reserved, need=need
+                )
+                if not plan['short']:
+                    db.put_reservation(
+                        lab=lab,
+                        region=self.region,
+                        endpoint=self.endpoint,
+                        need=need,
+                        expires=time.time() + RESERVATION_TTL
+                    )
+        return plan
+
+    def release(self, lab):
+        """Drop the reservation of a build."""
+
+        with sk.Database(file_path=self.db_path) as db:
+            db.delete_reservation(lab=lab)
+
+
+def describe(short):
+    """Return a printable string of the resources a build is short of."""
+
+    return ', '.join(['%s by %s' % (resource, short[resource])
+                      for resource in sorted(short)])
@@ -0,0 +1,156 @@
+# =============================================================================
+# Copyright [2013] [cloudnull]
+# License Information :
+# This software has no warranty, it is provided 'as is'. It is your
+# responsibility to validate the behavior of the routines and its accuracy
+# using the code provided. Consult the GNU General Public license for further
+# details (see GNU General Public License).
+# http://www.gnu.org/licenses/gpl.html
+# =============================================================================
+
+import StringIO
+import csv
+import json
+
+import prettytable
+
+from skylab import state
+
+
+# Lab values which hold keys and passwords. They are not read from the state
+# DB unless they are asked for.
+SECRET_VALUES = ('admin_pem', 'chef_validator_pem', 'erlang_cookie',
+                 'rabbit_password')
+
+# Shown in place of a secret.
+HIDDEN = '<hidden>'
+
+# Fields shown by lab-info when none are asked for.
+DEFAULT_FIELDS = ('id', 'name', 'lab_address', 'public_net')
+
+# Output formats of the lab-info and db-show commands.
+FORMATS = ('table', 'json', 'csv')
+
+
+def _addr(data, net_name):
+    """Return the IPv4 address of a server on a network, or None."""
+
+    for addr in (data.get('addresses') or {}).get(net_name) or []:
+        if addr.get('version') == 4:
+            return addr.get('addr')
+
+
+def _flavor(data):
+    return (data.get('flavor') or {}).get('id')
+
+
+def _image(data):
+    return (data.get('image') or {}).get('id')
+
+
+# Every field of a node row and how it is read from the node data. Fields
+# are only worked out when they are asked for.
+NODE_FIELDS = {
+    'id': lambda lab, name, data: data.get('id'),
+    'name': lambda lab, name, data: name,
+    'server_name': lambda lab, name, data: data.get('name'),
+    'role': lambda lab, name, data: state.node_role(lab=lab, name=name),
+    'status': lambda lab, name, data: data.get('status'),
+    'lab_address': lambda lab, name, data: _addr(data=data, net_name=lab),
+    'public_net': lambda lab, name, data: _addr(data=data, net_name='public'),
+    'private_net': lambda lab, name, data: _addr(
+        data=data, net_name='private'
+    ),
+    'flavor': lambda lab, name, data: _flavor(data=data),
+    'image': lambda lab, name, data: _image(data=data),
+    'created': lambda lab, name, data: data.get('created')
+}
+
+
+def parse_fields(fields):
+    """Return the node fields asked for on the command line.
+
+    :param fields: Comma separated field names, the defaults if not set.
+    :return: ``list``
+    """
+
+    if not fields:
+        return list(DEFAULT_FIELDS)
+
+    names = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in names if field not in NODE_FIELDS]
+    if unknown:
+        raise SystemExit(
+            'Unknown fields: %s. The fields are: %s'
+            % (', '.join(unknown), ', '.join(sorted(NODE_FIELDS)))
+        )
+    return names
+
+
+def node_rows(lab, nodes, fields):
+    """Return one row for every node, with only the fields asked for.
+
+    :param lab: Name of the lab.
+    :param nodes: ``dict`` of node names and their data.
+    :param fields: ``list`` of field names.
+    :return: ``list`` of ``dict`` rows in node name order.
+    """
+
+    return [
+        dict([(field, NODE_FIELDS[field](lab, name, nodes[name]))
+              for field in fields])
+        for name in sorted(nodes)
+    ]
+
+
+def hide_secrets(values, keys):
+    """Mark the secrets which were not read from the state DB as hidden.
+
+    The admin password saved with the build arguments is hidden as well.
+
+    :param values: ``dict`` of lab values read without the secrets.
+    :param keys: Names of every value of the lab.
+    :return: ``dict``
+    """
+
+    values = dict(values)
+    for key in keys:
+        if key in SECRET_VALUES:
+            values[key] = HIDDEN
+
+    compute = (values.get('build_args') or {}).get('compute') or {}
+    if compute.get('admin_pass') is not None:
+        values['build_args'] = dict(values['build_args'])
+        values['build_args']['compute'] = dict(compute, admin_pass=HIDDEN)
+    return values
+
+
+def render(rows, fields, output_format='table'):
+    """Return rows formatted as a table, JSON or CSV.
+
+    :param rows: ``list`` of ``dict`` rows.
+    :param fields: ``list`` of the field names, in column order.
+    :param output_format: table|json|csv
+    :return: ``str``
+    """
+
+    if output_format == 'json':
+        return json.dumps(rows, indent=4, sort_keys=True)
+
+    elif output_format == 'csv':
+        output = StringIO.StringIO()
+        writer = csv.DictWriter(output, fieldnames=fields, lineterminator='\n')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(
+                dict([(field, '' if row.get(field) is None else row[field])
+                      for field in fields])
+            )
+        return output.getvalue().rstrip('\n')
+
+    table = prettytable.PrettyTable(fields)
+    for row in rows:
+        table.add_row([row.get(field) for field in fields])
+    for field in fields:
+        table.align[field] = 'l'
+    return str(table)
@@ -0,0 +1,428 @@
+# =============================================================================
+# Copyright [2013] [cloudnull]
+# License Information :
+# This software has no warranty, it is provided 'as is'. It is your
+# responsibility to validate the behavior of the routines and its accuracy
+# using the code provided. Consult the GNU General Public license for further
+# details (see GNU General Public License).
+# http://www.gnu.org/licenses/gpl.html
+# =============================================================================
+
+import hashlib
+import json
+import multiprocessing
+import os
+import Queue
+
+import skylab as sk
+from skylab import build_fabric as bf
+
+
+class Step(object):
+    """A single step within a build graph.
+
+    :param name: Unique name of the step within the graph.
+    :param group: Name of the target group the step is run against.
+    :param method: Engine method used for the step, run|put|put_file|get.
+    :param string_obj: Payload for the step. Either a string or a callable
+                       which is passed the build context and returns one.
+    :param requires: List of step names which have to complete first.
+    :param remote_path: Remote path used by "put" and "put_file" steps.
+    :param output: Context key that the result of a "get" step is saved as.
+    :param title: Human readable name of the step.
+    """
+
+    def __init__(self, name, group, method, string_obj, requires=None,
+                 remote_path=None, output=None, title=None):
+        self.name = name
+        self.group = group
+        self.method = method
+        self.string_obj = string_obj
+        self.requires = requires or []
+        self.remote_path = remote_path
+        self.output = output
+        self.title = title or name
+
+    def render(self, context):
+        """Return the payload of the step rendered against the context.
+
+        :param context: ``dict``
+        :return: ``str``
+        """
+
+        if callable(self.string_obj):
+            return self.string_obj(context)
+        else:
+            return self.string_obj
+
+    def action(self, context):
+        """Return the engine method and keyword arguments for the step.
+
+        :param context: ``dict``
+        :return: ``tuple``
+        """
+
+        kwargs = {'string_obj': self.render(context)}
+        if self.method == 'get':
+            kwargs['name'] = self.output
+        else:
+            kwargs['name'] = self.title
+
+        if self.method in ('put', 'put_file'):
+            kwargs['remote_path'] = self.remote_path
+
+        return self.method, kwargs
+
+
+def _task_names(tasks):
+    """Return a printable string of task names.
+
+    :param tasks: iterable of (step, host) tuples.
+    :return: ``str``
+    """
+
+    return ', '.join(['%s@%s' % task for task in sorted(tasks)])
+
+
+def _run_batch(engine, host, keys, steps, result_q):
+    """Run a batch of tasks on a host, returning the result of every task.
+
+    :param engine: ``build_fabric.Engine`` of the lane.
+    :param host: Address of the host that the lane is working on.
+    :param keys: ``list`` of the task keys of the batch, in step order.
+    :param steps: ``list`` of ``dict`` steps for ``Engine.run_batch``.
+    :param result_q: Queue that results are returned on.
+    """
+
+    reported = set()
+
+    def report(index, error):
+        reported.add(index)
+        result_q.put((keys[index], None, error))
+
+    try:
+        engine.run_batch(steps=steps, target=host, report=report)
+    except (Exception, SystemExit) as exc:
+        error = str(exc)
+    else:
+        error = 'The batch ended before the step was run'
+
+    for index, key in enumerate(keys):
+        if index not in reported:
+            result_q.put((key, None, error))
+
+
+def _lane(args, host, work_q, result_q):
+    """Run all work sent to a single host, in the order it was sent.
+
+    :param args: ``dict`` parsed cli arguments.
+    :param host: Address of the host that the lane is working on.
+    :param work_q: Queue that tasks are pulled from.
+    :param result_q: Queue that results are returned on.
+    """
+
+    engine = bf.Engine(args=args)
+    try:
+        while True:
+            task = work_q.get()
+            if task is None:
+                break
+
+            key, method, kwargs = task
+            if method == 'run_batch':
+                _run_batch(engine=engine, host=host, keys=key,
+                           result_q=result_q, **kwargs)
+                continue
+
+            try:
+                result = getattr(engine, method)(target=host, **kwargs)
+            except (Exception, SystemExit) as exc:
+                # Fabric aborts with SystemExit, trap it so the lane lives.
+                result_q.put((key, None, str(exc)))
+            else:
+                result_q.put((key, result, None))
+    finally:
+        engine.disconnect()
+
+
+class Scheduler(object):
+    """Run a graph of steps, starting every step once its inputs are ready.
+
+    Every step targets a named group of hosts and is expanded into one task
+    per host. A task which requires a step from a group that it is also a
+    member of only waits for that step on its own host, otherwise it waits
+    for the step to have completed on every host in the required group.
+
+    Every completed task is recorded in the state DB with a hash of its
+    inputs and its outputs, so that a resumed run can skip the work which
+    has already been done.
+
+    Each host is given a "lane", a worker process which runs the tasks for
+    that host one after the other, while separate hosts run in parallel. A
+    lane keeps a single pooled SSH connection to its host which is closed
+    once the graph has finished.
+
+    With the "batch_steps" argument, the "run" and "put" tasks of a host
+    which are ready, along with the tasks of that host which only wait on
+    them, are sent to the lane as one batch and run as a single script.
+    """
+
+    def __init__(self, args, steps, groups, context, resume=False):
+        """Load the build graph.
+
+        :param args: ``dict`` parsed cli arguments.
+        :param steps: ``list`` of ``Step`` objects.
+        :param groups: ``dict`` of group names and their list of hosts.
+        :param context: ``dict`` used to render steps and to store outputs.
+        :param resume: Skip steps completed by an earlier run.
+        """
+
+        self.args = args
+        self.steps = dict([(step.name, step) for step in steps])
+        self.groups = groups
+        self.context = context
+        self.resume = resume
+        self.result_q = multiprocessing.Queue()
+        self.lanes = {}
+        self.tasks = {}
+        self.hashes = {}
+        self.executed = set()
+        self.completed = {}
+        if self.resume is True:
+            with sk.Database(file_path=self.args['db_path']) as db:
+                self.completed = db.steps(lab=self.args['name'])
+
+        for step in steps:
+            for req in step.requires:
+                if req not in self.steps:
+                    raise sk.DeploymentFailure(
+                        'Step "%s" requires an unknown step "%s"'
+                        % (step.name, req)
+                    )
+
+    def _tasks(self):
+        """Return a dict of every task and the tasks that it depends on."""
+
+        tasks = {}
+        for step in self.steps.values():
+            for host in self.groups.get(step.group, []):
+                deps = tasks[(step.name, host)] = set()
+                for req in step.requires:
+                    req_hosts = self.groups.get(self.steps[req].group, [])
+                    if host in req_hosts:
+                        deps.add((req, host))
+                    else:
+                        deps.update([(req, rh) for rh in req_hosts])
+        return tasks
+
+    def _lane(self, host):
+        """Return the work queue for a host, starting its lane if needed."""
+
+        if host not in self.lanes:
+            work_q = multiprocessing.Queue()
+            job = multiprocessing.Process(
+                target=_lane, args=(self.args, host, work_q, self.result_q)
+            )
+            job.start()
+            self.lanes[host] = (job, work_q)
+        return self.lanes[host][1]
+
+    def _action(self, key):
+        """Return the engine method and keyword arguments of a task.
+
+        The hash of the inputs of the task is kept for its record. The
+        payload of a "put_file" task is a local path, so the size and
+        modification time of the file are hashed along with it.
+
+        :return: ``tuple``
+        """
+
+        method, kwargs = self.steps[key[0]].action(context=self.context)
+        inputs = [key, method, kwargs]
+        if method == 'put_file':
+            stat = os.stat(kwargs['string_obj'])
+            inputs.append([stat.st_size, stat.st_mtime])
+
+        self.hashes[key] = hashlib.sha1(
+            json.dumps(inputs, sort_keys=True)
+        ).hexdigest()
+        return method, kwargs
+
+    def _resumed(self, key, deps):
+        """Return True if an earlier run completed the task.
+
+        A task is only skipped when it was completed with the same input
+        hash and none of the tasks it depends on had to be run again.
+        """
+
+        record = self.completed.get(key)
+        if record is None or deps & self.executed:
+            return False
+
+        self._action(key=key)
+        if record['input_hash'] != self.hashes[key]:
+            return False
+
+        print('[%s] %s - Already completed'
+              % (key[1], self.steps[key[0]].title))
+        self.context.update(record['outputs'])
+        return True
+
+    def _batch(self, key, pending, done):
+        """Return a task and the tasks of its host it can be batched with.
+
+        Tasks are added, in an order which runs every task after the tasks
+        it requires, while they are on the same host, can be batched and
+        only wait on done tasks or on tasks of the batch. Batched tasks are
+        removed from pending.
+
+        :return: ``list`` of task keys.
+        """
+
+        pending.pop(key)
+        keys = [key]
+        if not self.args.get('batch_steps'):
+            return keys
+
+        def batchable(task):
+            return (task[1] == key[1] and
+                    self.steps[task[0]].method in bf.BATCH_METHODS)
+
+        if not batchable(key):
+            return keys
+
+        grown = True
+        while grown:
+            grown = False
+            for task in sorted([task for task in pending if batchable(task)]):
+                if pending[task] <= done | set(keys):
+                    pending.pop(task)
+                    keys.append(task)
+                    grown = True
+        return keys
+
+    def _dispatch(self, keys):
+        """Send a task, or a batch of tasks, to the lane of their host."""
+
+        self.executed.update(keys)
+        if len(keys) == 1:
+            method, kwargs = self._action(key=keys[0])
+            self._lane(host=keys[0][1]).put((keys[0], method, kwargs))
+            return
+
+        steps = []
+        for key in keys:
+            method, kwargs = self._action(key=key)
+            step = self.steps[key[0]]
+            steps.append({
+                'title': step.title,
+                'method': method,
+                'string_obj': kwargs['string_obj'],
+                'remote_path': kwargs.get('remote_path'),
+                'requires': [keys.index(task) for task in self.tasks[key]
+                             if task in keys]
+            })
+        self._lane(host=keys[0][1]).put((keys, 'run_batch', {'steps': steps}))
+
+    def _record(self, key, outputs):
+        """Save a completed task so that a resumed run can skip it."""
+
+        with sk.Database(file_path=self.args['db_path']) as db:
+            db.put_step(
+                lab=self.args['name'],
+                step=key[0],
+                host=key[1],
+                input_hash=self.hashes[key],
+                outputs=outputs
+            )
+
+    def _stop(self):
+        for job, work_q in self.lanes.values():
+            work_q.put(None)
+
+        for job, work_q in self.lanes.values():
+            job.join()
+
+    def _dead_lane(self, running):
+        """Return a running task whose lane has died, if any."""
+
+        for key in running:
+            job = self.lanes[key[1]][0]
+            if not job.is_alive():
+                return key
+
+    def run(self):
+        """Run the graph.
+
+        Steps which fail have all of their dependents skipped, while the
+        independent branches of the graph are still run to completion.
+
+        :return: ``dict`` the build context including step outputs.
+        """
+
+        self.tasks = self._tasks()
+        pending = dict(self.tasks)
+        running = set()
+        done = set()
+        failed = {}
+        try:
+            while pending or running:
+                skipped = True
+                while skipped:
+                    # Skipped tasks may make more tasks ready straight away.
+                    skipped = False
+                    for key in sorted(pending):
+                        if (pending[key] <= done and
+                                self._resumed(key=key, deps=pending[key])):
+                            pending.pop(key)
+                            done.add(key)
+                            skipped = True
+
+                ready = sorted(
+                    [key for key, deps in pending.items() if deps <= done]
+                )
+                for key in ready:
+                    if key in pending:
+                        keys = self._batch(key=key, pending=pending, done=done)
+                        self._dispatch(keys=keys)
+                        running.update(keys)
+
+                if not running:
+                    break
+
+                try:
+                    key, result, error = self.result_q.get(timeout=1)
+                except Queue.Empty:
+                    key = self._dead_lane(running)
+                    if key is None:
+                        continue
+                    result, error = None, 'Lane for "%s" died' % key[1]
+
+                running.discard(key)
+                if error == bf.BATCH_SKIPPED:
+                    # Reported as skipped, along with its dependents.
+                    pending[key] = self.tasks[key]
+                    continue
+                elif error is not None:
+                    failed[key] = error
+                    print('Step "%s" FAILED on "%s": %s'
+                          % (key[0], key[1], error))
+                    continue
+
+                done.add(key)
+                outputs = {}
+                step = self.steps[key[0]]
+                if step.output is not None:
+                    outputs[step.output] = self.context[step.output] = result
+                self._record(key=key, outputs=outputs)
+        finally:
+            self._stop()
+
+        if failed or pending:
+            raise sk.DeploymentFailure(
+                'Failed steps: %s. Skipped steps: %s'
+                % (_task_names(failed) or 'None',
+                   _task_names(pending) or 'None')
+            )
+
+        return self.context
@@ -9,173 +9,401 @@
 # =============================================================================
 
 import time
-import random
 import json
+import re
+import uuid
 
 import skylab as sk
 
-from skylab import fabric_strings as fs
 from skylab import build_fabric as bf
+from skylab import fabric_strings as fs
+from skylab import metrics
+from skylab import scheduler as sched
+from skylab import templates as tpl
 from skylab import utils as ut
 
 
 MAX_FAULTS = 10
 
+# Steps of construct_skylab that a baked image has already done.
+BAKED_STEPS = ('base', 'swap_script', 'controller1_chef_client', 'chef_client')
 
-def _builder(client, server_dict, queue):
-    for rty in ut.retryloop(attempts=MAX_FAULTS, delay=5):
-        instance = client_create(client, build_hash=server_dict, queue=queue)
-        if instance is None:
-            rty()
-        else:
-            return instance
+# Groups of the build graph which the compute nodes are members of.
+COMPUTE_GROUPS = ('nodes', 'agents', 'computes')
+
+# Seconds allowed for a snapshot to go ACTIVE.
+IMAGE_TIMEOUT = 1800
+
+# Seconds allowed for deleted servers to be gone.
+DELETE_TIMEOUT = 300
 
+# Seconds used by the retry loop of every client call.
+RETRY_DELAY = 1
+RETRY_MAX_DELAY = 30
+RETRY_DEADLINE = 300
 
-def bob_the_builder(client, args, target, queue):
-    """Build Instances."""
 
-    def _write_db(data):
-        if data:
-            with sk.Shelve(args['db_path']) as db:
-                db_entry = data.__dict__
-                if 'manager' in db_entry:
-                    db_entry.pop('manager')
-                db[args['name']][target['name']] = db_entry
+def bob_the_builder(client, args, target):
+    """Build Instances.
+
+    :return: ID of the instance that was created.
+    """
 
     # Build our instance
-    instance = _builder(client=client, server_dict=target, queue=queue)
-    _write_db(data=instance)
-
-    # Wait until the instance reports active
-    wait_for_active(client, target, queue, instance.id)
-    instance = client_server_get(client=client, server_id=instance.id)
-    if not instance:
-        print('The build process failed, the system will retry.')
-        _kill_server(
-            client=client,
-            server_id=instance.id,
-            server_dict=target,
-            work_queue=queue
-        )
-    else:
-        _write_db(data=instance)
+    instance = client_create(client=client, build_hash=target)
+    with sk.Database(args['db_path']) as db:
+        db.put_node(lab=args['name'], name=target['name'], data=instance._info)
 
+    return instance.id
 
-def _kill_server(client, server_id, server_dict, work_queue):
-    work_queue.put(server_dict)
-    time.sleep(1)
-    client_delete(client=client, server_id=server_id)
 
+def bulk_groups(targets):
+    """Group server dicts which only differ by name.
 
-def wait_for_active(client, server_dict, queue, sid, MAX_RETRY=100):
-    """Wait for the instance to be active.
+    :param targets: ``list`` of server dicts.
+    :return: ``list`` of lists of server dicts with identical specs.
+    """
+
+    groups = {}
+    for target in targets:
+        spec = dict([(key, value) for key, value in target.items()
+                     if key != 'name'])
+        groups.setdefault(json.dumps(spec, sort_keys=True), []).append(target)
+    return [groups[key] for key in sorted(groups)]
+
+
+def _name_order(server):
+    """Sort servers named by a multi-create by their trailing number."""
+
+    number = re.search(r'(\d+)$', server.name)
+    return int(number.group(1)) if number else 0, server.name
+
+
+def bulk_create(client, args, targets):
+    """Create identical servers with a single multi-create request.
+
+    Nova names the servers of a multi-create itself, so they are created
+    with a name stem unique to the request. The stem is saved with the lab
+    before the request is sent, so that scuttle-lab finds every server of
+    the request even if it never made it into the state DB. The servers are
+    then found by the stem, the one returned by the request first, and
+    mapped in order onto the names of the targets.
 
     :param client: Authenticated Nova Client
-    :param server_dict: Dictionary of server information
-    :param queue: Multiprocessing Queue
-    :param sid: Server ID Number
-    :param tries: Number of allowed tries before faulting
+    :param args: ``dict`` parsed cli arguments.
+    :param targets: ``list`` of server dicts with identical specs.
+    :return: ``tuple`` of a dict of server IDs and their server dicts and a
+             list of the server dicts that were not created.
     """
 
-    instance = None
+    stem = '%s_bulk-%s' % (args['name'], uuid.uuid4().hex[:8])
+    build_hash = dict(targets[0])
+    build_hash.update(
+        {'name': stem, 'min_count': len(targets), 'max_count': len(targets)}
+    )
+
+    with sk.Database(args['db_path']) as db:
+        stems = db.get_value(lab=args['name'], key='bulk_stems', default=[])
+        db.set_values(lab=args['name'], values={'bulk_stems': stems + [stem]})
+
     try:
-        for rty in ut.retryloop(attempts=MAX_RETRY, delay=5):
-            # Retrieve the instance again so the status field updates
-            instance = client_server_get(client, server_id=sid)
-            status = instance.status
-            idnum = instance.id
+        first = client_create(client=client, build_hash=build_hash)
+    except Exception as exc:
+        if getattr(exc, 'code', None) in (400, 403):
+            print('Bulk create is not available: "%s". The servers will be'
+                  ' created one at a time.' % exc)
+            return {}, list(targets)
+        raise
+
+    created = _bulk_servers(
+        client=client, stem=stem, first=first, count=len(targets)
+    )
 
-            if status == 'ACTIVE':
-                print('Instance ID %s Name %s is ACTIVE'
-                      % (instance.id, instance.name))
-            elif status == 'ERROR':
-                print('%s is in ERROR and will be deleted. '
-                      'The job for server will be requeued.'
-                      % idnum)
-                _kill_server(client, idnum, server_dict, queue)
-            else:
+    servers = {}
+    with sk.Database(args['db_path']) as db:
+        for target, server in zip(targets, created):
+            db.put_node(lab=args['name'], name=target['name'],
+                        data=server._info)
+            servers[server.id] = target
+
+    print('Created "%s" servers with one request' % len(servers))
+    return servers, targets[len(servers):]
+
+
+def _bulk_servers(client, stem, first, count):
+    """Return the servers of a multi-create, the one it returned first.
+
+    The listing can lag behind the request, so it is fetched again until it
+    holds every server of the request or the retries run out.
+
+    :param client: Authenticated Nova Client
+    :param stem: Name stem of the servers of the request.
+    :param first: Server returned by the request.
+    :param count: Number of servers the request created.
+    :return: ``list`` of Servers.
+    """
+
+    listed = {}
+    try:
+        for rty in ut.retryloop(attempts=5, delay=RETRY_DELAY, backoff=2):
+            listed = dict([
+                (server.id, server)
+                for server in client_list(client, search_opts={'name': stem})
+                if server.name.startswith(stem)
+            ])
+            if len(listed) < count:
                 rty()
     except sk.RetryError:
-        wait = MAX_RETRY * 5
-        if instance is None:
-            print('Failure building the instance after "%s" seconds' % wait)
-        else:
-            print('Instance %s Never went ACTIVE within "%s" seconds.'
-                  ' The instance will be killed.' % (instance.name, wait))
-            client_delete(client=client, server_id=instance.id)
+        print('Only "%s" of the "%s" servers named "%s" were listed'
+              % (len(listed), count, stem))
 
+    first = listed.pop(first.id, first)
+    return [first] + sorted(listed.values(), key=_name_order)
 
-def check_limits(client, tenant_id, purposed_ram):
-    """check limits.
 
-    :param client: pre-setup nova client
-    :param tenant_id: tenant id for the user
-    :param purposed_ram: RAM usage being purposed for the build.
+def _is_built(server):
+    return server is not None and server.status in ('ACTIVE', 'ERROR')
+
+
+class StatusPoller(object):
+    """Watch the status of many servers using one API call per interval.
+
+    Every poll lists the servers of a lab in a single detailed call and
+    passes status changes on to the callback registered for each server. The
+    interval starts short and backs off while the servers are still busy.
     """
 
-    all_limits = client.limits.get(tenant_id=tenant_id)
-    limits = all_limits._info
-    a_limits = limits.get('absolute', sk.LimitsUnavailable('No Limits Found.'))
-    max_networks = a_limits.get('maxTotalPrivateNetworks', 0)
+    def __init__(self, client, prefix, interval=2, max_interval=15,
+                 backoff=1.5, timeout=500):
+        """Setup the poller.
+
+        :param client: Authenticated Nova Client
+        :param prefix: Name prefix shared by all of the watched servers.
+        :param interval: Seconds to wait after the first poll.
+        :param max_interval: Maximum seconds to wait between polls.
+        :param backoff: Multiplier applied to the interval after each poll.
+        :param timeout: Seconds before the poller gives up.
+        """
+
+        self.client = client
+        self.prefix = '%s_' % prefix
+        self.interval = interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
+        self.waiters = {}
+
+    def watch(self, server_id, callback, done=_is_built):
+        """Register a server to be watched.
+
+        :param server_id: Server ID Number
+        :param callback: Called with the server ID and the server on every
+                         status change. The server is None once it is gone.
+        :param done: Called with the server, returns True once the server
+                     no longer needs to be watched.
+        """
+
+        self.waiters[server_id] = {
+            'callback': callback,
+            'done': done,
+            'status': False
+        }
 
-    used_networks = a_limits.get('totalPrivateNetworksUsed', 0)
-    max_ram = a_limits.get('maxTotalRAMSize', 0)
-    used_ram = a_limits.get('totalRAMUsed', 0)
+    def poll(self):
+        """List the servers once and fan status changes out to waiters."""
 
-    if any([max_networks == -1, (max_networks - used_networks <= 0)]):
-        raise sk.NoNetworksAvailable('No Networks are available for use.')
-    elif purposed_ram > (max_ram - used_ram):
-        return False
-    else:
-        return True
+        listing = dict([
+            (server.id, server)
+            for server in client_list(
+                self.client, search_opts={'name': self.prefix}
+            )
+            if server.name.startswith(self.prefix)
+        ])
+
+        for sid, waiter in self.waiters.items():
+            server = listing.get(sid)
+            status = getattr(server, 'status', None)
+            if status != waiter['status']:
+                waiter['status'] = status
+                waiter['callback'](sid, server)
+
+            if waiter['done'](server):
+                del self.waiters[sid]
+
+    def run(self):
+        """Poll until every waiter is done or the timeout is reached.
+
+        :return: ``list`` of server IDs still being watched.
+        """
+
+        deadline = time.time() + self.timeout
+        interval = self.interval
+        while self.waiters:
+            self.poll()
+            if not self.waiters or time.time() > deadline:
+                break
+
+            time.sleep(interval)
+            interval = min(interval * self.backoff, self.max_interval)
+
+        return list(self.waiters)
+
+
+def wait_for_active(client, args, servers, timeout=500):
+    """Wait for the instances to be active.
+
+    Servers which go into ERROR, or never go ACTIVE, are deleted and their
+    server dict is returned so that they can be built again.
+
+    :param client: Authenticated Nova Client
+    :param args: ``dict`` parsed cli arguments.
+    :param servers: ``dict`` of Server ID Numbers and their server dicts.
+    :param timeout: Number of seconds allowed before faulting
+    :return: ``list`` of server dicts to be built again.
+    """
+
+    with metrics.span('wait_for_active', lab=args['name']):
+        return _wait_for_active(
+            client=client, args=args, servers=servers, timeout=timeout
+        )
+
+
+def _wait_for_active(client, args, servers, timeout):
+    rebuild = []
+
+    def _status(sid, server):
+        if server is None:
+            return
+        elif server.status == 'ACTIVE':
+            # Bulk created servers are named by Nova, use the node name.
+            name = servers[sid]['name']
+            print('Instance ID %s Name %s is ACTIVE' % (sid, name))
+            with sk.Database(args['db_path']) as db:
+                db.put_node(lab=args['name'], name=name, data=server._info)
+        elif server.status == 'ERROR':
+            print('%s is in ERROR and will be deleted. '
+                  'The job for server will be requeued.' % sid)
+            client_delete(client=client, server_id=sid)
+            rebuild.append(servers[sid])
+
+    poller = StatusPoller(client=client, prefix=args['name'], timeout=timeout)
+    for sid in servers:
+        poller.watch(server_id=sid, callback=_status)
+
+    for sid in poller.run():
+        print('Instance %s Never went ACTIVE within "%s" seconds.'
+              ' The instance will be killed.' % (sid, timeout))
+        client_delete(client=client, server_id=sid)
+        rebuild.append(servers[sid])
+
+    return rebuild
+
+
+def _is_gone(server):
+    return server is None or server.status == 'DELETED'
+
+
+def _delete_server(client, target):
+    client_delete(client=client, server_id=target)
+    return target
+
+
+def scuttle_servers(client, args, server_ids, timeout=DELETE_TIMEOUT):
+    """Delete servers in parallel and wait for them to be gone.
+
+    Every delete is sent at once, bounded by the number of workers, and the
+    deletes are then confirmed with one listing per poll.
+
+    :param client: Authenticated Nova Client
+    :param args: ``dict`` parsed cli arguments.
+    :param server_ids: ``list`` of Server ID Numbers.
+    :param timeout: Number of seconds allowed for the servers to be gone.
+    :return: ``list`` of Server ID Numbers which were not deleted.
+    """
+
+    if not server_ids:
+        return []
+
+    with metrics.span('scuttle_servers', lab=args['name']):
+        results = ut.worker_proc(
+            kwargs={'client': client,
+                    'queue': ut.basic_queue(iters=server_ids),
+                    'job_action': _delete_server},
+            threads=args.get('workers'),
+            backend=args.get('executor')
+        )
+
+        failed = []
+        for job in results:
+            if job.error is not None:
+                print('Instance %s could not be deleted: %s'
+                      % (job.target, job.error))
+                failed.append(job.target)
+
+        def _status(sid, server):
+            if _is_gone(server):
+                print('Instance ID %s is DELETED' % sid)
+
+        poller = StatusPoller(
+            client=client, prefix=args['name'], timeout=timeout
+        )
+        for sid in server_ids:
+            if sid not in failed:
+                poller.watch(server_id=sid, callback=_status, done=_is_gone)
+
+        remaining = poller.run()
+        for sid in remaining:
+            print('Instance %s was not deleted within "%s" seconds.'
+                  % (sid, timeout))
 
+    return failed + remaining
 
-def skylab_network(client, name, net_cidr=None, net_id=None):
+
+def skylab_network(client, catalog, name, net_cidr=None, net_id=None):
     """Set Network
 
     :param client: pre-setup nova client
+    :param catalog: ``catalog.Catalog`` for the client
     :param name: naming convention
     :param net_cidr: Network CIDR
     :param net_id: Network ID
     """
 
-    nets = client.networks._list('/os-networksv2', "networks")
+    nets = catalog.networks()
 
     if net_id is not None:
-        net = [net for net in nets if net.id == net_id]
+        net = [net for net in nets if net['id'] == net_id]
     else:
-        net = [net for net in nets if net.label == name]
+        net = [net for net in nets if net['label'] == name]
 
     if net:
         if len(net) == 1:
-            return net[0].id
+            return net[0]['id']
         else:
             raise sk.TooManyNetworks(
-                'You have more than one "skylab" network.'
+                'You have more than one "%s" network.' % name
             )
     else:
         body = {
             "network": {
-                "label": "skylab",
+                "label": name,
                 "cidr": net_cidr
             }
         }
+        metrics.incr('api.calls', call='networks.create')
         net = client.networks._create('/os-networksv2', body, 'network')
+        catalog.invalidate(kind='networks')
         return net.id
 
 
-def flavor_find(client, flavor_ram=None):
-    """Set Network
+def flavor_find(catalog, flavor_ram=None):
+    """Find the flavor ID for an amount of RAM.
 
-    :param novaclient: pre-setup nova client
+    :param catalog: ``catalog.Catalog`` for the nova client
     :param flavor_ram: Ram amount in Mega Bytes
     """
 
-    flavors = client.flavors.list()
-    flavor_id = [{'id': flv.id,
-                  'rxtx': flv.rxtx_factor}
-                 for flv in flavors
-                 if flv.ram == flavor_ram]
+    flavor_id = catalog.flavors_by_ram(ram=flavor_ram)
 
     if len(flavor_id) >= 2:
         max_rx = max(flv['rxtx'] for flv in flavor_id)
@@ -186,24 +414,22 @@ def flavor_find(client, flavor_ram=None):
         else:
             print('Here are a list of all the flavors available.')
             sk.print_horiz_table(
-                [{'id': flv.id, 'ram': flv.ram, 'name': flv.name}
-                 for flv in flavors]
+                [{'id': flv['id'], 'ram': flv['ram'], 'name': flv['name']}
+                 for flv in catalog.flavors()]
             )
             raise SystemExit(
                 'A Flavor ID for "%s" RAM was not found.' % flavor_ram
             )
 
 
-def image_find(client, image):
+def image_find(catalog, image):
     """Find the image that we will be using.
 
-    :param novaclient: pre-setup nova client
-    :param image: Name or ID of cloud Image.
+    :param catalog: ``catalog.Catalog`` for the nova client
+    :param image: Name, name prefix or ID of cloud Image.
     """
 
-    images = client.images.list()
-    image_ids = [img.id for img in images
-                 if image in img.name or image == img.id]
+    image_ids = [img['id'] for img in catalog.find_images(image=image)]
     if image_ids:
         if len(image_ids) > 1:
             raise SystemExit(
@@ -215,7 +441,8 @@ def image_find(client, image):
     else:
         print('Here are a list of all the images available.')
         sk.print_horiz_table(
-            [{'id': img.id, 'name': img.name} for img in images]
+            [{'id': img['id'], 'name': img['name']}
+             for img in catalog.images()]
         )
         raise SystemExit(
             'Image id/name "%s" was not found. To try using the image name'
@@ -223,15 +450,43 @@ def image_find(client, image):
         )
 
 
-def client_list(client):
+def _retryloop():
+    """Return the retry loop shared by all of the client calls."""
+
+    return ut.retryloop(
+        attempts=MAX_FAULTS,
+        timeout=RETRY_DEADLINE,
+        delay=RETRY_DELAY,
+        max_delay=RETRY_MAX_DELAY,
+        jitter=True
+    )
+
+
+def _client_fault(rty, exc, note):
+    """Retry a failed client call, or raise the error if it is not retryable.
+
+    :param rty: Retry function from the retry loop.
+    :param exc: Exception raised by the client call.
+    :param note: Message printed for the failure.
+    """
+
+    if not ut.retryable(exc):
+        raise exc
+
+    metrics.incr('api.retries')
+    print('%s: "%s"' % (note, exc))
+    rty(delay=ut.retry_after(exc))
+
+
+def client_list(client, search_opts=None):
     """Return a list of Servers."""
 
-    for rty in ut.retryloop(attempts=MAX_FAULTS, delay=5):
+    for rty in _retryloop():
         try:
-            servers = client.servers.list()
+            metrics.incr('api.calls', call='servers.list')
+            servers = client.servers.list(search_opts=search_opts)
         except Exception as exc:
-            print('Issues in getting Server list. EXCEPTION: %s' % exc)
-            rty()
+            _client_fault(rty, exc, 'Issues in getting Server list')
         else:
             if servers is not None:
                 return servers
@@ -242,52 +497,58 @@ def client_list(client):
 def client_delete(client, server_id):
     """Delete a server."""
 
-    for rty in ut.retryloop(attempts=MAX_FAULTS, delay=5):
+    for rty in _retryloop():
         try:
+            metrics.incr('api.calls', call='servers.delete')
             client.servers.delete(server_id)
-        except Exception as (exc, tb):
-            print('ERROR IN CLIENT DELETE: "%s", TRACEBACK: %s' % (exc, tb))
-            rty()
+        except Exception as exc:
+            if getattr(exc, 'code', None) == 404:
+                # The server is already gone.
+                return
+            _client_fault(rty, exc, 'ERROR IN CLIENT DELETE')
 
 
-def client_create(client, build_hash, queue):
-    """Return a list of Servers."""
+def client_network_delete(client, net_id):
+    """Delete a network."""
+
+    for rty in _retryloop():
+        try:
+            metrics.incr('api.calls', call='networks.delete')
+            client.networks._delete('/os-networksv2/%s' % net_id)
+        except Exception as exc:
+            if getattr(exc, 'code', None) == 404:
+                # The network is already gone.
+                return
+            _client_fault(rty, exc, 'ERROR IN NETWORK DELETE')
+
 
-    # Import requests to trap connection error exception.
-    import requests
+def client_create(client, build_hash):
+    """Create a Server."""
 
-    for rty in ut.retryloop(attempts=MAX_FAULTS, delay=5):
-        server = None
+    for rty in _retryloop():
         try:
-            time.sleep(random.randrange(1, 5))
-            server = client.servers.create(**build_hash)
-            if server is None:
-                raise ValueError('Server Created returned a None Value.')
-        except requests.ConnectionError:
-            rty()
+            metrics.incr('api.calls', call='servers.create')
+            with metrics.span('client_create', node=build_hash['name']):
+                server = client.servers.create(**build_hash)
         except Exception as exc:
-            if server is not None:
-                _kill_server(
-                    client=client,
-                    server_id=server.id,
-                    server_dict=build_hash,
-                    work_queue=queue
-                )
-            print('ERROR IN CLIENT CREATE: "%s"' % exc)
-            rty()
+            _client_fault(rty, exc, 'ERROR IN CLIENT CREATE')
         else:
-            return server
+            if server is not None:
+                return server
+            else:
+                print('Server Created returned a None Value.')
+                rty()
 
 
 def client_server_get(client, server_id):
-    """Return a list of Servers."""
+    """Return a Server."""
 
-    for rty in ut.retryloop(attempts=MAX_FAULTS, delay=5):
+    for rty in _retryloop():
         try:
+            metrics.incr('api.calls', call='servers.get')
             server = client.servers.get(server_id)
         except Exception as exc:
-            print('ERROR IN CLIENT GET: "%s"' % exc)
-            rty()
+            _client_fault(rty, exc, 'ERROR IN CLIENT GET')
         else:
             if server is not None:
                 return server
@@ -301,12 +562,12 @@ def client_key_find(client, key_name):
     :return True||False:
     """
 
-    for rty in ut.retryloop(attempts=MAX_FAULTS, delay=5):
+    for rty in _retryloop():
         try:
+            metrics.incr('api.calls', call='keypairs.findall')
             key = client.keypairs.findall(name=key_name)
         except Exception as exc:
-            print('ERROR IN CLIENT KEY NAME LOOKUP: "%s"' % exc)
-            rty()
+            _client_fault(rty, exc, 'ERROR IN CLIENT KEY NAME LOOKUP')
         else:
             return key
 
@@ -314,277 +575,825 @@ def client_key_find(client, key_name):
 def client_key_create(client, key_name, public_key):
     """Create a Public Key for Server injection in NOVA."""
 
-    for rty in ut.retryloop(attempts=MAX_FAULTS, delay=5):
+    for rty in _retryloop():
         try:
+            metrics.incr('api.calls', call='keypairs.create')
             client.keypairs.create(name=key_name, public_key=public_key)
         except Exception as exc:
-            print('ERROR IN CLIENT KEY CREATE: "%s"' % exc)
-            rty()
+            _client_fault(rty, exc, 'ERROR IN CLIENT KEY CREATE')
+
+
+def _artifact_steps(bundle, group, remote_path):
+    """Return the steps uploading and unpacking an artifact bundle."""
+
+    return [
+        sched.Step(
+            name='artifact_upload',
+            title='Artifact Upload',
+            group=group,
+            method='put_file',
+            string_obj=bundle,
+            remote_path=remote_path,
+            requires=['base']
+        ),
+        sched.Step(
+            name='artifact_unpack',
+            title='Artifact Unpack',
+            group=group,
+            method='run',
+            string_obj=tpl.script('ARTIFACT_UNPACK'),
+            requires=['artifact_upload']
+        )
+    ]
 
 
-def construct_skylab(args):
+def _skip_steps(steps, names):
+    """Return the steps without the named ones, dropping them as requires.
 
-    def first_boot_json(run_list):
-        return json.dumps({'run_list': run_list}, indent=2)
+    :param steps: ``list`` of ``Step`` objects.
+    :param names: Names of the steps which are skipped.
+    """
 
-    def get_addr(device, ip_type='public'):
-        with sk.Shelve(args['db_path']) as db:
-            try:
-                dev = db[args['db_name']].get(device)
-                addresses = dev.get('addresses')
-                type_addresses = addresses.get(ip_type)
-                for pa in type_addresses:
-                    if pa.get('version') == 4:
-                        return pa['addr']
-                else:
-                    raise sk.DeploymentFailure(
-                        'No IPV4 addresss was found for Controller1'
-                    )
-            except AttributeError as exc:
-                raise sk.DeploymentFailure(
-                    'No IP address was found for Device: "%s". Exception "%s"'
-                    % (device, exc)
-                )
+    skipped = set(names)
+    kept = [step for step in steps if step.name not in skipped]
+    for step in kept:
+        step.requires = [req for req in step.requires if req not in skipped]
+    return kept
 
-    def get_computes():
-        compute_addrs = []
-        with sk.Shelve(args['db_path']) as db:
-            nodes = db[args['db_name']].keys()
-            for node in nodes:
-                name = '%s_compute' % args.get('name')
-                if name in node:
-                    compute_addrs.append(
-                        get_addr(device=node, ip_type='public')
-                    )
-        return compute_addrs
 
-    controller1_name = '%s_%s' % (args['name'], 'controller1')
-    controller1_addr = get_addr(
-        device=controller1_name
-    )
+def node_addr(nodes, device, ip_type='public'):
+    """Return the IPv4 address of a node on a network.
+
+    :param nodes: ``dict`` of node names and their data.
+    :param device: Name of the node.
+    :param ip_type: Name of the network.
+    :return: ``str``
+    """
+
+    try:
+        addresses = nodes[device]['addresses'][ip_type]
+    except (KeyError, TypeError) as exc:
+        raise sk.DeploymentFailure(
+            'No IP address was found for Device: "%s". Exception "%s"'
+            % (device, exc)
+        )
+
+    for pa in addresses:
+        if pa.get('version') == 4:
+            return pa['addr']
+    else:
+        raise sk.DeploymentFailure(
+            'No IPV4 addresss was found for Device: "%s"' % device
+        )
+
 
-    skylab_vips = get_addr(
-        device=controller1_name,
-        ip_type=args['name']
+def compute_index(lab, name):
+    """Return the index of a compute node from its name.
+
+    :param lab: Name of the lab.
+    :param name: Name of the node, IE "<lab>_compute3".
+    :return: ``int``
+    """
+
+    return int(name[len('%s_compute' % lab):])
+
+
+def free_computes(lab, existing, count):
+    """Return the names of new compute nodes at the lowest free indexes.
+
+    :param lab: Name of the lab.
+    :param existing: Names of the compute nodes of the lab.
+    :param count: Number of new compute nodes.
+    :return: ``list``
+    """
+
+    taken = set([compute_index(lab=lab, name=name) for name in existing])
+    names = []
+    index = 0
+    while len(names) < count:
+        index += 1
+        if index not in taken:
+            names.append('%s_compute%d' % (lab, index))
+    return names
+
+
+def bake_node(args, node_name):
+    """Run the steps which are the same on every node on a single node.
+
+    :param args: ``dict`` parsed cli arguments.
+    :param node_name: Name of the node being baked.
+    :return: ``dict`` of metadata describing what was baked.
+    """
+
+    with sk.Database(args['db_path']) as db:
+        address = node_addr(nodes=db.nodes(lab=args['name']), device=node_name)
+        db.clear_steps(lab=args['name'])
+
+    context = {'artifact_remote': '/tmp/skylab-artifacts.tar.gz'}
+    steps = [
+        sched.Step(
+            name='base',
+            title='Base Setup',
+            group='nodes',
+            method='run',
+            string_obj=fs.BASE
+        ),
+        sched.Step(
+            name='swap_script',
+            title='Setting The Swap Script',
+            group='nodes',
+            method='put',
+            string_obj=fs.SWAP_SCRIPT,
+            remote_path='/opt/swap.sh',
+            requires=['base']
+        ),
+        sched.Step(
+            name='enable_swap',
+            title='Enable Swap',
+            group='nodes',
+            method='run',
+            string_obj=fs.ENABLE_SWAP,
+            requires=['swap_script']
+        ),
+        sched.Step(
+            name='apt_deps',
+            title='Apt Dependencies',
+            group='nodes',
+            method='run',
+            string_obj=fs.BAKE_APT_DEPS,
+            requires=['enable_swap']
+        ),
+        sched.Step(
+            name='chef_client',
+            title='Setup Chef Client',
+            group='nodes',
+            method='run',
+            string_obj=fs.CHEF_CLIENT,
+            requires=['apt_deps']
+        )
+    ]
+
+    metadata = {'skylab_baked': ','.join(BAKED_STEPS)}
+    if args.get('artifact_bundle'):
+        steps.extend(
+            _artifact_steps(bundle=args['artifact_bundle'],
+                            group='nodes',
+                            remote_path=context['artifact_remote'])
+        )
+        metadata['skylab_artifacts'] = args['cookbook_version']
+
+    steps.append(
+        sched.Step(
+            name='bake_cleanup',
+            title='Bake Cleanup',
+            group='nodes',
+            method='run',
+            string_obj=fs.BAKE_CLEANUP,
+            requires=[step.name for step in steps]
+        )
     )
 
-    controller2_name = '%s_%s' % (args['name'], 'controller2')
-    controller2_addr = get_addr(
-        device=controller2_name
+    scheduler = sched.Scheduler(
+        args=args, steps=steps, groups={'nodes': [address]}, context=context
     )
+    scheduler.run()
+    return metadata
 
-    engine = bf.Engine(args=args)
 
-    replacement_dict = {
-        'chef_server_ip': controller1_addr,
+def lab_context(args, controller1, controller2, vip, computes):
+    """Return the variables that the scripts of a lab are rendered with.
+
+    :param args: ``dict`` parsed cli arguments.
+    :param controller1: Public address of controller1.
+    :param controller2: Public address of controller2.
+    :param vip: Address of controller1 on the lab network.
+    :param computes: ``list`` of public addresses of the compute nodes.
+    :return: ``dict``
+    """
+
+    return {
+        'chef_server_ip': controller1,
+        'controller2_ip': controller2,
         'cookbook_version': args['cookbook_version'],
         'name': args['name'],
-        'rabbit_ip': skylab_vips,
+        'rabbit_ip': vip,
         'rabbit_password': 'secrete',
-        'vip_prefix': '.'.join(skylab_vips.split('.')[:-1]),
+        'vip_prefix': '.'.join(vip.split('.')[:-1]),
         'first_bt_json': '/etc/chef/first-boot.json',
         'client_loc': '/etc/chef/client.rb',
         'chef_env': args['name'],
+        'artifact_remote': '/tmp/skylab-artifacts.tar.gz',
+        'compute_nodes': computes,
+        'controller1_runlist': [
+            'role[ha-controller1]', 'role[single-network-node]'
+        ],
+        'controller2_runlist': [
+            'role[ha-controller2]', 'role[single-network-node]'
+        ],
+        'compute_runlist': ['role[single-compute]']
     }
 
-    compute_nodes = replacement_dict['compute_nodes'] = get_computes()
 
-    cntrl1 = replacement_dict['controller1_runlist'] = [
-        'role[ha-controller1]', 'role[single-network-node]'
-    ]
-    cntrl2 = replacement_dict['controller2_runlist'] = [
-        'role[ha-controller2]', 'role[single-network-node]'
-    ]
-    compute = replacement_dict['compute_runlist'] = [
-        'role[single-compute]'
-    ]
+def check_scripts(args):
+    """Render every script of a lab against placeholder addresses.
 
-    with sk.Shelve(args['db_path']) as db:
-        db[args['db_name']].update(replacement_dict)
+    Run before any server is created, so that a bad script or a missing
+    variable fails the build straight away.
 
-    # Controller1
-    engine.run(
-        name='Base Setup',
-        string_obj=fs.BASE,
-        target=controller1_addr
-    )
-    engine.run(
-        name='keys',
-        string_obj=fs.KEY_MAKER,
-        target=controller1_addr
-    )
-    engine.put(
-        name='Setting The Swap Script',
-        string_obj=fs.SWAP_SCRIPT,
-        remote_path='/opt/swap.sh',
-        target=controller1_addr
-    )
-    engine.run(
-        name='Enable Swap',
-        string_obj=fs.ENABLE_SWAP,
-        target=controller1_addr
-    )
-    engine.run(
-        name='Apt Packages',
-        string_obj=fs.INSTALL_APT_PACKAGES,
-        target=controller1_addr
-    )
-    engine.run(
-        name='Reconfigure Chef',
-        string_obj=fs.CHEFSERVER_RECONFIGURE % replacement_dict,
-        target=controller1_addr
-    )
-    engine.run(
-        name='Setup Chef Client',
-        string_obj=fs.CHEF_CLIENT,
-        target=controller1_addr
-    )
-    engine.run(
-        name='Setup Knife Client',
-        string_obj=fs.KNIFE_CLIENT % replacement_dict,
-        target=controller1_addr
-    )
-    engine.put(
-        name='Settings Chef Client RB',
-        string_obj=fs.CHEF_CLIENT_RB % replacement_dict,
-        remote_path='/etc/chef/client.rb',
-        target=controller1_addr
-    )
-    engine.run(
-        name='Cookbook Upload',
-        string_obj=fs.COOKBOOK_UPLOAD % replacement_dict,
-        target=controller1_addr
-    )
-    replacement_dict['erlang_cookie'] = engine.get(
-        name='erlang_cookie',
-        string_obj='/var/lib/rabbitmq/.erlang.cookie',
-        target=controller1_addr
-    )
-    replacement_dict['admin_pem'] = engine.get(
-        name='admin_pem',
-        string_obj='/etc/chef-server/admin.pem',
-        target=controller1_addr
+    :param args: ``dict`` parsed cli arguments.
+    """
+
+    context = lab_context(
+        args=args,
+        controller1='192.0.2.1',
+        controller2='192.0.2.2',
+        vip='198.51.100.1',
+        computes=['192.0.2.%d' % (num + 3)
+                  for num in range(max(0, args['node_count'] - 2))]
     )
-    replacement_dict['chef_validator_pem'] = engine.get(
-        name='chef_validator_pem',
-        string_obj='/etc/chef-server/chef-validator.pem',
-        target=controller1_addr
+    tpl.render_steps(
+        steps=lab_steps(args=args, context=context), context=context
     )
 
-    with sk.Shelve(args['db_path']) as db:
-        db[args['db_name']].update(replacement_dict)
 
-    engine.put(
-        name='Environment File',
-        string_obj=fs.ENVIRONMENT % replacement_dict,
-        remote_path='/opt/base.env.json',
-        target=controller1_addr
-    )
-    engine.run(
-        name='Upload Environment',
-        string_obj=fs.ENVIRONMENT_UPLOAD,
-        target=controller1_addr
-    )
-    engine.put(
-        name='First Boot JSON',
-        string_obj=first_boot_json(cntrl1),
-        remote_path=replacement_dict['first_bt_json'],
-        target=controller1_addr
-    )
-    engine.put(
-        name='chef_validator_pem',
-        string_obj=replacement_dict['chef_validator_pem'],
-        remote_path='/etc/chef/validation.pem',
-        target=controller1_addr
-    )
-    engine.run(
-        name='Bootstrap Controller1',
-        string_obj=fs.RUN_CHEF_CLIENT % replacement_dict,
-        target=controller1_addr
-    )
+def construct_skylab(args, resume=False):
+    """Bootstrap and deploy Openstack onto the nodes of a lab.
 
-    # Controller2
-    engine.run(
-        name='Base Setup',
-        string_obj=fs.BASE,
-        target=controller2_addr
-    )
-    engine.put(
-        name='Setting The Swap Script',
-        string_obj=fs.SWAP_SCRIPT,
-        remote_path='/opt/swap.sh',
-        target=controller2_addr
-    )
-    engine.run(
-        name='Enable Swap',
-        string_obj=fs.ENABLE_SWAP,
-        target=controller2_addr
-    )
-    engine.run(
-        name='Setup Chef Client',
-        string_obj=fs.CHEF_CLIENT,
-        target=controller2_addr
-    )
-    engine.put(
-        name='First Boot JSON',
-        string_obj=first_boot_json(cntrl2),
-        remote_path='/etc/chef/first-boot.json',
-        target=controller2_addr
-    )
-    engine.put(
-        name='chef_validator_pem',
-        string_obj=replacement_dict['chef_validator_pem'],
-        remote_path='/etc/chef/validation.pem',
-        target=controller2_addr
-    )
-    engine.put(
-        name='Settings Chef Client RB',
-        string_obj=fs.CHEF_CLIENT_RB % replacement_dict,
-        remote_path='/etc/chef/client.rb',
-        target=controller2_addr
-    )
-    engine.run(
-        name='Bootstrap Controller2',
-        string_obj=fs.RUN_CHEF_CLIENT % replacement_dict,
-        target=controller2_addr
-    )
+    :param args: ``dict`` parsed cli arguments.
+    :param resume: Skip the steps completed by an earlier run whose inputs
+                   have not changed.
+    """
 
-    # Compute Nodes
-    engine.parallel_run(
-        name='Base Setup',
-        string_obj=fs.BASE,
-        target=compute_nodes
-    )
-    engine.parallel_put(
-        name='Setting The Swap Script',
-        string_obj=fs.SWAP_SCRIPT,
-        remote_path='/opt/swap.sh',
-        target=compute_nodes
-    )
-    engine.parallel_run(
-        name='Enable Swap',
-        string_obj=fs.ENABLE_SWAP,
-        target=compute_nodes
+    with sk.Database(args['db_path']) as db:
+        lab_nodes = db.nodes(lab=args['name'])
+        computes = sorted(db.nodes(lab=args['name'], role='compute'))
+
+    controller1_name = '%s_%s' % (args['name'], 'controller1')
+    controller2_name = '%s_%s' % (args['name'], 'controller2')
+    replacement_dict = lab_context(
+        args=args,
+        controller1=node_addr(nodes=lab_nodes, device=controller1_name),
+        controller2=node_addr(nodes=lab_nodes, device=controller2_name),
+        vip=node_addr(
+            nodes=lab_nodes, device=controller1_name, ip_type=args['name']
+        ),
+        computes=[node_addr(nodes=lab_nodes, device=node)
+                  for node in computes]
     )
-    engine.parallel_run(
-        name='Setup Chef Client',
-        string_obj=fs.CHEF_CLIENT,
-        target=compute_nodes
+
+    with sk.Database(args['db_path']) as db:
+        db.set_values(lab=args['name'], values=replacement_dict)
+
+    controller1_addr = replacement_dict['chef_server_ip']
+    controller2_addr = replacement_dict['controller2_ip']
+    compute_nodes = replacement_dict['compute_nodes']
+    groups = {
+        'controller1': [controller1_addr],
+        'controller2': [controller2_addr],
+        'computes': compute_nodes,
+        'agents': [controller2_addr] + compute_nodes,
+        'nodes': [controller1_addr, controller2_addr] + compute_nodes
+    }
+
+    steps = lab_steps(args=args, context=replacement_dict)
+    if args.get('baked_steps'):
+        print('Skipping the steps baked into the image: %s'
+              % ', '.join(args['baked_steps']))
+
+    if resume is False:
+        with sk.Database(args['db_path']) as db:
+            db.clear_steps(lab=args['name'])
+
+    scheduler = sched.Scheduler(
+        args=args,
+        steps=steps,
+        groups=groups,
+        context=replacement_dict,
+        resume=resume
     )
-    engine.parallel_put(
-        name='First Boot JSON',
-        string_obj=first_boot_json(compute),
-        remote_path='/etc/chef/first-boot.json',
-        target=compute_nodes
+    try:
+        scheduler.run()
+    finally:
+        with sk.Database(args['db_path']) as db:
+            db.set_values(lab=args['name'], values=replacement_dict)
+
+    record_hostnames(args=args, computes=computes)
+
+
+def compute_steps(steps):
+    """Return the steps of a build graph which run on the compute nodes.
+
+    Requirements on the steps of the controllers are dropped, a lab is only
+    scaled once its controllers have been built.
+
+    :param steps: ``list`` of ``Step`` objects.
+    :return: ``list`` of ``Step`` objects.
+    """
+
+    names = set([step.name for step in steps
+                 if step.group in COMPUTE_GROUPS])
+    kept = [step for step in steps if step.name in names]
+    for step in kept:
+        step.requires = [req for req in step.requires if req in names]
+    return kept
+
+
+def scale_skylab(args, computes):
+    """Bootstrap and deploy Openstack onto new compute nodes of a lab.
+
+    Only the compute steps of the build are run, against the given nodes.
+    The outputs fetched from the controllers are taken from the state DB.
+    Completed steps are checkpointed, so a failed scale can be run again.
+
+    :param args: ``dict`` parsed cli arguments.
+    :param computes: ``list`` of names of the compute nodes to deploy.
+    """
+
+    with sk.Database(args['db_path']) as db:
+        lab_nodes = db.nodes(lab=args['name'])
+        lab_computes = sorted(db.nodes(lab=args['name'], role='compute'))
+        values = db.values(lab=args['name'])
+
+    controller1_name = '%s_%s' % (args['name'], 'controller1')
+    controller2_name = '%s_%s' % (args['name'], 'controller2')
+    replacement_dict = lab_context(
+        args=args,
+        controller1=node_addr(nodes=lab_nodes, device=controller1_name),
+        controller2=node_addr(nodes=lab_nodes, device=controller2_name),
+        vip=node_addr(
+            nodes=lab_nodes, device=controller1_name, ip_type=args['name']
+        ),
+        computes=[node_addr(nodes=lab_nodes, device=node)
+                  for node in lab_computes]
     )
-    engine.parallel_put(
-        name='chef_validator_pem',
-        string_obj=replacement_dict['chef_validator_pem'],
-        remote_path='/etc/chef/validation.pem',
-        target=compute_nodes
+
+    steps = lab_steps(args=args, context=replacement_dict)
+    for output in [step.output for step in steps if step.output]:
+        if output not in values:
+            raise SystemExit(
+                'Lab "%s" has not finished building, resume it before'
+                ' scaling it.' % args['name']
+            )
+        replacement_dict[output] = values[output]
+
+    with sk.Database(args['db_path']) as db:
+        db.set_values(
+            lab=args['name'],
+            values={'compute_nodes': replacement_dict['compute_nodes']}
+        )
+
+    addresses = [node_addr(nodes=lab_nodes, device=node) for node in computes]
+    scheduler = sched.Scheduler(
+        args=args,
+        steps=compute_steps(steps=steps),
+        groups=dict([(group, addresses) for group in COMPUTE_GROUPS]),
+        context=replacement_dict,
+        resume=True
     )
-    engine.parallel_run(
-        name='Bootstrap Computer Node',
-        string_obj=fs.RUN_CHEF_CLIENT % replacement_dict,
-        target=compute_nodes
+    scheduler.run()
+
+    record_hostnames(args=args, computes=computes)
+
+
+def record_hostnames(args, computes):
+    """Read the host names of compute nodes and save them with the lab.
+
+    Nova names a guest after a sanitised form of its server name and Chef
+    names a node by its FQDN, so neither can be worked out from the name of
+    the server. They are read from the nodes themselves. A node whose names
+    could not be read is left out and tried again the next time.
+
+    :param args: ``dict`` parsed cli arguments.
+    :param computes: ``list`` of names of the compute nodes.
+    :return: ``dict`` of node names and their "host" and "fqdn" names.
+    """
+
+    with sk.Database(args['db_path']) as db:
+        lab_nodes = db.nodes(lab=args['name'])
+
+    addresses = dict([(node_addr(nodes=lab_nodes, device=node), node)
+                      for node in computes])
+    engine = bf.Engine(args=args)
+    try:
+        results = engine.fan_out(
+            name='Host Names',
+            commands=dict([(addr, fs.HOST_NAMES) for addr in addresses])
+        )
+    finally:
+        engine.disconnect()
+
+    found = {}
+    for addr, result in results.items():
+        lines = [line.strip() for line in (result.output or '').splitlines()
+                 if line.strip()]
+        if result.error is not None or len(lines) < 2:
+            print('The host names of "%s" could not be read: %s'
+                  % (addresses[addr], result.error))
+        else:
+            found[addresses[addr]] = {'host': lines[-2], 'fqdn': lines[-1]}
+
+    with sk.Database(args['db_path']) as db:
+        hostnames = db.get_value(
+            lab=args['name'], key='compute_hostnames', default={}
+        )
+        hostnames.update(found)
+        db.set_values(
+            lab=args['name'], values={'compute_hostnames': hostnames}
+        )
+    return hostnames
+
+
+def drain_computes(args, computes):
+    """Take compute nodes out of the cloud of a lab before deleting them.
+
+    Every node is disabled in Nova and removed from the Chef server, from
+    controller1, by the host names read from the node. Nodes which were
+    never bootstrapped have nothing to drain.
+
+    :param args: ``dict`` parsed cli arguments.
+    :param computes: ``list`` of names of the compute nodes to drain.
+    """
+
+    with sk.Database(args['db_path']) as db:
+        lab_nodes = db.nodes(lab=args['name'])
+        completed = db.steps(lab=args['name'])
+        hostnames = db.get_value(
+            lab=args['name'], key='compute_hostnames', default={}
+        )
+
+    drained = [node for node in computes
+               if ('bootstrap_computes',
+                   node_addr(nodes=lab_nodes, device=node)) in completed]
+    if not drained:
+        return
+
+    missing = [node for node in drained if node not in hostnames]
+    if missing:
+        hostnames = record_hostnames(args=args, computes=missing)
+        missing = [node for node in drained if node not in hostnames]
+        if missing:
+            raise sk.DeploymentFailure(
+                'The host names of compute nodes %s are not known, they can'
+                ' not be drained.' % ', '.join(sorted(missing))
+            )
+
+    controller1_name = '%s_%s' % (args['name'], 'controller1')
+    drain = tpl.script('DRAIN_COMPUTE')
+    steps = [
+        sched.Step(
+            name='drain_%s' % node,
+            title='Drain %s' % node,
+            group='controller1',
+            method='run',
+            string_obj=drain.render(
+                context={'compute_name': hostnames[node]['host'],
+                         'compute_fqdn': hostnames[node]['fqdn']}
+            )
+        )
+        for node in drained
+    ]
+
+    scheduler = sched.Scheduler(
+        args=args,
+        steps=steps,
+        groups={
+            'controller1': [
+                node_addr(nodes=lab_nodes, device=controller1_name)
+            ]
+        },
+        context={}
     )
+    scheduler.run()
+
+
+def lab_steps(args, context):
+    """Return the build graph of a lab.
+
+    :param args: ``dict`` parsed cli arguments.
+    :param context: ``dict`` from ``lab_context``.
+    :return: ``list`` of ``Step`` objects.
+    """
+
+    def first_boot_json(run_list):
+        return json.dumps({'run_list': run_list}, indent=2)
+
+    steps = [
+        # All Nodes
+        sched.Step(
+            name='base',
+            title='Base Setup',
+            group='nodes',
+            method='run',
+            string_obj=fs.BASE
+        ),
+        sched.Step(
+            name='swap_script',
+            title='Setting The Swap Script',
+            group='nodes',
+            method='put',
+            string_obj=fs.SWAP_SCRIPT,
+            remote_path='/opt/swap.sh',
+            requires=['base']
+        ),
+        sched.Step(
+            name='enable_swap',
+            title='Enable Swap',
+            group='nodes',
+            method='run',
+            string_obj=fs.ENABLE_SWAP,
+            requires=['swap_script']
+        ),
+
+        # Controller1
+        sched.Step(
+            name='keys',
+            group='controller1',
+            method='run',
+            string_obj=fs.KEY_MAKER,
+            requires=['base']
+        ),
+        sched.Step(
+            name='apt_packages',
+            title='Apt Packages',
+            group='controller1',
+            method='run',
+            string_obj=fs.INSTALL_APT_PACKAGES,
+            requires=['keys', 'enable_swap']
+        ),
+        sched.Step(
+            name='chef_reconfigure',
+            title='Reconfigure Chef',
+            group='controller1',
+            method='run',
+            string_obj=tpl.script('CHEFSERVER_RECONFIGURE'),
+            requires=['apt_packages']
+        ),
+        sched.Step(
+            name='controller1_chef_client',
+            title='Setup Chef Client',
+            group='controller1',
+            method='run',
+            string_obj=fs.CHEF_CLIENT,
+            requires=['chef_reconfigure']
+        ),
+        sched.Step(
+            name='knife_client',
+            title='Setup Knife Client',
+            group='controller1',
+            method='run',
+            string_obj=tpl.script('KNIFE_CLIENT'),
+            requires=['controller1_chef_client']
+        ),
+        sched.Step(
+            name='controller1_client_rb',
+            title='Settings Chef Client RB',
+            group='controller1',
+            method='put',
+            string_obj=tpl.script('CHEF_CLIENT_RB'),
+            remote_path=context['client_loc'],
+            requires=['controller1_chef_client']
+        ),
+        sched.Step(
+            name='cookbook_upload',
+            title='Cookbook Upload',
+            group='controller1',
+            method='run',
+            string_obj=tpl.script('COOKBOOK_UPLOAD'),
+            requires=['knife_client']
+        ),
+        sched.Step(
+            name='erlang_cookie',
+            group='controller1',
+            method='get',
+            string_obj='/var/lib/rabbitmq/.erlang.cookie',
+            output='erlang_cookie',
+            requires=['chef_reconfigure']
+        ),
+        sched.Step(
+            name='admin_pem',
+            group='controller1',
+            method='get',
+            string_obj='/etc/chef-server/admin.pem',
+            output='admin_pem',
+            requires=['chef_reconfigure']
+        ),
+        sched.Step(
+            name='chef_validator_pem',
+            group='controller1',
+            method='get',
+            string_obj='/etc/chef-server/chef-validator.pem',
+            output='chef_validator_pem',
+            requires=['chef_reconfigure']
+        ),
+        sched.Step(
+            name='environment_file',
+            title='Environment File',
+            group='controller1',
+            method='put',
+            string_obj=tpl.script('ENVIRONMENT'),
+            remote_path='/opt/base.env.json',
+            requires=['erlang_cookie']
+        ),
+        sched.Step(
+            name='environment_upload',
+            title='Upload Environment',
+            group='controller1',
+            method='run',
+            string_obj=fs.ENVIRONMENT_UPLOAD,
+            requires=['environment_file', 'cookbook_upload']
+        ),
+        sched.Step(
+            name='controller1_first_boot',
+            title='First Boot JSON',
+            group='controller1',
+            method='put',
+            string_obj=first_boot_json(context['controller1_runlist']),
+            remote_path=context['first_bt_json'],
+            requires=['controller1_chef_client']
+        ),
+        sched.Step(
+            name='controller1_validator_pem',
+            title='chef_validator_pem',
+            group='controller1',
+            method='put',
+            string_obj=lambda ctx: ctx['chef_validator_pem'],
+            remote_path='/etc/chef/validation.pem',
+            requires=['chef_validator_pem']
+        ),
+        sched.Step(
+            name='bootstrap_controller1',
+            title='Bootstrap Controller1',
+            group='controller1',
+            method='run',
+            string_obj=tpl.script('RUN_CHEF_CLIENT'),
+            requires=['environment_upload',
+                      'controller1_client_rb',
+                      'controller1_first_boot',
+                      'controller1_validator_pem']
+        ),
+
+        # Controller2 and Compute Nodes
+        sched.Step(
+            name='chef_client',
+            title='Setup Chef Client',
+            group='agents',
+            method='run',
+            string_obj=fs.CHEF_CLIENT,
+            requires=['enable_swap']
+        ),
+        sched.Step(
+            name='client_rb',
+            title='Settings Chef Client RB',
+            group='agents',
+            method='put',
+            string_obj=tpl.script('CHEF_CLIENT_RB'),
+            remote_path=context['client_loc'],
+            requires=['chef_client']
+        ),
+        sched.Step(
+            name='validator_pem',
+            title='chef_validator_pem',
+            group='agents',
+            method='put',
+            string_obj=lambda ctx: ctx['chef_validator_pem'],
+            remote_path='/etc/chef/validation.pem',
+            requires=['chef_client', 'chef_validator_pem']
+        ),
+        sched.Step(
+            name='controller2_first_boot',
+            title='First Boot JSON',
+            group='controller2',
+            method='put',
+            string_obj=first_boot_json(context['controller2_runlist']),
+            remote_path=context['first_bt_json'],
+            requires=['chef_client']
+        ),
+        sched.Step(
+            name='bootstrap_controller2',
+            title='Bootstrap Controller2',
+            group='controller2',
+            method='run',
+            string_obj=tpl.script('RUN_CHEF_CLIENT'),
+            requires=['client_rb',
+                      'validator_pem',
+                      'controller2_first_boot',
+                      'bootstrap_controller1']
+        ),
+        sched.Step(
+            name='compute_first_boot',
+            title='First Boot JSON',
+            group='computes',
+            method='put',
+            string_obj=first_boot_json(context['compute_runlist']),
+            remote_path=context['first_bt_json'],
+            requires=['chef_client']
+        ),
+        sched.Step(
+            name='bootstrap_computes',
+            title='Bootstrap Computer Node',
+            group='computes',
+            method='run',
+            string_obj=tpl.script('RUN_CHEF_CLIENT'),
+            requires=['client_rb',
+                      'validator_pem',
+                      'compute_first_boot',
+                      'bootstrap_controller2']
+        )
+    ]
+
+    # A baked image may already hold the bundle of this cookbook version.
+    baked_artifacts = args.get('baked_artifacts') == args['cookbook_version']
+    if baked_artifacts:
+        for step in steps:
+            if step.name == 'apt_packages':
+                step.string_obj = fs.BAKED_APT_PACKAGES
+            elif step.name == 'cookbook_upload':
+                step.string_obj = fs.ARTIFACT_COOKBOOK_UPLOAD
+    elif args.get('artifact_bundle'):
+        # Push the cookbooks and packages from the local bundle instead of
+        # fetching them from upstream on the node.
+        steps.extend(
+            _artifact_steps(bundle=args['artifact_bundle'],
+                            group='controller1',
+                            remote_path=context['artifact_remote'])
+        )
+        for step in steps:
+            if step.name == 'apt_packages':
+                step.string_obj = fs.ARTIFACT_APT_PACKAGES
+                step.requires.append('artifact_unpack')
+            elif step.name == 'cookbook_upload':
+                step.string_obj = fs.ARTIFACT_COOKBOOK_UPLOAD
+                step.requires.append('artifact_unpack')
+
+    if args.get('baked_steps'):
+        steps = _skip_steps(steps=steps, names=args['baked_steps'])
+
+    return steps
+
+
+def client_image_create(client, server_id, image_name, metadata=None):
+    """Snapshot a server.
+
+    :return: ID of the image that was created.
+    """
+
+    for rty in _retryloop():
+        try:
+            metrics.incr('api.calls', call='servers.create_image')
+            return client.servers.create_image(
+                server_id, image_name, metadata
+            )
+        except Exception as exc:
+            _client_fault(rty, exc, 'ERROR IN CLIENT IMAGE CREATE')
+
+
+def client_image_delete(client, image_id):
+    """Delete an image."""
+
+    for rty in _retryloop():
+        try:
+            metrics.incr('api.calls', call='images.delete')
+            client.images.delete(image_id)
+        except Exception as exc:
+            if getattr(exc, 'code', None) == 404:
+                return
+            _client_fault(rty, exc, 'ERROR IN CLIENT IMAGE DELETE')
+        else:
+            return
+
+
+def wait_for_image(client, image_id, timeout=IMAGE_TIMEOUT, interval=5,
+                   max_interval=30, backoff=1.5):
+    """Wait for a snapshot to go ACTIVE.
+
+    :param client: Authenticated Nova Client
+    :param image_id: ID of the image.
+    :param timeout: Number of seconds allowed before faulting
+    """
+
+    deadline = time.time() + timeout
+    with metrics.span('wait_for_image'):
+        while True:
+            for rty in _retryloop():
+                try:
+                    metrics.incr('api.calls', call='images.get')
+                    status = client.images.get(image_id).status
+                except Exception as exc:
+                    _client_fault(rty, exc, 'ERROR IN CLIENT IMAGE GET')
+                else:
+                    break
+
+            if status == 'ACTIVE':
+                return
+            elif status in ('ERROR', 'DELETED', 'KILLED'):
+                raise sk.DeploymentFailure(
+                    'Image "%s" went into "%s"' % (image_id, status)
+                )
+            elif time.time() > deadline:
+                raise sk.DeploymentFailure(
+                    'Image "%s" never went ACTIVE within "%s" seconds'
+                    % (image_id, timeout)
+                )
+
+            time.sleep(interval)
+            interval = min(interval * backoff, max_interval)
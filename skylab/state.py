@@ -0,0 +1,424 @@
+# =============================================================================
+# Copyright [2013] [cloudnull]
+# License Information :
+# This software has no warranty, it is provided 'as is'. It is your
+# responsibility to validate the behavior of the routines and its accuracy
+# using the code provided. Consult the GNU General Public license for further
+# details (see GNU General Public License).
+# http://www.gnu.org/licenses/gpl.html
+# =============================================================================
+
+import contextlib
+import json
+import re
+import time
+
+
+SCHEMA_VERSION = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS labs (
+    name TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    lab TEXT NOT NULL,
+    name TEXT NOT NULL,
+    role TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (lab, name)
+);
+CREATE INDEX IF NOT EXISTS nodes_role ON nodes (lab, role);
+CREATE TABLE IF NOT EXISTS lab_values (
+    lab TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (lab, key)
+);
+CREATE TABLE IF NOT EXISTS catalog (
+    region TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    data TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (region, endpoint, kind)
+);
+CREATE TABLE IF NOT EXISTS steps (
+    lab TEXT NOT NULL,
+    step TEXT NOT NULL,
+    host TEXT NOT NULL,
+    input_hash TEXT NOT NULL,
+    outputs TEXT NOT NULL,
+    completed REAL NOT NULL,
+    PRIMARY KEY (lab, step, host)
+);
+CREATE TABLE IF NOT EXISTS tokens (
+    key TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reservations (
+    lab TEXT PRIMARY KEY,
+    region TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    data TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+"""
+
+
+def node_role(lab, name):
+    """Return the role of a node from its name.
+
+    :param lab: Name of the lab.
+    :param name: Name of the node, IE "<lab>_controller1".
+    :return: ``str`` controller|compute or None
+    """
+
+    match = re.match(r'^%s_(controller|compute)\d+$' % re.escape(lab), name)
+    if match is not None:
+        return match.group(1)
+
+
+class Store(object):
+    """Indexed lab and node state kept in a SQLite database.
+
+    Every lab has one row per node, indexed by name and role, and one row per
+    lab level value. All lookups and writes touch only the rows involved.
+    """
+
+    def __init__(self, conn):
+        """Load the store, creating the schema if needed.
+
+        :param conn: Open ``sqlite3`` connection in autocommit mode.
+        """
+
+        self.conn = conn
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version < SCHEMA_VERSION:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.executescript(
+                'BEGIN IMMEDIATE; %s PRAGMA user_version=%d; COMMIT;'
+                % (SCHEMA, SCHEMA_VERSION)
+            )
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Group several writes into a single transaction."""
+
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.conn
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        else:
+            self.conn.execute('COMMIT')
+
+    def add_lab(self, lab):
+        self.conn.execute(
+            'INSERT OR IGNORE INTO labs (name) VALUES (?)', (lab,)
+        )
+
+    def labs(self):
+        """Return a list of all lab names."""
+
+        query = self.conn.execute('SELECT name FROM labs ORDER BY name')
+        return [row[0] for row in query]
+
+    def delete_lab(self, lab):
+        """Remove a lab, its nodes and its values."""
+
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM nodes WHERE lab = ?', (lab,))
+            conn.execute('DELETE FROM lab_values WHERE lab = ?', (lab,))
+            conn.execute('DELETE FROM steps WHERE lab = ?', (lab,))
+            conn.execute('DELETE FROM reservations WHERE lab = ?', (lab,))
+            conn.execute('DELETE FROM labs WHERE name = ?', (lab,))
+
+    def get_node(self, lab, name):
+        """Return the data for a node or None.
+
+        :param lab: Name of the lab.
+        :param name: Name of the node.
+        :return: ``dict``
+        """
+
+        row = self.conn.execute(
+            'SELECT data FROM nodes WHERE lab = ? AND name = ?', (lab, name)
+        ).fetchone()
+        if row is not None:
+            return json.loads(row[0])
+
+    def put_node(self, lab, name, data, role=None):
+        """Create or replace the data for a node.
+
+        :param lab: Name of the lab.
+        :param name: Name of the node.
+        :param data: ``dict`` of node data.
+        :param role: Role of the node, derived from the name if not set.
+        """
+
+        if role is None:
+            role = node_role(lab=lab, name=name)
+
+        self.conn.execute(
+            'INSERT OR REPLACE INTO nodes (lab, name, role, data)'
+            ' VALUES (?, ?, ?, ?)',
+            (lab, name, role, json.dumps(data))
+        )
+
+    def delete_node(self, lab, name):
+        self.conn.execute(
+            'DELETE FROM nodes WHERE lab = ? AND name = ?', (lab, name)
+        )
+
+    def nodes(self, lab, role=None):
+        """Return the nodes of a lab, optionally limited to a role.
+
+        :param lab: Name of the lab.
+        :param role: Role of the nodes, controller|compute
+        :return: ``dict`` of node names and their data.
+        """
+
+        if role is None:
+            query = self.conn.execute(
+                'SELECT name, data FROM nodes WHERE lab = ?', (lab,)
+            )
+        else:
+            query = self.conn.execute(
+                'SELECT name, data FROM nodes WHERE lab = ? AND role = ?',
+                (lab, role)
+            )
+        return dict([(name, json.loads(data)) for name, data in query])
+
+    def get_value(self, lab, key, default=None):
+        """Return a lab level value.
+
+        :param lab: Name of the lab.
+        :param key: Name of the value.
+        :param default: Returned if the value is not set.
+        """
+
+        row = self.conn.execute(
+            'SELECT value FROM lab_values WHERE lab = ? AND key = ?',
+            (lab, key)
+        ).fetchone()
+        if row is None:
+            return default
+        else:
+            return json.loads(row[0])
+
+    def set_values(self, lab, values):
+        """Create or replace several lab level values in one transaction.
+
+        :param lab: Name of the lab.
+        :param values: ``dict`` of value names and values.
+        """
+
+        with self.transaction() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO lab_values (lab, key, value)'
+                ' VALUES (?, ?, ?)',
+                [(lab, key, json.dumps(value))
+                 for key, value in values.items()]
+            )
+
+    def values(self, lab, exclude=None):
+        """Return all lab level values.
+
+        :param lab: Name of the lab.
+        :param exclude: Names of values which are not read.
+        :return: ``dict``
+        """
+
+        exclude = tuple(exclude or ())
+        query = self.conn.execute(
+            'SELECT key, value FROM lab_values WHERE lab = ?'
+            ' AND key NOT IN (%s)' % ', '.join(['?'] * len(exclude)),
+            (lab,) + exclude
+        )
+        return dict([(key, json.loads(value)) for key, value in query])
+
+    def value_keys(self, lab):
+        """Return the names of the lab level values, without their values.
+
+        :param lab: Name of the lab.
+        :return: ``list``
+        """
+
+        query = self.conn.execute(
+            'SELECT key FROM lab_values WHERE lab = ? ORDER BY key', (lab,)
+        )
+        return [row[0] for row in query]
+
+    def dump(self, lab=None, exclude=None):
+        """Return every lab, or one lab, with its nodes and values.
+
+        :param lab: Name of the lab, every lab if not set.
+        :param exclude: Names of values which are not read.
+        """
+
+        data = {}
+        for name in self.labs() if lab is None else [lab]:
+            data[name] = self.values(lab=name, exclude=exclude)
+            data[name].update(self.nodes(lab=name))
+        return data
+
+    def steps(self, lab):
+        """Return the completed build steps of a lab.
+
+        :param lab: Name of the lab.
+        :return: ``dict`` of (step, host) and their input hash and outputs.
+        """
+
+        query = self.conn.execute(
+            'SELECT step, host, input_hash, outputs FROM steps WHERE lab = ?',
+            (lab,)
+        )
+        return dict([
+            ((step, host), {'input_hash': input_hash,
+                            'outputs': json.loads(outputs)})
+            for step, host, input_hash, outputs in query
+        ])
+
+    def put_step(self, lab, step, host, input_hash, outputs):
+        """Record a completed build step.
+
+        :param lab: Name of the lab.
+        :param step: Name of the step.
+        :param host: Host the step was completed on.
+        :param input_hash: Hash of everything sent to the host for the step.
+        :param outputs: ``dict`` of the context values the step produced.
+        """
+
+        self.conn.execute(
+            'INSERT OR REPLACE INTO steps'
+            ' (lab, step, host, input_hash, outputs, completed)'
+            ' VALUES (?, ?, ?, ?, ?, ?)',
+            (lab, step, host, input_hash, json.dumps(outputs), time.time())
+        )
+
+    def clear_steps(self, lab, host=None):
+        """Forget the completed build steps of a lab, or of one host."""
+
+        if host is None:
+            self.conn.execute('DELETE FROM steps WHERE lab = ?', (lab,))
+        else:
+            self.conn.execute(
+                'DELETE FROM steps WHERE lab = ? AND host = ?', (lab, host)
+            )
+
+    def get_catalog(self, region, endpoint, kind, ttl):
+        """Return a cached catalog listing, or None if missing or expired.
+
+        :param region: Name of the region.
+        :param endpoint: Compute endpoint the listing came from.
+        :param kind: Type of listing, IE "flavors".
+        :param ttl: Seconds that a listing is valid for.
+        """
+
+        row = self.conn.execute(
+            'SELECT data, updated FROM catalog'
+            ' WHERE region = ? AND endpoint = ? AND kind = ?',
+            (region, endpoint, kind)
+        ).fetchone()
+        if row is not None and time.time() - row[1] < ttl:
+            return json.loads(row[0])
+
+    def put_catalog(self, region, endpoint, kind, data):
+        """Cache a catalog listing.
+
+        :param region: Name of the region.
+        :param endpoint: Compute endpoint the listing came from.
+        :param kind: Type of listing, IE "flavors".
+        :param data: ``list`` of items in the listing.
+        """
+
+        self.conn.execute(
+            'INSERT OR REPLACE INTO catalog'
+            ' (region, endpoint, kind, data, updated) VALUES (?, ?, ?, ?, ?)',
+            (region, endpoint, kind, json.dumps(data), time.time())
+        )
+
+    def clear_catalog(self, region, endpoint, kind=None):
+        """Invalidate the cached listings for an endpoint.
+
+        :param region: Name of the region.
+        :param endpoint: Compute endpoint the listing came from.
+        :param kind: Type of listing, all listings if not set.
+        """
+
+        if kind is None:
+            self.conn.execute(
+                'DELETE FROM catalog WHERE region = ? AND endpoint = ?',
+                (region, endpoint)
+            )
+        else:
+            self.conn.execute(
+                'DELETE FROM catalog'
+                ' WHERE region = ? AND endpoint = ? AND kind = ?',
+                (region, endpoint, kind)
+            )
+
+    def get_token(self, key, margin=0):
+        """Return a cached auth response, or None if missing or expiring.
+
+        :param key: Cache key of the credentials.
+        :param margin: Treat tokens expiring within this many seconds as
+                       expired.
+        """
+
+        row = self.conn.execute(
+            'SELECT data, expires FROM tokens WHERE key = ?', (key,)
+        ).fetchone()
+        if row is not None and row[1] - time.time() > margin:
+            return json.loads(row[0])
+
+    def put_token(self, key, data, expires):
+        """Cache an auth response until it expires.
+
+        :param key: Cache key of the credentials.
+        :param data: ``dict`` auth response body.
+        :param expires: Expiry of the token as a unix timestamp.
+        """
+
+        self.conn.execute(
+            'INSERT OR REPLACE INTO tokens (key, data, expires)'
+            ' VALUES (?, ?, ?)',
+            (key, json.dumps(data), expires)
+        )
+
+    def reservations(self, region, endpoint, exclude=None):
+        """Return the resources held by the builds running on an endpoint.
+
+        :param region: Name of the region.
+        :param endpoint: Compute endpoint of the builds.
+        :param exclude: Name of a lab whose reservation is left out.
+        :return: ``list`` of ``dict`` footprints.
+        """
+
+        query = self.conn.execute(
+            'SELECT lab, data FROM reservations'
+            ' WHERE region = ? AND endpoint = ? AND expires > ?',
+            (region, endpoint, time.time())
+        )
+        return [json.loads(data) for lab, data in query if lab != exclude]
+
+    def put_reservation(self, lab, region, endpoint, need, expires):
+        """Hold resources for a build.
+
+        :param lab: Name of the lab.
+        :param region: Name of the region.
+        :param endpoint: Compute endpoint of the build.
+        :param need: ``dict`` footprint of the build.
+        :param expires: Unix timestamp the reservation lapses at.
+        """
+
+        self.conn.execute(
+            'INSERT OR REPLACE INTO reservations'
+            ' (lab, region, endpoint, data, expires) VALUES (?, ?, ?, ?, ?)',
+            (lab, region, endpoint, json.dumps(need), expires)
+        )
+
+    def delete_reservation(self, lab):
+        self.conn.execute('DELETE FROM reservations WHERE lab = ?', (lab,))
@@ -0,0 +1,160 @@
+# =============================================================================
+# Copyright [2013] [cloudnull]
+# License Information :
+# This software has no warranty, it is provided 'as is'. It is your
+# responsibility to validate the behavior of the routines and its accuracy
+# using the code provided. Consult the GNU General Public license for further
+# details (see GNU General Public License).
+# http://www.gnu.org/licenses/gpl.html
+# =============================================================================
+
+import hashlib
+import json
+import re
+
+import skylab as sk
+from skylab import fabric_strings as fs
+
+
+# Every variable the remote scripts may use, and when its value is known.
+#   build: set by skylab for every lab.
+#   args: taken from the cli arguments.
+#   nodes: known once the nodes of the lab exist.
+#   outputs: fetched from a node by a step of the build.
+VARIABLES = {
+    'artifact_remote': 'build',
+    'chef_env': 'args',
+    'chef_server_ip': 'nodes',
+    'client_loc': 'build',
+    'compute_fqdn': 'nodes',
+    'compute_name': 'nodes',
+    'cookbook_version': 'args',
+    'erlang_cookie': 'outputs',
+    'first_bt_json': 'build',
+    'name': 'args',
+    'rabbit_ip': 'nodes',
+    'rabbit_password': 'build',
+    'vip_prefix': 'nodes'
+}
+
+_VARIABLE = re.compile(r'%\((\w+)\)')
+
+
+class Template(object):
+    """A remote script compiled once and rendered against a context.
+
+    The variables of the script are checked against ``VARIABLES`` when the
+    template is compiled. Renders are memoized by the values of the
+    variables the script uses, so a script rendered for many hosts or many
+    steps is only formatted once. A script without variables is used as it
+    is. Templates are callable, so they can be used as the payload of a
+    build step.
+    """
+
+    def __init__(self, name, source):
+        """Compile a script.
+
+        :param name: Name of the script, IE "RUN_CHEF_CLIENT".
+        :param source: ``str`` with "%(key)s" style substitutions.
+        """
+
+        self.name = name
+        self.source = source
+        self.variables = frozenset(_VARIABLE.findall(source))
+        self.renders = {}
+
+        unknown = self.variables - set(VARIABLES)
+        if unknown:
+            raise sk.TemplateError(
+                'Script "%s" uses undeclared variables: %s'
+                % (name, ', '.join(sorted(unknown)))
+            )
+
+        if self.variables:
+            try:
+                source % dict([(var, '') for var in self.variables])
+            except (KeyError, TypeError, ValueError) as exc:
+                raise sk.TemplateError(
+                    'Script "%s" is malformed: %s' % (name, exc)
+                )
+
+    def check(self, context):
+        """Raise if the context is missing a variable of the script.
+
+        :param context: ``dict`` of variables.
+        """
+
+        missing = self.variables - set(context)
+        if missing:
+            raise sk.TemplateError(
+                'Script "%s" is missing variables: %s'
+                % (self.name, ', '.join(sorted(missing)))
+            )
+
+    def render(self, context):
+        """Return the script rendered against the context.
+
+        :param context: ``dict`` of variables.
+        :return: ``str``
+        """
+
+        if not self.variables:
+            return self.source
+
+        self.check(context=context)
+        values = sorted([(var, context[var]) for var in self.variables])
+        key = hashlib.sha1(json.dumps(values)).hexdigest()
+        if key not in self.renders:
+            self.renders[key] = self.source % dict(values)
+        return self.renders[key]
+
+    __call__ = render
+
+
+def _compile(module):
+    """Compile every script defined in a module."""
+
+    return dict([(name, Template(name=name, source=value))
+                 for name, value in vars(module).items()
+                 if name.isupper() and isinstance(value, basestring)])
+
+
+# Compiled on import so that a bad script fails at startup.
+SCRIPTS = _compile(module=fs)
+
+
+def script(name):
+    """Return a compiled script.
+
+    :param name: Name of the script in ``fabric_strings``.
+    :return: ``Template``
+    """
+
+    return SCRIPTS[name]
+
+
+def render_steps(steps, context):
+    """Render the payload of every step of a build graph in one pass.
+
+    Variables produced by a step of the graph are filled with a
+    placeholder, as their value is only known part way through the build.
+
+    :param steps: ``list`` of ``scheduler.Step`` objects.
+    :param context: ``dict`` of variables.
+    :return: ``dict`` of step names and payloads.
+    """
+
+    outputs = set([step.output for step in steps if step.output])
+    context = dict(context)
+    for var in outputs:
+        context.setdefault(var, '<%s>' % var)
+
+    payloads = {}
+    for step in steps:
+        try:
+            payloads[step.name] = step.render(context=context)
+        except KeyError as exc:
+            raise sk.TemplateError(
+                'Step "%s" is missing variable %s' % (step.name, exc)
+            )
+    return payloads
@@ -8,12 +8,20 @@
 # http://www.gnu.org/licenses/gpl.html
 # =============================================================================
 
+import collections
 import inspect
 import multiprocessing
+import pickle
 import Queue
+import random
+import socket
 import sys
+import threading
 import time
 
+from novaclient import exceptions as nova_exceptions
+import requests
+
 import skylab as sk
 
 
@@ -46,65 +54,194 @@ def get_from_q(queue):
         return wfile
 
 
-def worker_proc(kwargs, threads=10):
-    """Requires the job_action and num_jobs variables for functionality.
+JobResult = collections.namedtuple('JobResult', 'target result error')
+
+
+def _portable(exc):
+    """Return an exception which can be sent back from a worker process."""
+
+    try:
+        pickle.dumps(exc)
+    except Exception:
+        return RuntimeError('%s: %s' % (type(exc).__name__, exc))
+    else:
+        return exc
+
+
+def worker_proc(kwargs, threads=10, backend='process', timeout=.5):
+    """Requires the job_action and queue variables for functionality.
+
+    All workers produced are limited by the number of concurrency specified
+    by the user and the number of jobs in the queue, whichever is smaller.
+    Workers exit once the queue is empty and no other worker is busy with a
+    job which could put work back into the queue.
 
-    All threads produced by the worker are limited by the number of concurrency
-    specified by the user. The Threads are all made active prior to them
-    processing jobs.
+    :param kwargs: ``dict`` of arguments passed to the job_action.
+    :param threads: Maximum number of concurrent workers.
+    :param backend: Worker type, "process" or "thread".
+    :param timeout: Seconds a worker waits on an empty queue.
+    :return: ``list`` of JobResult, one per job that was run.
     """
 
-    jobs = [multiprocessing.Process(target=doerator,
-                                    args=tuple([kwargs]))
+    if backend not in BACKENDS:
+        raise ValueError('Unknown worker backend "%s"' % backend)
+
+    worker, result_q = BACKENDS[backend]
+    result_q = result_q()
+    busy = multiprocessing.Value('i', 0)
+
+    try:
+        # Fixes Errors with OS X due to no sem_getvalue support
+        threads = max(1, min(threads, kwargs['queue'].qsize()))
+    except NotImplementedError:
+        pass
+
+    jobs = [worker(target=doerator,
+                   args=(kwargs, result_q, busy, timeout))
             for _ in xrange(threads)]
+    for job in jobs:
+        job.start()
 
-    join_jobs = []
-    for _job in jobs:
-        time.sleep(.1)
-        join_jobs.append(_job)
-        _job.start()
+    results = []
+    while any([job.is_alive() for job in jobs]):
+        try:
+            results.append(result_q.get(timeout=.1))
+        except Queue.Empty:
+            pass
 
-    for job in join_jobs:
+    for job in jobs:
         job.join()
 
+    while True:
+        try:
+            results.append(result_q.get_nowait())
+        except Queue.Empty:
+            return results
 
-def doerator(kwargs):
-    """Do Jobs until done."""
 
-    while True:
-        # Get the file that we want to work with
-        queue = kwargs.get('queue')
-        job_action = kwargs.get('job_action')
+def doerator(kwargs, result_q=None, busy=None, timeout=.5):
+    """Do Jobs until done.
 
-        target = get_from_q(queue=queue)
+    :param kwargs: ``dict`` of arguments passed to the job_action.
+    :param result_q: Queue that JobResults are placed in.
+    :param busy: Shared count of workers that are processing a job.
+    :param timeout: Seconds to wait on an empty queue.
+    """
 
-        # If Work is None return None
-        if target is None:
-            break
-        else:
-            kwargs['target'] = target
+    queue = kwargs.get('queue')
+    job_action = kwargs.get('job_action')
+    job_args = inspect.getargspec(job_action).args
+
+    while True:
+        # Get the file that we want to work with
+        try:
+            target = queue.get(timeout=timeout)
+        except Queue.Empty:
+            # Busy workers may still put work back on the queue.
+            if busy is not None and busy.value > 0:
+                continue
+            else:
+                break
 
         job_kwargs = {}
-        for kwarg in inspect.getargspec(job_action).args:
-            if kwarg in kwargs:
+        for kwarg in job_args:
+            if kwarg == 'target':
+                job_kwargs[kwarg] = target
+            elif kwarg in kwargs:
                 job_kwargs[kwarg] = kwargs[kwarg]
 
+        if busy is not None:
+            with busy.get_lock():
+                busy.value += 1
+
         # Do the job that was provided
-        job_action(**job_kwargs)
+        try:
+            result = JobResult(target, job_action(**job_kwargs), None)
+        except Exception as exc:
+            result = JobResult(target, None, _portable(exc))
+        finally:
+            if busy is not None:
+                with busy.get_lock():
+                    busy.value -= 1
+
+        if result_q is not None:
+            result_q.put(result)
+
+
+# Worker type and the matching result queue type for each worker backend.
+BACKENDS = {
+    'process': (multiprocessing.Process, multiprocessing.Queue),
+    'thread': (threading.Thread, Queue.Queue)
+}
+
+
+# HTTP status codes which are worth retrying, 5xx codes are always retried.
+RETRY_CODES = (408, 413, 429)
 
+# Connection errors without a status code, novaclient raises its own for
+# the calls which still go through it. Its Timeout is not in every version.
+RETRY_ERRORS = tuple(
+    [requests.ConnectionError, requests.Timeout, socket.error,
+     nova_exceptions.ConnectionRefused] +
+    [getattr(nova_exceptions, name) for name in ('Timeout',)
+     if hasattr(nova_exceptions, name)]
+)
 
-def retryloop(attempts, timeout=None, delay=None, backoff=1):
+
+def retryable(exc):
+    """Return True if an exception is worth retrying.
+
+    Connection errors, rate limits and server side errors are retryable, any
+    other error will fail the same way when tried again.
+
+    :param exc: Exception raised by a client call.
+    :return: ``bool``
+    """
+
+    if isinstance(exc, RETRY_ERRORS):
+        return True
+
+    try:
+        code = int(getattr(exc, 'code', None))
+    except (TypeError, ValueError):
+        return False
+    else:
+        return code in RETRY_CODES or code >= 500
+
+
+def retry_after(exc):
+    """Return the seconds a rate limited request asked us to wait, or None.
+
+    :param exc: Exception raised by a client call.
+    """
+
+    try:
+        wait = int(getattr(exc, 'retry_after', 0))
+    except (TypeError, ValueError):
+        return None
+    else:
+        return wait or None
+
+
+def retryloop(attempts, timeout=None, delay=None, backoff=1, max_delay=None,
+              jitter=False):
     """Enter the amount of retries you want to perform.
 
-    The timeout allows the application to quit on "X".
-    delay allows the loop to wait on fail. Useful for making REST calls.
+    The timeout is a deadline for the whole loop, no wait will run past it and
+    once it has passed the loop fails. delay allows the loop to wait on fail.
+    Useful for making REST calls.
+
+    With jitter the waits use decorrelated jitter, each wait is a random
+    value between delay and three times the previous wait, capped at
+    max_delay. The retry function can be given a delay, such as the
+    Retry-After of a rate limited request, which the next wait will honour.
 
     ACTIVE STATE retry loop
     http://code.activestate.com/recipes/578163-retry-loop/
 
     Example:
         Function for retring an action.
-        for retry in retryloop(attempts=10, timeout=30, delay=1, backoff=1):
+        for retry in retryloop(attempts=10, timeout=30, delay=1, jitter=True):
             something
             if somecondition:
                 retry()
@@ -113,26 +250,46 @@ def retryloop(attempts, timeout=None, delay=None, backoff=1):
     :param timeout:
     :param delay:
     :param backoff:
+    :param max_delay:
+    :param jitter:
     """
 
     starttime = time.time()
-    success = set()
-    for _ in range(attempts):
-        success.add(True)
-        yield success.clear
+    wait = delay
+    failure = {}
 
-        if success:
-            return
+    def retry(delay=None):
+        failure['delay'] = delay
+
+    for attempt in range(attempts):
+        failure.clear()
+        yield retry
 
-        duration = time.time() - starttime
-        if timeout is not None and duration > timeout:
+        if not failure:
+            return
+        elif attempt + 1 == attempts:
             break
 
         if delay:
-            time.sleep(delay)
-            delay *= backoff
-    else:
-        raise sk.RetryError('Failed to process Job...')
+            if jitter:
+                wait = random.uniform(delay, wait * 3)
+            elif attempt > 0:
+                wait *= backoff
+
+            if max_delay is not None:
+                wait = min(wait, max_delay)
+
+        sleep = max(wait or 0, failure['delay'] or 0)
+        if timeout is not None:
+            remaining = timeout - (time.time() - starttime)
+            if remaining <= 0:
+                break
+            sleep = min(sleep, remaining)
+
+        if sleep:
+            time.sleep(sleep)
+
+    raise sk.RetryError('Failed to process Job...')
 
 
 class IndicatorThread(object):